@@ -0,0 +1,111 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import sys
+import time
+from itertools import chain
+
+from django.db import connection
+from django.test.simple import DjangoTestSuiteRunner
+from django.contrib.contenttypes.models import ContentType
+
+from chroma_core.lib.cache import ObjectCache
+from chroma_core.models import ManagedFilesystem, ManagedMgs, ManagedMdt, ManagedOst, ManagedTarget, ManagedTargetMount
+from chroma_core.models import Nid
+from chroma_core.services.job_scheduler.command_plan import CommandPlan
+from chroma_core.services.job_scheduler.job_scheduler import JobCollection
+from chroma_core.services.job_scheduler.lock_cache import LockCache
+from benchmark.generic import GenericBenchmark
+
+
+class Benchmark(GenericBenchmark):
+    """Time the planning of the jobs to start filesystems of increasing size: the
+    CommandPlan.command_set_state call which the job_scheduler makes when a filesystem
+    is set to 'available', without running any of the jobs."""
+
+    def __init__(self, *args, **kwargs):
+        self.sizes = [int(size) for size in kwargs['sizes'].split(",")]
+        self.ost_per_oss = kwargs['ost_per_oss']
+        self.test_runner = DjangoTestSuiteRunner()
+        self.prepare()
+
+    def prepare(self):
+        from south.management.commands import patch_for_test_db_setup
+        from tests.unit.chroma_core.helpers import load_default_profile
+
+        self.test_runner.setup_test_environment()
+        # This is necessary to ensure that we use django.core.syncdb()
+        # instead of south's hacked syncdb()
+        patch_for_test_db_setup()
+        self.old_db_config = self.test_runner.setup_databases()
+        load_default_profile()
+
+    def cleanup(self):
+        self.test_runner.teardown_databases(self.old_db_config)
+        self.test_runner.teardown_test_environment()
+
+    def _host(self, address):
+        from tests.unit.chroma_core.helpers import synthetic_host
+
+        self.host_count += 1
+        return synthetic_host(address, [Nid.Nid("10.0.%d.%d" % (self.host_count / 250, self.host_count % 250), "tcp", 0)])
+
+    def _volume(self, primary, secondary):
+        from tests.unit.chroma_core.helpers import synthetic_volume_full
+
+        return synthetic_volume_full(primary, [secondary]).id
+
+    def create_filesystem(self, name, ost_count):
+        """Create a filesystem with ost_count OSTs on pairs of OSSes, and an MGT and MDT on
+        a pair of servers of their own, as they would be after being added to the manager"""
+        self.host_count = getattr(self, 'host_count', 0)
+        mds = [self._host("%s-mds%d" % (name, i)) for i in range(0, 2)]
+        oss_count = max(2, (ost_count + self.ost_per_oss - 1) / self.ost_per_oss)
+        oss_count += oss_count % 2
+        osss = [self._host("%s-oss%d" % (name, i)) for i in range(0, oss_count)]
+
+        mgt, mgt_tms = ManagedMgs.create_for_volume(self._volume(mds[0], mds[1]), name = "MGS")
+        fs = ManagedFilesystem.objects.create(mgs = mgt, name = name)
+        ObjectCache.add(ManagedFilesystem, fs)
+        mdt, mdt_tms = ManagedMdt.create_for_volume(self._volume(mds[1], mds[0]), filesystem = fs)
+        osts = []
+        ost_tms = []
+        for i in range(0, ost_count):
+            primary = (i * oss_count) / ost_count
+            secondary = primary - 1 if primary % 2 else primary + 1
+            ost, tms = ManagedOst.create_for_volume(self._volume(osss[primary], osss[secondary]), filesystem = fs)
+            osts.append(ost)
+            ost_tms.extend(tms)
+
+        for target in [mgt, mdt] + osts:
+            ObjectCache.add(ManagedTarget, target.managedtarget_ptr)
+        for tm in chain(mgt_tms, mdt_tms, ost_tms):
+            ObjectCache.add(ManagedTargetMount, tm)
+
+        return fs
+
+    def plan(self, fs):
+        """Plan setting fs to 'available', returning the seconds taken, and the number of jobs
+        and queries"""
+        plan = CommandPlan(LockCache(), JobCollection())
+        ct_nk = ContentType.objects.get_for_model(fs).natural_key()
+        queries = len(connection.queries)
+        started = time.time()
+        command = plan.command_set_state([(ct_nk, fs.id, 'available')], "Benchmark start %s" % fs.name)
+        elapsed = time.time() - started
+        return elapsed, command.jobs.count(), len(connection.queries) - queries
+
+    def run(self):
+        connection.use_debug_cursor = True
+        try:
+            print "%8s %8s %10s %10s %12s" % ('osts', 'jobs', 'queries', 'seconds', 'ms/job')
+            for size in self.sizes:
+                sys.stderr.write("\rCreating filesystem with %d OSTs..." % size)
+                fs = self.create_filesystem("bench%d" % size, size)
+                sys.stderr.write("\r" + " " * 60 + "\r")
+                elapsed, jobs, queries = self.plan(fs)
+                print "%8d %8d %10d %10.3f %12.3f" % (size, jobs, queries, elapsed, 1000.0 * elapsed / jobs)
+        finally:
+            connection.use_debug_cursor = False
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from benchmark.command_plan import Benchmark
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+            make_option("--sizes", type=str, default="8,32,100,200",
+                help="comma separated numbers of OSTs of the filesystems to plan (default: 8,32,100,200)"),
+            make_option("--ost_per_oss", type=int, default=4,
+                help="number of OSTs per OSS (default: 4)"),
+    )
+    help = "Benchmark the planning of the jobs to start filesystems of increasing size"
+
+    def handle(self, *args, **kwargs):
+        bench = Benchmark(*args, **kwargs)
+        bench.run()
+        bench.cleanup()
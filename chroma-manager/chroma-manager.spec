@@ -73,6 +73,7 @@ Requires: iml-online-help
 Requires: iml-device-scanner-aggregator
 Requires: createrepo
 Requires: python2-toolz
+Requires: numpy
 Conflicts: chroma-agent
 Requires(post): selinux-policy-targeted
 Obsoletes: httpd
@@ -27,6 +27,9 @@ from chroma_api.chroma_model_resource import ChromaModelResource
 
 
 from chroma_core.services.plugin_runner.scan_daemon_interface import ScanDaemonRpcInterface
+from chroma_core.services import log_register
+
+log = log_register(__name__)
 
 
 class StorageResourceValidation(Validation):
@@ -300,6 +303,17 @@ class StorageResourceResource(MetricResource, ChromaModelResource):
 
         # Construct a record
         record, created = StorageResourceRecord.get_or_create_root(resource_class, resource_class_id, attrs)
+        if created:
+            # Start scanning it now rather than at the plugin_runner's next reconciliation,
+            # which will still pick it up if this doesn't get through.  Commit first so that
+            # the plugin_runner can see the record.
+            from django.db import transaction
+            with transaction.commit_manually():
+                transaction.commit()
+            try:
+                ScanDaemonRpcInterface().add_resource(record.id)
+            except Exception as e:
+                log.warning("Failed to notify plugin_runner of new resource %s: %s" % (record.id, e))
         #record_dict = self.full_dehydrate(self.build_bundle(obj = record)).data
         bundle.obj = record
 
@@ -17,6 +17,7 @@ from tastypie import fields
 
 from chroma_core.services import log_register
 from chroma_api.authentication import AnonymousAuthentication
+from chroma_api.utils import metric_cache
 
 
 log = log_register(__name__)
@@ -86,6 +87,9 @@ class SystemStatus(object):
 
         return {'queues': queues}
 
+    def get_metric_cache(self):
+        return metric_cache.stats()
+
 
 class SystemStatusResource(Resource):
     """
@@ -94,6 +98,7 @@ class SystemStatusResource(Resource):
 
     postgres = fields.DictField(help_text = "PostgreSQL statistics")
     rabbitmq = fields.DictField(help_text = "RabbitMQ statistics")
+    metric_cache = fields.DictField(help_text = "Metric query cache statistics of the API process serving this request")
 
     class Meta:
         object_class = SystemStatus
@@ -113,6 +118,9 @@ class SystemStatusResource(Resource):
     def dehydrate_postgres(self, bundle):
         return bundle.obj.get_postgres_stats()
 
+    def dehydrate_metric_cache(self, bundle):
+        return bundle.obj.get_metric_cache()
+
     def get_list(self, request = None, **kwargs):
         bundle = self.build_bundle(obj = SystemStatus(), request = request)
         bundle = self.full_dehydrate(bundle)
@@ -4,12 +4,15 @@
 
 
 import sys
+import time
 import traceback
 import logging
 import itertools
+import functools
+import threading
+from datetime import timedelta
 from chroma_core.models.jobs import SchedulingError
-import bisect
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 
 from django.contrib.contenttypes.models import ContentType
@@ -32,7 +35,10 @@ from chroma_api.chroma_model_resource import ChromaModelResource
 import chroma_core.lib.conf_param
 from chroma_core.models import utils as conversion_util
 from iml_common.lib.date_time import IMLDateTime
-from chroma_core.lib.metrics import MetricStore, Counter
+from chroma_core.lib.metrics import MetricStore, MetricTable
+from chroma_core.models import Stats
+from chroma_core.models.stats import total_seconds
+import settings
 
 from collections import defaultdict
 from django.db.models.query import QuerySet
@@ -386,6 +392,110 @@ class ConfParamResource(StatefulModelResource):
         return bundle
 
 
+class MetricCache(object):
+    """Results of metric list queries, keyed by the query without its time range, for dashboards which poll
+    the same query repeatedly.
+
+    Buckets older than the stats watermark (the most recent stored sample) at the time they were computed are
+    settled, less a period for servers which report late, and are reused for later queries.  Only buckets from
+    there on are computed again once newer samples have been inserted.  The watermark itself is queried at most
+    once per `watermark_age` seconds, so samples stored meanwhile are seen that much later.  Counters are kept
+    per process.
+    """
+    RANGE_PARAMS = 'begin', 'end', 'update', 'max_points', '_'
+
+    def __init__(self, size, settle, watermark_age):
+        self.size = size
+        self.settle = timedelta(seconds=settle)
+        self.watermark_age = watermark_age
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self._watermark = None
+        self._watermark_at = 0
+        self.counters = dict.fromkeys(('hits', 'misses', 'evictions', 'buckets_reused', 'buckets_computed'), 0)
+
+    def resolution(self, begin, end, max_points, watermark):
+        "Return sample step which a query for the time range will most likely be served at."
+        minstep = total_seconds(end - begin) / max_points
+        for model in Stats[:-1]:
+            if model.step >= minstep and begin + model.expiration_time >= watermark:
+                return model.step
+        return Stats[-1].step
+
+    def watermark(self):
+        "Return the stats watermark, querying it again once it is older than `watermark_age` seconds."
+        now = time.time()
+        with self.lock:
+            if self._watermark is not None and now - self._watermark_at < self.watermark_age:
+                return self._watermark
+        watermark = Stats.watermark()
+        with self.lock:
+            self._watermark, self._watermark_at = watermark, now
+        return watermark
+
+    def count(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                self.counters[name] += count
+
+    def fetch(self, key, begin, end, max_points, compute):
+        """Return results of compute(begin, end, max_points) for the given key, reusing settled buckets.
+        Results are mappings of keys to datetimes with dicts of field names and values."""
+        watermark = self.watermark()
+        step = self.resolution(begin, end, max_points, watermark)
+        key += (step,)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+        if entry is None or entry['begin'] > begin:
+            settled = begin
+        elif watermark == entry['watermark']:
+            settled = entry['end']  # nothing newer was stored since
+        else:
+            settled = min(entry['watermark'], entry['end']) - self.settle
+        if settled <= begin:
+            entry = {'results': {}}
+            settled = begin
+            fresh = compute(begin, end, max_points)
+        elif settled < end:
+            # start a couple of samples early so rates and carried values have their previous sample
+            start = settled - timedelta(seconds=2 * step)
+            fresh = compute(start, end, total_seconds(end - start) * 2 / step)
+        else:
+            fresh = {}
+
+        retained = end - timedelta(seconds=step * max(max_points, 1))
+        merged, results = {}, {}
+        for group in set(entry['results']) | set(fresh):
+            stats = dict((dt, data) for dt, data in entry['results'].get(group, {}).items() if retained <= dt < settled)
+            stats.update((dt, data) for dt, data in fresh.get(group, {}).items() if max(settled, begin) <= dt < end)
+            merged[group] = stats
+            results[group] = dict((dt, data) for dt, data in stats.items() if begin <= dt)
+        reused = sum(1 for stats in entry['results'].values() for dt in stats if max(retained, begin) <= dt < settled)
+        computed = sum(len(stats) for stats in results.values()) - reused
+        self.count(**{'hits' if entry['results'] else 'misses': 1, 'buckets_reused': reused, 'buckets_computed': computed})
+
+        with self.lock:
+            self.entries[key] = {'begin': min(begin, retained), 'end': end, 'watermark': watermark, 'results': merged}
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+        return results
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self._watermark = None
+
+    def stats(self):
+        "Return counters and number of cached queries."
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries))
+
+
+metric_cache = MetricCache(settings.METRIC_CACHE_SIZE, settings.METRIC_CACHE_SETTLE_SECONDS, settings.METRIC_CACHE_WATERMARK_SECONDS)
+
+
 class MetricResource:
     def prepend_urls(self):
         from django.conf.urls.defaults import url
@@ -500,22 +610,31 @@ class MetricResource:
 
     def _reduce(self, metrics, results, reduce_fn):
         # Want an overall reduction into one series
-        if reduce_fn not in ('sum', 'average'):
-            raise NotImplementedError
-        datetimes = dict((obj_id, sorted(data)) for obj_id, data in results.items())
-        result = {}
-        for dt in set(itertools.chain(*datetimes.values())):
-            result[dt] = counter = Counter.fromkeys(metrics, 0.0)
-            for obj_id, stats in results.items():
-                data = stats.get(dt, {})
-                dts = datetimes[obj_id]
-                if dts and not data:  # Didn't have one for this exact timestamp, do we have one before?
-                    data = stats[dts[max(bisect.bisect(dts, dt) - 1, 0)]]
-                counter.update(data)
-            if reduce_fn == 'average':
-                for name in counter:
-                    counter[name] /= len(results)
-        return result
+        tables = [stats if isinstance(stats, MetricTable) else MetricTable.fromdict(metrics, stats) for stats in results.values()]
+        return MetricTable.reduce(metrics, tables, reduce_fn).todict()
+
+    def _get_metric_results(self, objs, metrics, begin, end, max_points, job, num_points, reduce_fn, group_by):
+        """Return datetimes with dicts of field names and values, keyed by object id, by group if grouped,
+        or by None if reduced into a single series."""
+        if begin and end and not job:
+            result = MetricStore.fetch_many(objs, metrics, begin, end, max_points, num_points)
+            for obj_id in result:
+                result[obj_id] = result[obj_id].todict()
+        else:
+            result = dict((obj.id, self._fetch(MetricStore(obj), metrics, begin, end, job, max_points, num_points)) for obj in objs)
+        if not reduce_fn:
+            return result
+        if not group_by:
+            return {None: self._reduce(metrics, result, reduce_fn)}
+        # Want to reduce into groups, one series per group
+        groups = defaultdict(dict)
+        for obj in objs:
+            if hasattr(obj, 'content_type'):
+                obj = obj.downcast()
+            if hasattr(obj, group_by):
+                group_val = getattr(obj, group_by)
+                groups[getattr(group_val, 'id', group_val)][obj.id] = result[obj.id]
+        return dict((key, self._reduce(metrics, groups[key], reduce_fn)) for key in groups)
 
     def get_metric_list(self, request, metrics, begin, end, job, max_points, num_points, **kwargs):
         errors = {}
@@ -532,26 +651,20 @@ class MetricResource:
             raise custom_response(self, request, http.HttpNotFound, {'metrics': exc})
         metrics = metrics or set(itertools.chain.from_iterable(MetricStore(obj).names for obj in objs))
 
-        result = dict((obj.id, self._fetch(MetricStore(obj), metrics, begin, end, job, max_points, num_points)) for obj in objs)
-        if not reduce_fn:
-            for obj_id, stats in result.items():
-                result[obj_id] = self._format(stats)
-            return self.create_response(request, result)
-        if not group_by:
-            stats = self._reduce(metrics, result, reduce_fn)
-            return self.create_response(request, self._format(stats))
-        # Want to reduce into groups, one series per group
-        groups = defaultdict(dict)
-        for obj in objs:
-            if hasattr(obj, 'content_type'):
-                obj = obj.downcast()
-            if hasattr(obj, group_by):
-                group_val = getattr(obj, group_by)
-                groups[getattr(group_val, 'id', group_val)][obj.id] = result[obj.id]
-        for key in groups:
-            stats = self._reduce(metrics, groups[key], reduce_fn)
-            groups[key] = self._format(stats)
-        return self.create_response(request, groups)
+        compute = functools.partial(self._get_metric_results, objs, metrics, job=job, num_points=num_points,
+                                    reduce_fn=reduce_fn, group_by=group_by)
+        if begin and end and not (job or num_points):
+            # the time range and resolution are part of the cached results, any other parameter is a distinct query
+            params = sorted((name, values) for name, values in request.GET.lists() if name not in MetricCache.RANGE_PARAMS)
+            # as are the objects measured, so that one being added or removed isn't served from the cache
+            key = (self._meta.resource_name, kwargs.get('pk'), tuple(sorted(metrics)), repr(params),
+                   tuple(sorted(obj.id for obj in objs)))
+            result = metric_cache.fetch(key, begin, end, max_points, compute)
+        else:
+            result = compute(begin, end, max_points)
+        for key, stats in result.items():
+            result[key] = self._format(stats)
+        return self.create_response(request, result[None] if reduce_fn and not group_by else result)
 
 
 class SeverityResource(ChromaModelResource):
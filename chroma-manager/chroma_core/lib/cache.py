@@ -10,6 +10,67 @@ from chroma_core.services import log_register
 log = log_register(__name__)
 
 
+class TargetIndex(object):
+    """The filesystems which each cached target belongs to, counts of the states of the targets
+    of each filesystem, and the primary mount of each target.
+
+    Built from the cached objects with a query per kind of filesystem member, and then
+    kept up to date as targets are updated and purged, so that the state of a filesystem's
+    targets can be checked without loading them.  The filesystems of a purged target are
+    remembered, for the completion of the job which removed it.
+
+    """
+
+    def __init__(self, objects):
+        from chroma_core.models import ManagedFilesystem, ManagedMdt, ManagedOst
+        from chroma_core.models.target import ManagedTarget, ManagedTargetMount
+
+        targets = objects[ManagedTarget]
+        filesystems = objects[ManagedFilesystem]
+
+        self.filesystems = defaultdict(set)
+        for filesystem in filesystems.values():
+            self.filesystems[filesystem.mgs_id].add(filesystem.id)
+        for klass in [ManagedMdt, ManagedOst]:
+            for member in klass.objects.filter(filesystem__in = filesystems.keys()).values('id', 'filesystem_id'):
+                self.filesystems[member['id']].add(member['filesystem_id'])
+
+        self.states = {}
+        self.state_counts = defaultdict(lambda: defaultdict(int))
+        for target_id in self.filesystems.keys():
+            if target_id in targets:
+                self.states[target_id] = None
+                self.set_state(target_id, targets[target_id].state)
+            else:
+                del self.filesystems[target_id]
+
+        self.primary_mounts = {}
+        for mount in objects[ManagedTargetMount].values():
+            if mount.primary:
+                self.primary_mounts[mount.target_id] = mount
+
+    def _count(self, target_id, state, n):
+        for filesystem_id in self.filesystems[target_id]:
+            counts = self.state_counts[filesystem_id]
+            counts[state] += n
+            if not counts[state]:
+                del counts[state]
+
+    def set_state(self, target_id, state):
+        """Count the new state of a filesystem's target"""
+        if target_id not in self.states or self.states[target_id] == state:
+            return
+
+        if self.states[target_id] is not None:
+            self._count(target_id, self.states[target_id], -1)
+        self._count(target_id, state, 1)
+        self.states[target_id] = state
+
+    def remove(self, target_id):
+        if target_id in self.states:
+            self._count(target_id, self.states.pop(target_id), -1)
+
+
 class ObjectCache(object):
     instance = None
 
@@ -30,6 +91,10 @@ class ObjectCache(object):
                                Copytool, PacemakerConfiguration, CorosyncConfiguration,
                                Corosync2Configuration, NTPConfiguration]
 
+        # Built when first needed and dropped when targets, filesystems or mounts come or go
+        self._target_index = None
+        self._target_index_models = [ManagedTarget, ManagedFilesystem, ManagedTargetMount]
+
         for klass in self._cached_models:
             args = filter_args.get(klass, {})
             for obj in klass.objects.filter(**args):
@@ -41,6 +106,8 @@ class ObjectCache(object):
         log.debug("_add %s %s %s" % (instance.__class__, instance.id, id(instance)))
 
         self.objects[klass][instance.pk] = instance
+        if klass in self._target_index_models:
+            self._target_index = None
 
     @classmethod
     def add(cls, klass, instance):
@@ -84,6 +151,35 @@ class ObjectCache(object):
 
         return targets
 
+    def _get_target_index(self):
+        if self._target_index is None:
+            self._target_index = TargetIndex(self.objects)
+        return self._target_index
+
+    @classmethod
+    def target_filesystem_ids(cls, target_id):
+        """Return the ids of the filesystems a target belongs to: its own, or those whose MGS it is"""
+        return cls.getInstance()._get_target_index().filesystems.get(target_id, set())
+
+    @classmethod
+    def filesystem_target_states(cls, filesystem_id):
+        """Return the set of states of the targets of a filesystem, including its MGS"""
+        return set(cls.getInstance()._get_target_index().state_counts[filesystem_id].keys())
+
+    @classmethod
+    def target_state_changed(cls, target):
+        """Count the state of a target which may have been read from the database, rather than
+        updated in the cache"""
+        cls.getInstance()._get_target_index().set_state(target.id, target.state)
+
+    @classmethod
+    def target_primary_mount(cls, target_id):
+        from chroma_core.models.target import ManagedTargetMount
+        try:
+            return cls.getInstance()._get_target_index().primary_mounts[target_id]
+        except KeyError:
+            return ManagedTargetMount.objects.get(target = target_id, primary = True)
+
     @classmethod
     def get_one(cls, klass, filter = None):
         assert klass in cls.getInstance()._cached_models
@@ -97,9 +193,7 @@ class ObjectCache(object):
 
     @classmethod
     def target_primary_server(cls, target):
-        from chroma_core.models.target import ManagedTargetMount
-        primary_mtm = cls.get_one(ManagedTargetMount, lambda mtm: mtm.target.id == target.id and mtm.primary == True)
-        return primary_mtm.host
+        return cls.target_primary_mount(target.id).host
 
     @classmethod
     def getInstance(cls):
@@ -144,7 +238,17 @@ class ObjectCache(object):
 
     @classmethod
     def purge(cls, klass, filter):
-        cls.getInstance().objects[klass] = dict([(o.pk, o) for o in cls.getInstance().objects[klass].values() if not filter(o)])
+        instance = cls.getInstance()
+        from chroma_core.models.target import ManagedTarget
+
+        purged = [o for o in instance.objects[klass].values() if filter(o)]
+        instance.objects[klass] = dict([(o.pk, o) for o in instance.objects[klass].values() if not filter(o)])
+        if instance._target_index is not None:
+            if klass == ManagedTarget:
+                for target in purged:
+                    instance._target_index.remove(target.pk)
+            elif klass in instance._target_index_models:
+                instance._target_index = None
 
     def _update(self, obj):
         log.debug("update: %s %s" % (obj.__class__, obj.id))
@@ -157,6 +261,12 @@ class ObjectCache(object):
                 return None
             else:
                 class_collection[obj.pk] = fresh_instance
+                if self._target_index is not None:
+                    from chroma_core.models.target import ManagedTarget, ManagedTargetMount
+                    if obj.__class__ == ManagedTarget:
+                        self._target_index.set_state(obj.pk, fresh_instance.state)
+                    elif obj.__class__ == ManagedTargetMount:
+                        self._target_index = None
             return fresh_instance
 
     @classmethod
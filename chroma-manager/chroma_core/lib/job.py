@@ -157,6 +157,11 @@ class Step(object):
     # database connections)
     database = False
 
+    # If true, this step may spend a long time waiting (for a server to restart, say),
+    # so it runs in a thread of its own rather than holding one of the job_scheduler's
+    # step workers
+    long_running = False
+
     def run(self, kwargs):
         raise NotImplementedError
 
@@ -3,13 +3,20 @@
 # license that can be found in the LICENSE file.
 
 
+import math
 import time
 import heapq
+import operator
+import itertools
 import collections
 from datetime import datetime
+import numpy
 from chroma_core.services import log_register
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
 from django.utils.timezone import utc
-from chroma_core.models import Point, Series, Stats, ManagedHost, ManagedTarget, ManagedFilesystem
+from chroma_core.models import Series, Stats, ManagedHost, ManagedTarget, ManagedFilesystem
+from chroma_core.models.stats import means, rollup, to_datetime, to_timestamp
 from chroma_core.lib.storage_plugin.api import statistics
 from chroma_core.lib import scheduler
 
@@ -26,6 +33,74 @@ class Counter(dict):
             self[key] += other[key]
 
 
+class MetricTable(collections.namedtuple('MetricTable', ('metrics', 'timestamps', 'values'))):
+    """Values of metrics at sorted timestamps, as a matrix with one row per timestamp and one column per metric.
+    Missing values are nan.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def empty(cls, metrics, rows=0):
+        values = numpy.empty((rows, len(metrics)))
+        values.fill(numpy.nan)
+        return cls(list(metrics), numpy.empty(rows), values)
+
+    @classmethod
+    def fromdict(cls, metrics, stats):
+        "Return table from datetimes with dicts of field names and values;  unknown fields are appended to metrics."
+        metrics = list(metrics)
+        metrics += sorted(set(itertools.chain.from_iterable(stats.values())).difference(metrics))
+        columns = dict((name, column) for column, name in enumerate(metrics))
+        table = cls.empty(metrics, len(stats))
+        for row, dt in enumerate(sorted(stats)):
+            table.timestamps[row] = to_timestamp(dt)
+            for name, value in stats[dt].items():
+                table.values[row, columns[name]] = value
+        return table
+
+    def todict(self):
+        "Return datetimes with dicts of field names and values."
+        result = {}
+        for ts, row in zip(self.timestamps.tolist(), self.values.tolist()):
+            result[to_datetime(ts)] = dict((name, value) for name, value in zip(self.metrics, row) if not math.isnan(value))
+        return result
+
+    def align(self, metrics):
+        "Return values with columns in the order of the given metrics."
+        if self.metrics == metrics:
+            return self.values
+        table = self.empty(metrics, len(self.timestamps))
+        table.values[:, [metrics.index(name) for name in self.metrics]] = self.values
+        return table.values
+
+    @classmethod
+    def reduce(cls, metrics, tables, reduce_fn):
+        """Return a single table with the sum or average of all tables at each of their timestamps.
+        A table without a row at a timestamp contributes its previous row, or else its earliest row.
+        The given metrics are always present, defaulting to 0.
+        """
+        if reduce_fn not in ('sum', 'average'):
+            raise NotImplementedError
+        tables, required, metrics = list(tables), len(metrics), list(metrics)
+        for table in tables:
+            metrics += [name for name in table.metrics if name not in metrics]
+        timestamps = numpy.unique(numpy.concatenate([table.timestamps for table in tables] or [[]]))
+        result = cls(metrics, timestamps, numpy.zeros((len(timestamps), len(metrics))))
+        present = numpy.zeros(result.values.shape, bool)
+        for table in tables:
+            if len(table.timestamps):
+                rows = (numpy.searchsorted(table.timestamps, timestamps, 'right') - 1).clip(0, None)
+                values = table.align(metrics)[rows]
+                missing = numpy.isnan(values)
+                present |= ~missing
+                result.values[~missing] += values[~missing]
+        if reduce_fn == 'average' and tables:
+            result.values[:] /= len(tables)
+        present[:, :required] = True
+        result.values[~present] = numpy.nan
+        return result
+
+
 class MetricStore(object):
     """
     Base class for metric stores.
@@ -43,11 +118,11 @@ class MetricStore(object):
 
     def serialize(self, update):
         "Generate serialized samples (id, dt, value) from a timestamped update dict."
+        series = Series.get_many(self.measured_object, dict((name, item['type']) for data in update.values() for name, item in data.items()))
         for ts, data in update.items():
             dt = datetime.fromtimestamp(ts, utc)
             for name, item in data.items():
-                series = Series.get(self.measured_object, name, item['type'])
-                yield series.id, dt, item['value']
+                yield series[name].id, dt, item['value']
 
     def clear(self):
         "Remove all associated series."
@@ -62,18 +137,61 @@ class MetricStore(object):
 
     def fetch(self, fetch_metrics, begin, end, max_points=float('inf'), num_points=0):
         "Return datetimes with dicts of field names and values."
-        result = collections.defaultdict(dict)
-        types = set()
+        tables = self.fetch_many([self.measured_object], fetch_metrics, begin, end, max_points, num_points)
+        return tables[self.measured_object.id].todict()
+
+    @staticmethod
+    def fetch_many(objs, fetch_metrics, begin, end, max_points=float('inf'), num_points=0):
+        """Return mapping of object ids to MetricTables of the given metrics.
+        The series of all objects are resolved in one query, and read in one query per sample resolution.
+        """
+        fetch_metrics = list(fetch_metrics)
+        owners = {}
+        for obj in objs:
+            measured_object = MetricStore(obj).measured_object
+            owners[ContentType.objects.get_for_model(measured_object).id, measured_object.id] = obj.id
+        tables = dict((obj_id, MetricTable.empty(fetch_metrics)) for obj_id in owners.values())
+        if not owners:
+            return tables
+        object_ids = collections.defaultdict(list)
+        for content_type_id, object_id in owners:
+            object_ids[content_type_id].append(object_id)
+        query = reduce(operator.or_, (Q(content_type=content_type_id, object_id__in=ids) for content_type_id, ids in object_ids.items()))
+        series = dict((item.id, item) for item in Series.objects.filter(query, name__in=fetch_metrics))
         end = Stats[0].floor(end)  # exclude points from a partial sample
-        for series in Series.filter(self.measured_object, name__in=fetch_metrics):
-            types.add(series.type)
-            minimum = 0.0 if series.type == 'Counter' else float('-inf')
-            for point in Stats.select(series.id, begin, end, rate=series.type in ('Counter', 'Derive'), maxlen=max_points, fixed=num_points):
-                result[point.dt][series.name] = max(minimum, point.mean)
-        # if absolute and derived values are mixed, the earliest value will be incomplete
-        if result and types > set(['Gauge']) and len(result[min(result)]) < len(fetch_metrics):
-            del result[min(result)]
-        return dict(result)
+        columns = []
+        for rate in (False, True):
+            ids = [id for id in series if (series[id].type in ('Counter', 'Derive')) == rate]
+            if ids:
+                points = Stats.select_many(ids, begin, end, rate=rate, maxlen=max_points, fixed=num_points)
+                values = means(points)
+                counters = numpy.in1d(points['id'], [id for id in ids if series[id].type == 'Counter'])
+                values[counters] = numpy.maximum(values[counters], 0.0)
+                columns.append((points['id'], points['ts'], values))
+        if not columns:
+            return tables
+        ids, timestamps, values = map(numpy.concatenate, zip(*columns))
+        # group points by owning object, then place them by timestamp and metric
+        series_ids = numpy.array(sorted(series))
+        index = numpy.searchsorted(series_ids, ids)
+        obj_ids = numpy.array([owners[series[id].content_type_id, series[id].object_id] for id in series_ids.tolist()])[index]
+        metrics = numpy.array([fetch_metrics.index(series[id].name) for id in series_ids.tolist()])[index]
+        order = numpy.lexsort((timestamps, obj_ids))
+        obj_ids, timestamps, values, metrics = obj_ids[order], timestamps[order], values[order], metrics[order]
+        types = collections.defaultdict(set)
+        for item in series.values():
+            types[owners[item.content_type_id, item.object_id]].add(item.type)
+        for obj_id in numpy.unique(obj_ids).tolist():
+            section = slice(*numpy.searchsorted(obj_ids, [obj_id, obj_id + 1]))
+            unique, rows = numpy.unique(timestamps[section], return_inverse=True)
+            table = MetricTable.empty(fetch_metrics, len(unique))
+            table.timestamps[:] = unique
+            table.values[rows, metrics[section]] = values[section]
+            # if absolute and derived values are mixed, the earliest value will be incomplete
+            if types[obj_id] > set(['Gauge']) and numpy.isnan(table.values[0]).any():
+                table = MetricTable(table.metrics, table.timestamps[1:], table.values[1:])
+            tables[obj_id] = table
+        return tables
 
     def fetch_last(self, fetch_metrics):
         "Return latest datetime and dict of field names and values."
@@ -87,25 +205,29 @@ class MetricStore(object):
     def fetch_jobs(self, metric, begin, end, job, max_points=float('inf'), num_points=0):
         "Return datetimes with dicts of field names and values."
         result = collections.defaultdict(dict)
-        types = set()
         end = Stats[0].floor(end)  # exclude points from a partial sample
-        series_ids = Series.filter(self.measured_object, name__startswith='job_' + metric).values('id')
-        series_ids = Stats[0].objects.filter(id__in=series_ids, dt__gte=begin).values('id').distinct('id')
-        for series in Series.filter(self.measured_object, id__in=series_ids):
-            types.add(series.type)
-            for point in Stats.select(series.id, begin, end, rate=True, maxlen=max_points, fixed=num_points):
-                result[point.dt][series.name.split('_', 3)[-1]] = point
+        series_ids = Series.filter(self.measured_object, name__startswith='job_' + metric).values_list('id', flat=True)
+        series_ids = Stats.active(series_ids, begin)
+        series = dict((item.id, item) for item in Series.filter(self.measured_object, id__in=series_ids))
+        types = set(item.type for item in series.values())
         assert types.issubset(Series.JOB_TYPES)
+        points = Stats.select_many(list(series), begin, end, rate=True, maxlen=max_points, fixed=num_points)
+        job_ids = dict((id, series[id].name.split('_', 3)[-1]) for id in numpy.unique(points['id']).tolist())
         # translate job ids into metadata
-        metadata = dict((job_id, job_id) for points in result.values() for job_id in points)
+        metadata = dict((job_id, job_id) for job_id in job_ids.values())
         if job != 'id':
             for type in types:  # there should generally be only one
                 metadata.update(scheduler.metadata(type, job, metadata))
-        for dt in result:
-            data = collections.defaultdict(lambda: Point.zero)
-            for job_id, point in result[dt].items():
-                data[metadata[job_id]] += point
-            result[dt] = dict((key, max(0.0, data[key].mean)) for key in data)
+        # sum the rates of each job id with the same metadata
+        keys = sorted(set(metadata.values()))
+        positions = dict((key, position) for position, key in enumerate(keys))
+        index = dict((id, positions[metadata[job_ids[id]]]) for id in job_ids)
+        points['id'] = [index[id] for id in points['id'].tolist()]
+        points = rollup(points)
+        values = numpy.maximum(means(points), 0.0)
+        datetimes = dict((ts, to_datetime(ts)) for ts in numpy.unique(points['ts']).tolist())
+        for key, ts, value in zip(points['id'].tolist(), points['ts'].tolist(), values.tolist()):
+            result[datetimes[ts]][keys[key]] = value
         return dict(result)
 
 
@@ -0,0 +1,231 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""Columnar storage engine for time series, as an alternative to the Sample_* tables.
+
+Each series is stored per resolution in a fixed-size, memory-mapped ring file of (timestamp, sum, len)
+records.  A sample is kept in the slot indexed by its sample number modulo the ring size, so expiration
+is implicit, fetches are slices and rollups are vectorized.  The first record of each file holds the most
+recent point written to it.
+"""
+
+
+import os
+import math
+import errno
+import shutil
+import collections
+from datetime import timedelta
+
+import numpy
+
+from chroma_core.models.stats import POINTS, Cache, Point, SampleStats, concatenate, epoch, timestamp, to_datetime, to_timestamp, total_seconds
+
+
+RECORD = numpy.dtype([('ts', '<f8'), ('sum', '<f8'), ('len', '<i8')])
+
+
+class RingCache(Cache):
+    "Open rings;  bounded well below the kernel's limit on memory maps."
+    SIZE = 4096
+
+
+class Ring(object):
+    "Ring files of all series at a single resolution."
+
+    def __init__(self, path, sample):
+        self.path = path
+        self.step = sample.sample_rate
+        self.size = int(total_seconds(sample.expiration_time)) // self.step
+        self.expiration_time = timedelta(seconds=self.size * self.step)
+        self.cache = RingCache(None)
+
+    def __repr__(self):
+        return 'Ring_{0:d}'.format(self.step)
+
+    def open(self, id, create=False):
+        "Return memory-mapped ring for series, or None if it doesn't exist and isn't to be created."
+        try:
+            return self.cache[id]
+        except KeyError:
+            pass
+        filename = os.path.join(self.path, str(id))
+        if os.path.exists(filename):
+            ring = numpy.memmap(filename, dtype=RECORD, mode='r+', shape=(self.size + 1,))
+        elif create:
+            try:
+                os.makedirs(self.path)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            ring = numpy.memmap(filename, dtype=RECORD, mode='w+', shape=(self.size + 1,))
+        else:
+            return None
+        self.cache[id] = ring
+        return ring
+
+    def latest(self, id):
+        "Return most recent data point for series."
+        ring = self.open(id)
+        if ring is None or not ring[0]['len']:
+            return Point.zero
+        ts, sum, len = ring[0].tolist()
+        return Point(to_datetime(ts), sum, len)
+
+    def start(self, id):
+        "Return earliest datetime that is stored for series."
+        try:
+            return self.latest(id).dt - self.expiration_time
+        except OverflowError:
+            return epoch
+
+    def starts(self, ids):
+        "Return mapping of series ids to earliest datetimes that are stored."
+        return dict((id, self.start(id)) for id in ids)
+
+    def floor(self, dt):
+        "Return datetime rounded down to nearest sample size."
+        return dt - timedelta(seconds=timestamp(dt) % self.step, microseconds=dt.microsecond)
+
+    def records(self, id, start=None, stop=None):
+        "Return records of a series in time order, optionally within a half-open interval of timestamps."
+        ring = self.open(id)
+        if ring is None or not ring[0]['len']:
+            return numpy.zeros(0, RECORD)
+        last = int(ring[0]['ts'] // self.step)
+        if stop is not None:
+            last = min(last, int(math.ceil(stop / self.step)) - 1)
+        first = last - self.size + 1
+        if start is not None:
+            first = max(first, int(math.ceil(start / self.step)))
+        numbers = numpy.arange(first, last + 1)
+        records = ring[numbers % self.size + 1]
+        # slots which haven't been written since their sample number came around are stale
+        return records[(records['len'] > 0) & (records['ts'] == numbers * self.step)]
+
+    def select(self, id, dt__gte=None, dt__lt=None):
+        "Return points for a series."
+        start, stop = (dt and to_timestamp(dt) for dt in (dt__gte, dt__lt))
+        return [Point(to_datetime(ts), sum, len) for ts, sum, len in self.records(id, start, stop).tolist()]
+
+    def columns(self, ids, start, stop):
+        "Return array of points for multiple series within interval."
+        start, stop = to_timestamp(start), to_timestamp(stop)
+        arrays = []
+        for id in ids:
+            records = self.records(id, start, stop)
+            points = numpy.empty(len(records), POINTS)
+            points['id'] = id
+            for field in RECORD.names:
+                points[field] = records[field]
+            arrays.append(points)
+        return concatenate(arrays)
+
+    def write(self, id, timestamps, sums, lens):
+        "Add arrays of timestamped values into their sample slots."
+        latest = timestamps.argmax()
+        header = timestamps[latest], sums[latest], lens[latest]
+        buckets, index = numpy.unique(timestamps - timestamps % self.step, return_inverse=True)
+        sums = numpy.bincount(index, weights=sums)
+        lens = numpy.bincount(index, weights=lens).astype(numpy.int64)
+        # only the most recent samples fit in the ring
+        recent = buckets > buckets[-1] - self.size * self.step
+        buckets, sums, lens = buckets[recent], sums[recent], lens[recent]
+        ring = self.open(id, create=True)
+        slots = (buckets // self.step).astype(numpy.int64) % self.size + 1
+        current = ring[slots]
+        same = (current['len'] > 0) & (current['ts'] == buckets)
+        ring['sum'][slots] = sums + numpy.where(same, current['sum'], 0.0)
+        ring['len'][slots] = lens + numpy.where(same, current['len'], 0)
+        ring['ts'][slots] = buckets
+        if not ring[0]['len'] or header[0] >= ring[0]['ts']:
+            ring[0] = header
+
+    def insert(self, stats):
+        "Bulk insert mapping of series ids to points."
+        for id, points in stats.items():
+            if points:
+                ts, sums, lens = zip(*((to_timestamp(point.dt), point.sum, point.len) for point in points))
+                self.write(id, numpy.array(ts), numpy.array(sums, float), numpy.array(lens, numpy.int64))
+
+    def delete(self, id):
+        "Delete ring of a series."
+        self.cache.pop(id, None)
+        try:
+            os.remove(os.path.join(self.path, str(id)))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def delete_all(self):
+        "Delete rings of all series."
+        self.cache.clear()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class MmapStats(SampleStats):
+    "Stats interface backed by rings of each sample resolution."
+
+    def __init__(self, samples, path):
+        for sample in samples:
+            self.append(Ring(os.path.join(path, str(sample.sample_rate)), sample))
+        self.path = path
+        self.marker = None
+
+    def mark(self, create=False):
+        "Return memory-mapped timestamp of the most recent sample, or None if it doesn't exist and isn't to be created."
+        if self.marker is None:
+            filename = os.path.join(self.path, 'watermark')
+            if os.path.exists(filename) or create:
+                self.marker = numpy.memmap(filename, dtype=numpy.float64, mode='r+' if os.path.exists(filename) else 'w+', shape=(1,))
+        return self.marker
+
+    def insert(self, samples):
+        "Bulk insert new samples (id, dt, value).  Skip and return outdated samples."
+        outdated, stats = [], collections.defaultdict(list)
+        for id, dt, value in samples:
+            if dt > self[0].latest(id).dt:
+                stats[id].append((to_timestamp(dt), value))
+            else:
+                outdated.append((id, dt, value))
+        # every resolution accumulates its current sample, so there is no rollup pass
+        for id, values in stats.items():
+            timestamps, sums = map(numpy.array, zip(*values))
+            lens = numpy.ones(len(values), numpy.int64)
+            for ring in self:
+                ring.write(id, timestamps, sums.astype(float), lens)
+            marker = self.mark(create=True)
+            marker[0] = max(marker[0], timestamps.max())
+        return outdated
+
+    def latest(self, id):
+        "Return most recent data point."
+        point = self[0].latest(id)
+        return Point(self[0].floor(point.dt), point.sum, point.len)
+
+    def delete(self, id):
+        "Delete all stored points for a series."
+        for ring in self:
+            ring.delete(id)
+
+    def delete_all(self):
+        "Delete all stored points for all series."
+        for ring in self:
+            ring.delete_all()
+        self.marker = None
+        try:
+            os.remove(os.path.join(self.path, 'watermark'))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def active(self, ids, start):
+        "Return subset of series ids which have samples since start."
+        return [id for id in ids if self[0].latest(id).dt >= start]
+
+    def watermark(self):
+        "Return datetime of the most recent sample of any series."
+        marker = self.mark()
+        return epoch if marker is None else to_datetime(marker[0])
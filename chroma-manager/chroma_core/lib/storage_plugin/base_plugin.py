@@ -278,11 +278,14 @@ class BaseStoragePlugin(object):
             self._delta_alerts.clear()
 
     def _commit_resource_statistics(self):
-        samples = []
+        updates = []
         for resource in self._index.all():
             r_stats = resource.flush_stats()
             if r_stats and settings.STORAGE_PLUGIN_ENABLE_STATS:
-                samples += self._resource_manager.session_get_stats(self._scannable_id, resource._handle, r_stats)
+                updates.append((resource._handle, r_stats))
+        samples = []
+        if updates:
+            samples = self._resource_manager.session_get_stats_many(self._scannable_id, updates)
         if samples:
             StatsQueue().put(samples)
         return len(samples)
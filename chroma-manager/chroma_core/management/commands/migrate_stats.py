@@ -0,0 +1,41 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from chroma_core.models import Series
+from chroma_core.models.stats import engine
+
+
+class Command(BaseCommand):
+    help = """Copy all stored stats samples from one storage engine ('postgres' or 'mmap') to another.
+The stats service should be stopped while migrating, and STATS_ENGINE set to the target engine afterwards."""
+    option_list = BaseCommand.option_list + (
+        make_option('--from', dest = 'source', default = 'postgres'),
+        make_option('--to', dest = 'target', default = 'mmap'),
+        make_option('--delete', dest = 'delete', action = 'store_true', default = False,
+                    help = "delete samples from the source engine once copied"),
+    )
+
+    def handle(self, *args, **options):
+        if options['source'] == options['target']:
+            raise CommandError("Source and target engines must differ")
+        try:
+            source, target = engine(options['source']), engine(options['target'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        ids = list(Series.objects.values_list('id', flat=True))
+        for count, id in enumerate(ids, 1):
+            target.delete(id)
+            # each resolution is copied as is, rather than being rolled up again
+            for src, dst in zip(source, target):
+                dst.insert({id: list(src.select(id))})
+            if options['delete']:
+                source.delete(id)
+            if count % 1000 == 0:
+                self.stdout.write("Migrated %s of %s series\n" % (count, len(ids)))
+        self.stdout.write("Migrated %s series from %s to %s\n" % (len(ids), options['source'], options['target']))
@@ -0,0 +1,41 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils.timezone import utc
+from chroma_core.models.stats import PostgresStats
+
+
+class Command(BaseCommand):
+    help = """Move stats samples from the Sample_* tables into time partitions, and drop expired partitions.
+The stats service should be stopped while partitioning, and STATS_PARTITIONED set afterwards."""
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+        now = datetime.now(utc)
+        for model in PostgresStats:
+            table = model._meta.db_table
+            cursor.execute("SELECT min(dt), max(dt) FROM ONLY {0}".format(table))
+            start, stop = cursor.fetchone()
+            if start is not None:
+                numbers = range(model.partition(max(start, now - model.expiration_time)), model.partition(stop) + 1)
+                model.create_partitions(numbers)
+                transaction.commit()
+                for number in numbers:
+                    # each partition is moved in its own transaction, so partitioning can be resumed
+                    params = model.bounds(number)
+                    cursor.execute("INSERT INTO {0} SELECT * FROM ONLY {1} WHERE dt >= %s AND dt < %s".format(model.partitions()[number], table), params)
+                    cursor.execute("DELETE FROM ONLY {0} WHERE dt >= %s AND dt < %s".format(table), params)
+                    transaction.commit()
+                    self.stdout.write("Moved %s samples into %s\n" % (cursor.rowcount, model.partitions()[number]))
+                # whatever remains has expired
+                cursor.execute("TRUNCATE ONLY {0}".format(table))
+            model.drop_partitions(now - model.expiration_time)
+            transaction.commit()
+            self.stdout.write("Partitioned %s into %s tables\n" % (table, len(model.partitions())))
@@ -0,0 +1,95 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from chroma_core.services.job_scheduler.job_scheduler_client import JobSchedulerRpc
+
+
+class Command(BaseCommand):
+    help = """Show a continuously updated view of where the job_scheduler service spends its time: the
+wall time of its operations, cache counters, jobs and queue depths, and the RPCs it is
+serving.  Rates and times per interval are since the previous update."""
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', dest = 'interval', type = 'float', default = 2.0,
+                    help = "seconds between updates"),
+        make_option('--count', dest = 'count', type = 'int', default = 0,
+                    help = "number of updates to show, or 0 to run until interrupted"),
+        make_option('--limit', dest = 'limit', type = 'int', default = 20,
+                    help = "number of operations to show"),
+    )
+
+    def handle(self, *args, **options):
+        previous = None
+        updates = 0
+        try:
+            while True:
+                profile = JobSchedulerRpc().get_profile()
+                profile['rpc'] = JobSchedulerRpc().get_rpc_stats()
+                self.show(profile, previous, options['limit'])
+                previous = profile
+                updates += 1
+                if updates == options['count']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+    def show(self, profile, previous, limit):
+        interval = profile['elapsed'] - previous['elapsed'] if previous else profile['elapsed']
+        timings = previous['timings'] if previous else {}
+        counters = previous['counters'] if previous else {}
+        lines = []
+        if previous and self.stdout.isatty():
+            # clear the screen and home the cursor
+            lines.append("\x1b[2J\x1b[H")
+
+        lines.append("job_scheduler: up %.0fs, jobs %s, queues %s" % (
+            profile['elapsed'],
+            ' '.join("%s=%s" % item for item in sorted(profile['jobs'].items())),
+            ' '.join("%s=%s" % item for item in sorted(profile['queues'].items()))))
+
+        hits, misses = profile['counters'].get('dep_cache.hits', 0), profile['counters'].get('dep_cache.misses', 0)
+        if hits + misses:
+            lines.append("dep_cache: %s hits, %s misses (%.1f%% hits)" % (hits, misses, 100.0 * hits / (hits + misses)))
+        for name, value in sorted(profile['counters'].items()):
+            if not name.startswith('dep_cache.'):
+                lines.append("%s: %s (%.1f/s)" % (name, value, (value - counters.get(name, 0)) / max(interval, 1e-6)))
+
+        lines.append("")
+        lines.append("%-40s %10s %8s %10s %10s %10s %9s" % ('operation', 'calls', 'calls/s', 'total', 'interval', 'mean', 'max'))
+        rows = []
+        for name, timing in profile['timings'].items():
+            before = timings.get(name, {'calls': 0, 'total': 0.0})
+            rows.append((timing['total'] - before['total'], name, timing, timing['calls'] - before['calls']))
+        # busiest operations in the last interval first
+        for busy, name, timing, calls in sorted(rows, reverse = True)[:limit]:
+            lines.append("%-40s %10d %8.1f %9.3fs %9.3fs %9.4fs %8.3fs" % (
+                name, timing['calls'], calls / max(interval, 1e-6), timing['total'], busy,
+                timing['total'] / timing['calls'] if timing['calls'] else 0.0, timing['max']))
+
+        rpc = profile['rpc']
+        rpc_methods = previous['rpc']['methods'] if previous else {}
+        lines.append("")
+        lines.append("rpc: %s workers, %s ready, waiting %s, running %s" % (
+            rpc['workers'], rpc['ready'],
+            ' '.join("%s=%s" % item for item in sorted(rpc['waiting'].items())) or '-',
+            ' '.join("%s=%s" % item for item in sorted(rpc['running'].items())) or '-'))
+        lines.append("%-40s %10s %8s %7s %7s %10s %9s %10s %9s" % ('method', 'calls', 'calls/s', 'queued', 'running',
+                                                                  'mean wait', 'max wait', 'mean serv', 'max serv'))
+        rows = []
+        for name, stats in rpc['methods'].items():
+            before = rpc_methods.get(name, {'calls': 0, 'service_time': 0.0})
+            rows.append((stats['service_time'] - before['service_time'], name, stats, stats['calls'] - before['calls']))
+        for busy, name, stats, calls in sorted(rows, reverse = True)[:limit]:
+            lines.append("%-40s %10d %8.1f %7d %7d %9.4fs %8.3fs %9.4fs %8.3fs" % (
+                name, stats['calls'], calls / max(interval, 1e-6), stats['queued'], stats['running'],
+                stats['wait_time'] / stats['calls'] if stats['calls'] else 0.0, stats['max_wait_time'],
+                stats['service_time'] / stats['calls'] if stats['calls'] else 0.0, stats['max_service_time']))
+
+        self.stdout.write("\n".join(lines) + "\n")
+        self.stdout.flush()
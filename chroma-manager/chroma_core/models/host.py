@@ -556,6 +556,8 @@ class TriggerPluginUpdatesStep(Step):
 
 
 class DeployStep(Step):
+    long_running = True
+
     # TODO: This timeout is the time to wait for the agent to successfully connect back to the manager. It is stupidly long
     # because we have seen the agent take stupidly long times to connect back to the manager. I've raised HYD-4769
     # to address the need for this long time out.
@@ -605,6 +607,8 @@ class DeployStep(Step):
 
 
 class AwaitRebootStep(Step):
+    long_running = True
+
     def run(self, kwargs):
         from chroma_core.services.job_scheduler.agent_rpc import AgentRpc
 
@@ -657,6 +661,8 @@ class DeployHostJob(StateChangeJob):
 
 
 class RebootIfNeededStep(Step):
+    long_running = True
+
     def _reboot_needed(self, host):
         # Check if we are running the required (lustre) kernel
         kernel_status = self.invoke_agent(host, 'kernel_status')
@@ -948,6 +954,7 @@ class DetectTargetsJob(HostListMixin):
 
 class SetHostProfileStep(Step):
     database = True
+    long_running = True
 
     def is_dempotent(self):
         return True
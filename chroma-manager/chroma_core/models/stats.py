@@ -6,10 +6,10 @@
 import itertools
 import collections
 import calendar
-import operator
 import functools
 from datetime import datetime, timedelta
-from django.db import models
+import numpy
+from django.db import IntegrityError, connection, models, transaction
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.utils.timezone import utc
@@ -72,14 +72,152 @@ epoch = datetime.fromtimestamp(0, utc)
 Point.zero = Point(epoch, 0.0, 0)
 
 
-class Cache(collections.defaultdict):
-    "Simple cache of limited size;  doesn't need to be LRU yet."
+# Vectorized equivalent of Points across many series, kept sorted by id and timestamp.
+POINTS = numpy.dtype([('id', numpy.int64), ('ts', numpy.float64), ('sum', numpy.float64), ('len', numpy.float64)])
+
+
+def to_timestamp(dt):
+    "Return utc timestamp from datetime, preserving microseconds."
+    return timestamp(dt) + dt.microsecond * 1e-6
+
+
+def to_datetime(ts):
+    "Return utc datetime from timestamp."
+    return datetime.fromtimestamp(ts, utc)
+
+
+def point_array(id, points):
+    "Return array of points for a series."
+    array = numpy.empty(len(points), POINTS)
+    array['id'] = id
+    for index, point in enumerate(points):
+        array[index] = id, to_timestamp(point.dt), point.sum, point.len
+    return array
+
+
+def concatenate(arrays):
+    "Return a single array of points from arrays of disjoint series."
+    return numpy.concatenate(arrays) if arrays else numpy.empty(0, POINTS)
+
+
+def rollup(points, step=0):
+    "Return points of each series grouped and summed by sample size, or by exact timestamp."
+    ts = points['ts'] - points['ts'] % step if step else points['ts']
+    order = numpy.lexsort((ts, points['id']))
+    ids, ts = points['id'][order], ts[order]
+    heads = numpy.flatnonzero(numpy.r_[True, (ids[1:] != ids[:-1]) | (ts[1:] != ts[:-1])]) if len(ids) else ids
+    result = numpy.empty(len(heads), POINTS)
+    result['id'], result['ts'] = ids[heads], ts[heads]
+    for field in ('sum', 'len'):
+        result[field] = numpy.add.reduceat(points[field][order], heads) if len(heads) else []
+    return result
+
+
+def means(points):
+    "Return mean values of points, with empty points as 0."
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(points['len'] != 0, points['sum'] / points['len'], 0.0)
+
+
+def rates(points):
+    "Return rate of change between consecutive points of each series, as (mean delta, seconds)."
+    same = points['id'][1:] == points['id'][:-1]
+    values = means(points)
+    result = points[1:][same]
+    result['sum'] = (values[1:] - values[:-1])[same]
+    result['len'] = (points['ts'][1:] - points['ts'][:-1])[same]
+    return result
+
+
+def pad(points, ids, start, stop, fixed):
+    "Return fixed intervals of each series with the sum of points within them."
+    step = (stop - start) / fixed
+    ids = numpy.unique(numpy.asarray(ids, numpy.int64))
+    intervals = numpy.array([to_timestamp(start + step * index) for index in range(fixed)])
+    columns = numpy.floor((points['ts'] - intervals[0]) / total_seconds(step)).astype(numpy.int64)
+    index = numpy.searchsorted(ids, points['id']) * fixed + columns.clip(0, fixed - 1)
+    result = numpy.empty(len(ids) * fixed, POINTS)
+    result['id'] = ids.repeat(fixed)
+    result['ts'] = numpy.tile(intervals, len(ids))
+    for field in ('sum', 'len'):
+        result[field] = numpy.bincount(index, points[field], len(result))
+    return result
+
+
+def split(points):
+    "Return mapping of series ids to lists of Points."
+    result = collections.defaultdict(list)
+    for id, ts, sum, len in points.tolist():
+        result[id].append(Point(to_datetime(ts), sum, int(len)))
+    return dict(result)
+
+
+class Cache(object):
+    """Cache of limited size which evicts least recently used entries, and optionally creates missing ones.
+    Only looking an entry up with `cache[key]` makes it recently used;  iterating, `in` and `get` don't."""
     SIZE = 1e5
 
+    def __init__(self, default_factory):
+        self.default_factory = default_factory
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def __getitem__(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            if self.default_factory is None:
+                raise
+            value = self.default_factory()
+        else:
+            self.hits += 1
+        self[key] = value
+        return value
+
     def __setitem__(self, key, value):
-        collections.defaultdict.__setitem__(self, key, value)
-        if len(self) > self.SIZE:
-            self.clear()
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.SIZE:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        del self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.entries.items())
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def pop(self, key, *default):
+        return self.entries.pop(key, *default)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def values(self):
+        return self.entries.values()
+
+    def items(self):
+        return self.entries.items()
+
+    def clear(self):
+        self.entries.clear()
+
+    def counters(self):
+        "Return hit, miss and eviction counts, and the current size."
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self)}
 
 
 class Series(models.Model):
@@ -99,21 +237,60 @@ class Series(models.Model):
         unique_together = ('content_type', 'object_id', 'name'),
 
     cache = Cache(None)
+    loaded = Cache(None)  # measured objects whose series have all been cached at some point
 
     @classmethod
     def get(cls, obj, name, type=''):
         "Return cached series for measured object and field, optionally creating it with given type."
-        try:
-            return cls.cache[obj, name]
-        except KeyError:
-            ct = ContentType.objects.get_for_model(obj)
-        if type:
-            assert type in cls.DATA_TYPES + cls.JOB_TYPES
-            series, created = cls.objects.get_or_create(content_type=ct, object_id=obj.id, name=name, type=type)
-        else:
-            series = cls.objects.get(content_type=ct, object_id=obj.id, name=name)
-        cls.cache[obj, name] = series
-        return series
+        series = cls.get_many(obj, {name: type})
+        if name not in series:
+            raise cls.DoesNotExist("Series {0} of {1} does not exist".format(name, obj))
+        return series[name]
+
+    @classmethod
+    def get_many(cls, obj, types):
+        """Return mapping of field names to cached series for measured object.
+        Uncached series are loaded in one query, with all other series of an object the first time it's seen.
+        Those which don't exist are created in bulk, for fields with a given type."""
+        ct = ContentType.objects.get_for_model(obj)
+        result, missing = {}, []
+        for name in types:
+            try:
+                result[name] = cls.cache[ct.id, obj.id, name]
+            except KeyError:
+                missing.append(name)
+        if not missing:
+            return result
+        query = cls.objects.filter(content_type=ct, object_id=obj.id)
+        if (ct.id, obj.id) in cls.loaded:
+            query = query.filter(name__in=missing)
+        cls.loaded[ct.id, obj.id] = True
+        for series in query:
+            if series.name in types:
+                result[series.name] = series
+            else:
+                cls.cache[ct.id, obj.id, series.name] = series
+        for name in result:
+            cls.cache[ct.id, obj.id, name] = result[name]
+
+        created = [name for name in missing if name not in result and types[name]]
+        if created:
+            assert set(types[name] for name in created) <= set(cls.DATA_TYPES + cls.JOB_TYPES)
+            sid = transaction.savepoint()
+            try:
+                cls.objects.bulk_create([cls(content_type=ct, object_id=obj.id, name=name, type=types[name]) for name in created])
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # some were created concurrently; fall back to creating the rest individually
+                transaction.savepoint_rollback(sid)
+            for series in cls.objects.filter(content_type=ct, object_id=obj.id, name__in=created):
+                result[series.name] = series
+            for name in created:
+                if name not in result:
+                    result[name], _ = cls.objects.get_or_create(content_type=ct, object_id=obj.id, name=name, type=types[name])
+            for name in created:
+                cls.cache[ct.id, obj.id, name] = result[name]
+        return result
 
     @classmethod
     def filter(cls, obj, **kwargs):
@@ -149,6 +326,22 @@ class Sample(models.Model):
         except OverflowError:
             return epoch
 
+    @classmethod
+    def starts(cls, ids):
+        "Return mapping of series ids to earliest datetimes that should be stored, querying uncached series together."
+        latest = dict((id, cls.cache[id][-1].dt) for id in ids if cls.cache[id])
+        missing = [id for id in ids if id not in latest]
+        if missing:
+            query = cls.objects.filter(id__in=missing).values('id').annotate(latest=models.Max('dt'))
+            latest.update(query.values_list('id', 'latest'))
+        result = {}
+        for id in ids:
+            try:
+                result[id] = latest.get(id, epoch) - cls.expiration_time
+            except OverflowError:
+                result[id] = epoch
+        return result
+
     @classmethod
     def floor(cls, dt):
         "Return datetime rounded down to nearest sample size."
@@ -166,14 +359,101 @@ class Sample(models.Model):
         query = cls.objects.filter(id=id, **filters).order_by(order_by)[:limit]
         return itertools.starmap(Point, query.values_list(*Point._fields))
 
+    @classmethod
+    def columns(cls, ids, start, stop):
+        "Return array of points for multiple series within interval, with one row per series."
+        cursor = connection.cursor()
+        cursor.execute("SELECT id, array_agg(extract(epoch FROM dt) ORDER BY dt), array_agg(sum ORDER BY dt), "
+                       "array_agg(len ORDER BY dt) FROM {0} WHERE id = ANY(%s) AND dt >= %s AND dt < %s "
+                       "GROUP BY id ORDER BY id".format(cls._meta.db_table), [list(ids), start, stop])
+        rows = cursor.fetchall()
+        points = numpy.empty(sum(len(row[1]) for row in rows), POINTS)
+        offset = 0
+        for id, ts, sums, lens in rows:
+            section = points[offset:offset + len(ts)]
+            section['id'], section['ts'], section['sum'], section['len'] = id, ts, sums, lens
+            offset += len(ts)
+        return points
+
     @classmethod
     def insert(cls, stats):
         "Bulk insert mapping of series ids to points."
-        if stats:
+        if stats and settings.STATS_PARTITIONED:
+            cls.insert_partitions(stats)
+        elif stats:
             cls.objects.bulk_create(cls(id, *point) for id in stats for point in stats[id])
         for id in stats:
             cls.cache[id] += sorted(stats[id])
 
+    @classmethod
+    def partition(cls, dt):
+        "Return number of the time partition which datetime falls in."
+        return int(timestamp(dt) // total_seconds(cls.partition_interval))
+
+    @classmethod
+    def bounds(cls, number):
+        "Return half-open interval of datetimes of a time partition."
+        width = total_seconds(cls.partition_interval)
+        return to_datetime(number * width), to_datetime((number + 1) * width)
+
+    @classmethod
+    def partitions(cls):
+        "Return mapping of partition numbers to the names of their tables, which inherit from the model's table."
+        if cls.partition_tables is None:
+            cursor = connection.cursor()
+            cursor.execute("SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = inhrelid "
+                           "WHERE inhparent = %s::regclass", [cls._meta.db_table])
+            cls.partition_tables = dict((int(name.rsplit('_p', 1)[-1]), name) for name, in cursor.fetchall())
+        return cls.partition_tables
+
+    @classmethod
+    def create_partitions(cls, numbers):
+        """Create tables of time partitions, which are constrained to their interval so that
+        queries on the model's table only scan the partitions that overlap the queried range.
+        Indexes aren't inherited, so each partition gets its own on dt, as the model's table has."""
+        cursor = connection.cursor()
+        # serialize concurrent creation by stats workers
+        cursor.execute("SELECT pg_advisory_xact_lock(%s::regclass::oid::int)", [cls._meta.db_table])
+        for number in numbers:
+            table = '{0}_p{1:d}'.format(cls._meta.db_table, number)
+            cursor.execute("CREATE TABLE IF NOT EXISTS {0} (UNIQUE (id, dt), CHECK (dt >= %s AND dt < %s)) "
+                           "INHERITS ({1})".format(table, cls._meta.db_table), cls.bounds(number))
+            cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [table + '_dt'])
+            if cursor.fetchone() is None:
+                cursor.execute("CREATE INDEX {0}_dt ON {0} (dt)".format(table))
+            cls.partitions()[number] = table
+        transaction.commit_unless_managed()
+
+    @classmethod
+    def drop_partitions(cls, before):
+        "Drop time partitions which only contain points before given datetime."
+        cursor = connection.cursor()
+        for number, table in cls.partitions().items():
+            if cls.bounds(number)[1] <= before:
+                cursor.execute("DROP TABLE IF EXISTS {0}".format(table))
+        transaction.commit_unless_managed()
+        cls.partition_tables = None  # other processes may have created partitions too
+
+    @classmethod
+    def insert_partitions(cls, stats):
+        "Bulk insert mapping of series ids to points directly into their partitions, creating them as necessary."
+        rows = collections.defaultdict(list)
+        for id in stats:
+            for point in stats[id]:
+                rows[cls.partition(point.dt)].append((id,) + point)
+        # points which have already expired may belong to partitions which were dropped
+        expired = cls.partition(datetime.now(utc) - cls.expiration_time)
+        for number in [number for number in rows if number < expired]:
+            del rows[number]
+        missing = set(rows) - set(cls.partitions())
+        if missing:
+            cls.create_partitions(missing)
+        cursor = connection.cursor()
+        for number, values in rows.items():
+            cursor.execute("INSERT INTO {0} (id, dt, sum, len) VALUES {1}".format(
+                cls.partitions()[number], ', '.join(['(%s, %s, %s, %s)'] * len(values))), list(itertools.chain(*values)))
+        transaction.commit_unless_managed()
+
     @classmethod
     def delete(cls, **filters):
         "Delete points in bulk."
@@ -183,10 +463,21 @@ class Sample(models.Model):
 
     @classmethod
     def expire(cls, ids):
-        if settings.STATS_SIMPLE_WIPE:
+        if settings.STATS_PARTITIONED:
+            "Drop whole partitions, and create the next one ahead of time."
+            # this is the same for every stats worker, so is only done by those with expire_all set
+            now = datetime.now(utc)
+            if cls.expire_all and now > cls.next_flush_orphans_time:
+                cls.drop_partitions(now - cls.expiration_time)
+                upcoming = cls.partition(now + cls.partition_interval)
+                if upcoming not in cls.partitions():
+                    cls.create_partitions([upcoming])
+                cls.next_flush_orphans_time = now + cls.flush_orphans_interval
+        elif settings.STATS_SIMPLE_WIPE:
             "We also have a general flush added in for 2.2 which just clears everything old every so often!"
+            # this is the same for every stats worker, so is only done by those with expire_all set
             now = datetime.now(utc)
-            if now > cls.next_flush_orphans_time:
+            if cls.expire_all and now > cls.next_flush_orphans_time:
                 cls.delete(dt__lt=now - cls.expiration_time)
                 cls.next_flush_orphans_time = now + cls.flush_orphans_interval
         else:
@@ -195,7 +486,7 @@ class Sample(models.Model):
                 cls.delete(id__in=ids, dt__lt=min(map(cls.start, ids)))
 
 
-class Stats(list):
+class SampleStats(list):
     "Primary interface to all sample models."
     def __init__(self, samples):
         maxlen = max(map(div_samplerate, samples[1:], samples[:-1]))
@@ -206,6 +497,9 @@ class Stats(list):
                          'expiration_time': sample.expiration_time,
                          'next_flush_orphans_time': epoch,
                          'flush_orphans_interval': sample.expiration_time / settings.STATS_FLUSH_RATE,
+                         'partition_interval': sample.expiration_time / settings.STATS_PARTITIONS,
+                         'partition_tables': None,
+                         'expire_all': True,
                          'cache': cache}
             self.append(type('Sample_{0:d}'.format(sample.sample_rate), (Sample,), namespace))
 
@@ -222,6 +516,7 @@ class Stats(list):
         self[0].insert(stats)
         for previous, model in zip(self, self[1:]):
             step = timedelta(seconds=model.step)
+            arrays = []
             for id in list(stats):
                 start = model.latest(id).dt + step
                 stop = model.floor(max(stats.pop(id)).dt)
@@ -229,12 +524,12 @@ class Stats(list):
                 # aggregate from previous Sample as necessary
                 if start < stop:
                     if cache and start >= cache[0].dt and stop <= cache[-1].dt:  # use cache if full
-                        points = (point for point in cache if start <= point.dt < stop and point.len)
+                        points = [point for point in cache if start <= point.dt < stop and point.len]
                     else:
-                        points = previous.select(id, dt__gte=start, dt__lt=stop)
-                    points = list(model.reduce(points))
-                    if points:
-                        stats[id] = points
+                        points = list(previous.select(id, dt__gte=start, dt__lt=stop))
+                    arrays.append(point_array(id, points))
+            # roll up all series at once
+            stats = split(rollup(concatenate(arrays), model.step))
             previous.expire(stats)
             model.insert(stats)
         model.expire(stats)
@@ -246,20 +541,30 @@ class Stats(list):
         Optionally limit number of points by increasing sample resolution.
         Optionally return fixed intervals with padding and arbitrary resolution.
         """
+        points = self.select_many([id], start, stop, rate, maxlen, fixed)
+        return [Point(to_datetime(ts), sum, len) for _, ts, sum, len in points.tolist()]
+
+    def select_many(self, ids, start, stop, rate=False, maxlen=float('inf'), fixed=0):
+        "Return array of points for multiple series, with the same options as `select`."
         minstep = total_seconds(stop - start) / maxlen
-        for index, model in enumerate(self):
-            if start >= model.start(id) and model.step >= minstep:
-                break
-        points = model.select(id, dt__gte=start, dt__lt=stop)
-        points = list(points if index else model.reduce(points))
+        groups, remaining = {}, list(ids)
+        for index, model in enumerate(self[:-1]):
+            if remaining and model.step >= minstep:
+                starts = model.starts(remaining)
+                groups[index] = [id for id in remaining if start >= starts[id]]
+                remaining = [id for id in remaining if start < starts[id]]
+        groups[len(self) - 1] = remaining
+        arrays = []
+        for index, group in groups.items():
+            if group:
+                points = self[index].columns(group, start, stop)
+                arrays.append(points if index else rollup(points, self[index].step))
+        points = concatenate(arrays)
+        points = points[numpy.lexsort((points['ts'], points['id']))]
         if rate:
-            points = map(operator.sub, points[1:], points[:-1])
+            points = rates(points)
         if fixed:
-            step = (stop - start) / fixed
-            intervals = [Point(start + step * index, 0.0, 0) for index in range(fixed)]
-            for point in points:
-                intervals[int(total_seconds(point.dt - start) / total_seconds(step))] += point
-            points = intervals
+            points = pad(points, ids, start, stop, fixed)
         return points
 
     def latest(self, id):
@@ -277,5 +582,25 @@ class Stats(list):
         for model in self:
             model.delete(id__gte=0)
 
+    def active(self, ids, start):
+        "Return subset of series ids which have samples since start."
+        return self[0].objects.filter(id__in=ids, dt__gte=start).values('id').distinct('id')
+
+    def watermark(self):
+        "Return datetime of the most recent sample of any series."
+        return self[0].objects.aggregate(models.Max('dt'))['dt__max'] or epoch
+
+
+PostgresStats = SampleStats(SAMPLES)
+
+
+def engine(name):
+    "Return the storage engine implementing the Stats interface by name:  'postgres' or 'mmap'."
+    if name == 'postgres':
+        return PostgresStats
+    if name == 'mmap':
+        from chroma_core.lib.stats_mmap import MmapStats
+        return MmapStats(SAMPLES, settings.STATS_MMAP_PATH)
+    raise ValueError("Unknown stats engine '{0}'".format(name))
 
-Stats = Stats(SAMPLES)
+Stats = engine(settings.STATS_ENGINE)
@@ -1257,6 +1257,7 @@ class UpdateManagedTargetMount(Step):
     MkfsStep and device mounting/unmounting.
     """
     database = True
+    long_running = True
 
     @classmethod
     def describe(cls, kwargs):
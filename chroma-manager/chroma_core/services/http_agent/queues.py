@@ -5,8 +5,9 @@
 
 import Queue
 import threading
-from chroma_core.services import _amqp_connection, log_register
-from chroma_core.services.queue import ServiceQueue
+from collections import defaultdict
+from chroma_core.services import log_register
+from chroma_core.services.queue import AgentRxQueue, ServiceQueue
 
 
 class AgentTxQueue(ServiceQueue):
@@ -62,18 +63,22 @@ class AmqpRxForwarder(object):
         self._queue_collection = queue_collection
 
     def run(self):
-        with _amqp_connection() as conn:
-            while not self._stopping.is_set():
-                try:
-                    msg = self._queue_collection.plugin_rx_queue.get(block = True, timeout = 1)
-                except Queue.Empty:
-                    pass
-                else:
-                    plugin_name = msg['plugin']
-                    rx_queue_name = "agent_%s_rx" % plugin_name
-                    q = conn.SimpleQueue(rx_queue_name, serializer = 'json',
-                                         exchange_opts={'durable': False}, queue_opts={'durable': False})
-                    q.put(msg)
+        while not self._stopping.is_set():
+            try:
+                msg = self._queue_collection.plugin_rx_queue.get(block = True, timeout = 1)
+            except Queue.Empty:
+                pass
+            else:
+                # Forward whatever else is already waiting along with it, in one batch per plugin
+                plugin_msgs = defaultdict(list)
+                while msg is not None:
+                    plugin_msgs[msg['plugin']].append(msg)
+                    try:
+                        msg = self._queue_collection.plugin_rx_queue.get_nowait()
+                    except Queue.Empty:
+                        msg = None
+                for plugin_name, msgs in plugin_msgs.items():
+                    AgentRxQueue(plugin_name).put_many(msgs)
 
     def stop(self):
         self._stopping.set()
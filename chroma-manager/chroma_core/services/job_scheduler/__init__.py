@@ -5,6 +5,7 @@
 
 import threading
 import traceback
+from collections import OrderedDict
 
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
@@ -37,38 +38,66 @@ class QueueHandler(object):
 
     def run(self):
         # Disregard any old messages
-        self._queue.serve(self.on_message)
+        self._queue.serve(batch_callback = self.on_messages)
 
     def on_message(self, message):
+        self.on_messages([message])
+
+    def on_messages(self, messages):
+        """Coalesce a batch of notifications and pass them to the JobScheduler together.
+
+        Successive notifications of the same object (with the same from_states, and which
+        either both or neither set the state) are merged into one with the latest value of
+        each attribute, at the position of the last of them.
+
+        """
+        notifications = OrderedDict()
+        for message in messages:
+            try:
+                notification = self._deserialize(message)
+            except:
+                # Log bad messages and continue, swallow the exception to avoid
+                # bringing down the whole service
+                log.warning("on_message: bad message: %s" % traceback.format_exc())
+                continue
+
+            content_type, object_id, time_serialized, update_attrs, from_states = notification
+            key = (tuple(content_type), object_id, tuple(from_states), 'state' in update_attrs)
+            if key in notifications:
+                update_attrs = dict(notifications.pop(key)[3], **update_attrs)
+            notifications[key] = (content_type, object_id, time_serialized, update_attrs, from_states)
+
+        if len(notifications) < len(messages):
+            log.debug("on_messages: coalesced %d notifications into %d" % (len(messages), len(notifications)))
+
         try:
-            # Deserialize any datetimes which were serialized for JSON
-            deserialized_update_attrs = {}
-            model_klass = ContentType.objects.get_by_natural_key(*message['instance_natural_key']).model_class()
-            for attr, value in message['update_attrs'].items():
-                try:
-                    field = [f for f in model_klass._meta.fields if f.name == attr][0]
-                except IndexError:
-                    # e.g. _id names, they aren't datetimes so ignore them
-                    deserialized_update_attrs[attr] = value
+            self._job_scheduler.notify_many(notifications.values())
+        except:
+            log.warning("on_messages: failed to apply notifications: %s" % traceback.format_exc())
+
+    def _deserialize(self, message):
+        # Deserialize any datetimes which were serialized for JSON
+        deserialized_update_attrs = {}
+        model_klass = ContentType.objects.get_by_natural_key(*message['instance_natural_key']).model_class()
+        for attr, value in message['update_attrs'].items():
+            try:
+                field = [f for f in model_klass._meta.fields if f.name == attr][0]
+            except IndexError:
+                # e.g. _id names, they aren't datetimes so ignore them
+                deserialized_update_attrs[attr] = value
+            else:
+                if isinstance(field, DateTimeField):
+                    deserialized_update_attrs[attr] = IMLDateTime.parse(value)
                 else:
-                    if isinstance(field, DateTimeField):
-                        deserialized_update_attrs[attr] = IMLDateTime.parse(value)
-                    else:
-                        deserialized_update_attrs[attr] = value
+                    deserialized_update_attrs[attr] = value
 
-            log.debug("on_message: %s %s" % (message, deserialized_update_attrs))
+        log.debug("on_message: %s %s" % (message, deserialized_update_attrs))
 
-            self._job_scheduler.notify(
-                message['instance_natural_key'],
+        return (message['instance_natural_key'],
                 message['instance_id'],
                 message['time'],
                 deserialized_update_attrs,
-                message['from_states']
-            )
-        except:
-            # Log bad messages and continue, swallow the exception to avoid
-            # bringing down the whole service
-            log.warning("on_message: bad message: %s" % traceback.format_exc())
+                message['from_states'])
 
 
 class Service(ChromaService):
@@ -0,0 +1,83 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import time
+import threading
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+import settings
+from chroma_core.models import StatefulObject
+from chroma_core.services.job_scheduler import lock_cache
+from chroma_core.services.job_scheduler.profiler import profiler
+
+
+class ActionCache(object):
+    """The transitions and jobs advertised for objects, which the UI asks for on every refresh
+    of every object it shows.
+
+    An entry is valid while the object is in the state it was computed for, until the generation
+    advances: which happens whenever a lock is taken or released, a notification updates an
+    object's attributes, or an object is created or deleted by this process, because what is
+    available can depend on more than state (a target can only fail back while it is mounted on a
+    failover host) and on other objects (an MGS can't be removed once it has a filesystem).
+    Changes made by other processes aren't seen here, so entries also expire after
+    `settings.AVAILABLE_ACTIONS_MAX_AGE` seconds.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.generation = 0
+            self._entries = {}
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries = {}
+
+    def get(self, kind, obj_key, obj_id, state, compute):
+        """Return the cached value for an object in a state, or else compute and cache it"""
+        key = (kind, tuple(obj_key), obj_id)
+        now = time.time()
+        with self._lock:
+            generation = self.generation
+            entry = self._entries.get(key)
+        if entry and entry[0] == state and now - entry[1] < settings.AVAILABLE_ACTIONS_MAX_AGE:
+            profiler.count("action_cache.hits")
+            return entry[2]
+
+        profiler.count("action_cache.misses")
+        value = compute()
+        with self._lock:
+            # Don't keep a value which was being computed while the cache was invalidated
+            if generation == self.generation:
+                self._entries[key] = (state, now, value)
+        return value
+
+
+action_cache = ActionCache()
+
+
+@lock_cache.lock_change_receiver()
+def lock_change_receiver(lock, add_remove):
+    action_cache.invalidate()
+
+
+@receiver(post_save)
+def stateful_object_saved(sender, instance, created, **kwargs):
+    if created and isinstance(instance, StatefulObject):
+        action_cache.invalidate()
+
+
+@receiver(post_delete)
+def stateful_object_deleted(sender, instance, **kwargs):
+    if isinstance(instance, StatefulObject):
+        action_cache.invalidate()
@@ -12,6 +12,7 @@ from django.db import transaction
 
 from chroma_core.services.log import log_register
 from chroma_core.services.job_scheduler.dep_cache import DepCache
+from chroma_core.services.job_scheduler.profiler import profiler
 from chroma_core.models.jobs import StateChangeJob, SchedulingError, StateLock
 from chroma_core.models.command import Command
 
@@ -56,6 +57,32 @@ class CommandPlan(object):
         self._dep_cache = DepCache()
         self._lock_cache = lock_cache
         self._job_collection = job_collection
+        # Objects which may depend on each object, which don't change while planning
+        self._dependent_objects = {}
+
+    def _start_expansion(self):
+        """Reset the transition graph, before expanding the transitions needed for a state change"""
+        self.deps = set()
+        self.edges = set()
+        # Transitions whose dependencies have been collected, with the transition stack
+        # they were collected for
+        self._collected = set()
+        # The job for each transition, created once so that its dependencies are only looked up once
+        self._transition_jobs = {}
+
+    def _transition_job(self, transition):
+        try:
+            return self._transition_jobs[transition]
+        except KeyError:
+            job = self._transition_jobs[transition] = transition.to_job()
+            return job
+
+    def _get_dependent_objects(self, stateful_object):
+        try:
+            return self._dependent_objects[stateful_object]
+        except KeyError:
+            dependents = self._dependent_objects[stateful_object] = stateful_object.get_dependent_objects()
+            return dependents
 
     def get_expected_state(self, stateful_object_instance):
         try:
@@ -107,6 +134,7 @@ class CommandPlan(object):
 
         return locks
 
+    @profiler.timed
     def add_jobs(self, jobs, command):
         """Add a job, and any others which are required in order to reach its prerequisite state"""
         # Important: the Job must not be committed until all
@@ -130,8 +158,7 @@ class CommandPlan(object):
             for l in locks:
                 self._lock_cache.add(l)
 
-            command.jobs.add(job)
-
+        command.jobs.add(*jobs)
         self._job_collection.add_command(command, jobs)
 
     def get_transition_consequences(self, instance, new_state):
@@ -150,8 +177,7 @@ class CommandPlan(object):
         assert(isinstance(instance, StatefulObject))
 
         self.expected_states = {}
-        self.deps = set()
-        self.edges = set()
+        self._start_expansion()
         self._emit_transition_deps(Transition(
             instance,
             self.get_expected_state(instance),
@@ -167,7 +193,7 @@ class CommandPlan(object):
         depended_jobs = []
         transition_job = None
         for d in self.deps:
-            job = d.to_job()
+            job = self._transition_job(d)
             if isinstance(job, StateChangeJob):
                 so = getattr(job, job.stateful_object)
                 stateful_object_id = so.pk
@@ -234,33 +260,30 @@ class CommandPlan(object):
         """Sort items in a graph by their longest path from a leaf.  Items
            at the start of the result are the leaves.  Roots come last."""
         object_edges = defaultdict(list)
-        for e in edges:
-            parent, child = e
+        for parent, child in edges:
             object_edges[parent].append(child)
 
-        leaf_distance_cache = {}
-
-        def leaf_distance(obj, depth = 0, hops = 0):
-            if obj in leaf_distance_cache:
-                return leaf_distance_cache[obj] + hops
-
-            depth = depth + 1
-            max_child_hops = hops
-            for child in object_edges[obj]:
-                child_hops = leaf_distance(child, depth, hops + 1)
-                max_child_hops = max(child_hops, max_child_hops)
-
-            leaf_distance_cache[obj] = max_child_hops - hops
-
-            return max_child_hops
-
-        object_leaf_distances = []
+        # Depth first without recursion: an item is revisited to work out its distance
+        # after all of its children, which were pushed after it.  The only children
+        # which can be unfinished then are those on a cycle, and they are ignored.
+        leaf_distances = {}
+        visited = set()
         for o in objects:
-            object_leaf_distances.append((o, leaf_distance(o)))
+            stack = [o]
+            while stack:
+                obj = stack.pop()
+                if obj in leaf_distances:
+                    continue
+                if obj not in visited:
+                    visited.add(obj)
+                    stack.append(obj)
+                    stack.extend(child for child in object_edges[obj] if child not in visited)
+                else:
+                    leaf_distances[obj] = max([leaf_distances[child] + 1 for child in object_edges[obj] if child in leaf_distances] or [0])
 
-        object_leaf_distances.sort(lambda x, y: cmp(x[1], y[1]))
-        return [obj for obj, ld in object_leaf_distances]
+        return sorted(objects, key = lambda obj: leaf_distances[obj])
 
+    @profiler.timed
     def _set_state(self, instance, new_state, command):
         """Return a Job or None if the object is already in new_state.
         command_id should refer to a command instance or be None."""
@@ -284,11 +307,10 @@ class CommandPlan(object):
         if new_state not in available_states:
             raise SchedulingError("State '%s' is invalid for %s, must be one of %s" % (new_state, instance.__class__, available_states))
 
-        # Work out the eventual states (and which writelock'ing job to depend on to
-        # ensure that state) from all non-'complete' jobs in the queue
-        # It is possible the some locks have no end state and so these should be excluded.
-        item_to_lock = self._lock_cache.get_write_by_locked_item()
-        self.expected_states = dict([(item, state_lock.end_state) for item, state_lock in item_to_lock.items() if state_lock.end_state])
+        # The eventual states from all non-'complete' jobs in the queue, as maintained by
+        # the lock cache from the latest write lock of each item which has an end state.
+        # Copied, so that the locks this plan takes don't change what it expects meanwhile.
+        self.expected_states = dict(self._lock_cache.expected_states)
 
         if new_state == self.get_expected_state(instance):
             log.info("set_state: already expected to be in state %s" % new_state)
@@ -302,8 +324,7 @@ class CommandPlan(object):
             # Pick out whichever job made it so, and attach that to the Command
             return None
 
-        self.deps = set()
-        self.edges = set()
+        self._start_expansion()
         self._emit_transition_deps(Transition(
             instance,
             self.get_expected_state(instance),
@@ -318,7 +339,7 @@ class CommandPlan(object):
         jobs = []
         for d in self.deps:
             # Create and save the Job instance
-            job = d.to_job()
+            job = self._transition_job(d)
             locks = self._create_locks(job)
             job.locks_json = json.dumps([l.to_dict() for l in locks])
             self._create_dependencies(job, locks)
@@ -327,8 +348,8 @@ class CommandPlan(object):
             for l in locks:
                 self._lock_cache.add(l)
             log.debug("  dep %s -> Job %s" % (d, job.pk))
-            command.jobs.add(job)
 
+        command.jobs.add(*jobs)
         command.save()
         self._job_collection.add_command(command, jobs)
 
@@ -369,14 +390,14 @@ class CommandPlan(object):
         return prev
 
     def _collect_dependencies(self, root_transition, transition_stack):
-        if not hasattr(self, 'cdc'):
-            self.cdc = defaultdict(list)
-        if root_transition in self.cdc:
+        key = (root_transition, frozenset(transition_stack.items()))
+        if key in self._collected:
             return
+        self._collected.add(key)
 
         log.debug("collect_dependencies: %s" % root_transition)
         # What is explicitly required for this state transition?
-        transition_deps = self._dep_cache.get(root_transition.to_job())
+        transition_deps = self._dep_cache.get(self._transition_job(root_transition))
         for dependency in transition_deps.all():
             from chroma_core.lib.job import DependOn
             assert(isinstance(dependency, DependOn))
@@ -417,7 +438,7 @@ class CommandPlan(object):
 
         # What was depending on our old state?
         # Iterate over all objects which *might* depend on this one
-        for dependent in root_transition.stateful_object.get_dependent_objects():
+        for dependent in self._get_dependent_objects(root_transition.stateful_object):
             if dependent in transition_stack:
                 continue
 
@@ -443,6 +464,7 @@ class CommandPlan(object):
                             dependent_state, fix_state), transition_stack)
                     self.edges.add((root_transition, dep_transition))
 
+    @profiler.timed
     def command_run_jobs(self, job_dicts, message):
         assert(len(job_dicts) > 0)
 
@@ -460,6 +482,7 @@ class CommandPlan(object):
 
         return command.id
 
+    @profiler.timed
     def command_set_state(self, object_ids, message, command=None):
         if not command:
             command = Command.objects.create(message=message)
@@ -3,6 +3,9 @@
 # license that can be found in the LICENSE file.
 
 
+from chroma_core.services.job_scheduler.profiler import profiler
+
+
 class DepCache(object):
     def __init__(self):
         self.hits = 0
@@ -32,9 +35,11 @@ class DepCache(object):
         try:
             v = self.cache[key]
             self.hits += 1
+            profiler.count('dep_cache.hits')
 
             return v
         except KeyError:
             self.cache[key] = self._get(obj, state)
             self.misses += 1
+            profiler.count('dep_cache.misses')
             return self.cache[key]
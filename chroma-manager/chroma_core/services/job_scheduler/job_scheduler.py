@@ -45,6 +45,9 @@ from chroma_core.models import TriggerPluginUpdatesJob
 from chroma_core.services.job_scheduler.dep_cache import DepCache
 from chroma_core.services.job_scheduler.lock_cache import LockCache
 from chroma_core.services.job_scheduler.command_plan import CommandPlan
+from chroma_core.services.job_scheduler.profiler import profiler
+from chroma_core.services.job_scheduler.step_executor import StepExecutor
+from chroma_core.services.job_scheduler.action_cache import action_cache
 from chroma_core.services.job_scheduler.agent_rpc import AgentException
 from chroma_core.services.plugin_runner.agent_daemon_interface import AgentDaemonRpcInterface
 from chroma_core.services.rpc import RpcError
@@ -54,6 +57,8 @@ from iml_common.lib.date_time import IMLDateTime
 
 from chroma_help.help import help_text
 
+import settings
+
 import chroma_core.lib.conf_param
 from chroma_core.lib.long_polling import long_polling
 
@@ -177,7 +182,10 @@ class JobProgress(threading.Thread, Queue.Queue):
         # Commit after each message to ensure the next message handler
         # doesn't see a stale transaction
         with transaction.commit_on_success():
-            fn(*msg[1], **msg[2])
+            with profiler.time("progress.%s" % msg[0]):
+                fn(*msg[1], **msg[2])
+            committing = time.time()
+        profiler.add("progress.commit", time.time() - committing)
 
     def stop(self):
         self._stopping.set()
@@ -239,6 +247,8 @@ class JobProgress(threading.Thread, Queue.Queue):
 
 
 class RunJobThread(threading.Thread):
+    """Run the steps of a job, either as a thread of its own, or a step at a time on a StepExecutor"""
+
     CANCEL_TIMEOUT = 30
 
     def __init__(self, job_progress, connection_quota, job, steps):
@@ -248,6 +258,7 @@ class RunJobThread(threading.Thread):
         self._connection_quota = connection_quota
         self._cancel = threading.Event()
         self._complete = threading.Event()
+        self._step_index = 0
         self.steps = steps
 
     def cancel(self):
@@ -263,13 +274,47 @@ class RunJobThread(threading.Thread):
             # HYD-1485: Get a mechanism to interject when the thread is blocked on an agent call
             log.error("Job %s: cancel timed out, will continue as zombie thread!" % self.job.id)
 
+    def join(self, timeout = None):
+        if self.ident is None:
+            # Running on a StepExecutor rather than as a thread
+            self._complete.wait(timeout)
+        else:
+            super(RunJobThread, self).join(timeout)
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def host(self):
+        """The server which the next step acts on, if known"""
+        try:
+            host = self.steps[self._step_index][1].get('host')
+        except IndexError:
+            return None
+        return None if host is None else str(getattr(host, 'fqdn', host))
+
+    @property
+    def long_running(self):
+        """Whether the next step may wait for a long time, see Step.long_running"""
+        try:
+            return self.steps[self._step_index][0].long_running
+        except IndexError:
+            return False
+
+    @property
+    def step_class(self):
+        try:
+            return self.steps[self._step_index][0].__name__
+        except IndexError:
+            return None
+
     def run(self):
         if django.db.connection.connection:
             log.error("RunJobThread started with a DB connection!")
 
         try:
             self._run()
-            self._complete.set()
         except Exception:
             log.critical("Unhandled exception in RunJobThread: %s" % traceback.format_exc())
             # Better to die clean than live on dirty (an unhandled exception
@@ -283,9 +328,19 @@ class RunJobThread(threading.Thread):
     def _run(self):
         log.info("Job %d: %s.run" % (self.job.id, self.__class__.__name__))
 
-        step_index = 0
-        finish_step = -1
-        while step_index < len(self.steps) and not self._cancel.is_set():
+        while self.run_step():
+            pass
+
+    def run_step(self):
+        """Run the next step, returning whether there are more to run"""
+        more = self._run_step()
+        if not more:
+            self._complete.set()
+        return more
+
+    def _run_step(self):
+        if self._step_index < len(self.steps) and not self._cancel.is_set():
+            step_index = self._step_index
             klass, args = self.steps[step_index]
 
             # Do not persist any sensitive arguments (prefixed with __)
@@ -324,28 +379,30 @@ class RunJobThread(threading.Thread):
                 # is the backtrace inside the AgentException
                 self._job_progress.step_failure(self.job.id, e.backtrace)
                 self._job_progress.complete_job(self.job.id, errored = True)
-                return
+                return False
             except Exception, e:
                 backtrace = traceback.format_exc()
                 log.error("Job %d step %d encountered an error: %s:%s" % (self.job.id, step_index, e, backtrace))
 
                 self._job_progress.step_failure(self.job.id, backtrace)
                 self._job_progress.complete_job(self.job.id, errored = True)
-                return
+                return False
             finally:
                 if step.database:
                     log.debug("Job %d releasing database connection" % self.job.id)
                     self._connection_quota.release(django.db.connection.connection)
 
-            finish_step = step_index
-            step_index += 1
+            self._step_index += 1
+            if self._step_index < len(self.steps):
+                return True
 
         if self._cancel.is_set():
-            return
+            return False
 
-        log.info("Job %d finished %d steps successfully" % (self.job.id, finish_step + 1))
+        log.info("Job %d finished %d steps successfully" % (self.job.id, self._step_index))
 
         self._job_progress.complete_job(self.job.id, errored = False)
+        return False
 
 
 class JobCollection(object):
@@ -364,9 +421,32 @@ class JobCollection(object):
         self._command_to_jobs = defaultdict(set)
         self._job_to_commands = defaultdict(set)
 
+        # Index of wait_for dependencies: the number of jobs each job is still waiting for, the jobs
+        # waiting for each job, and the pending jobs which aren't waiting for any
+        self._wait_counts = {}
+        self._waiters = defaultdict(set)
+        self._ready = set()
+
     def add(self, job):
+        if job.id not in self._jobs:
+            wait_for_ids = set(json.loads(job.wait_for_json)) - set(self._state_jobs['complete'])
+            self._wait_counts[job.id] = len(wait_for_ids)
+            for wait_for_id in wait_for_ids:
+                self._waiters[wait_for_id].add(job.id)
         self._jobs[job.id] = job
         self._state_jobs[job.state][job.id] = job
+        if job.state == 'pending' and not self._wait_counts[job.id]:
+            self._ready.add(job.id)
+
+    def _transition(self, job, new_state):
+        """Update the dependency index for a job which is leaving the pending state,
+        making any jobs which were only waiting for it ready once it completes"""
+        self._ready.discard(job.id)
+        if new_state == 'complete':
+            for waiter_id in self._waiters.pop(job.id, []):
+                self._wait_counts[waiter_id] -= 1
+                if not self._wait_counts[waiter_id] and waiter_id in self._state_jobs['pending']:
+                    self._ready.add(waiter_id)
 
     def add_command(self, command, jobs):
         """Add command if it doesn't already exist, and ensure that all
@@ -397,6 +477,7 @@ class JobCollection(object):
             log.warning("Cancelling uncached Job %s" % job.id)
         else:
             self._state_jobs[job.state][job.id] = job
+        self._transition(job, new_state)
 
     def update_commands(self, job):
         """
@@ -421,17 +502,13 @@ class JobCollection(object):
             del self._state_jobs[job.state][job.id]
             job.state = new_state
             self._state_jobs[job.state][job.id] = job
+            self._transition(job, new_state)
 
         Job.objects.filter(id__in = [j.id for j in jobs]).update(state = new_state)
 
     @property
     def ready_jobs(self):
-        result = []
-        for job in self._state_jobs['pending'].values():
-            wait_for_ids = json.loads(job.wait_for_json)
-            complete_job_ids = [j.id for j in self._state_jobs['complete'].values()]
-            if not set(wait_for_ids) - set(complete_job_ids):
-                result.append(job)
+        result = [self._state_jobs['pending'][job_id] for job_id in sorted(self._ready)]
 
         if len(result) == 0 and len(self.pending_jobs) == 0 and len(self.tasked_jobs) == 0:
             # A quiescent state, flush the collection (avoid building up an indefinitely
@@ -445,6 +522,16 @@ class JobCollection(object):
     def pending_jobs(self):
         return self._state_jobs['pending'].values()
 
+    def first_command_id(self, job_id):
+        """Return the ID of the earliest command which a job is part of"""
+        return min(self._job_to_commands.get(job_id) or [0])
+
+    def counts(self):
+        """Return the number of jobs in each state, and of pending jobs which are ready"""
+        counts = dict((state, len(jobs)) for state, jobs in self._state_jobs.items())
+        counts['ready'] = len(self._ready)
+        return counts
+
     @property
     def tasked_jobs(self):
         return self._state_jobs['tasked'].values()
@@ -463,18 +550,22 @@ class JobScheduler(object):
 
     def __init__(self):
         self._lock = threading.RLock()
-        """Globally serialize all scheduling operations: within a given cluster, they all potentially
-        interfere with one another.  In the future, if this class were handling multiple isolated
-        clusters then they could take a lock each and run in parallel
+        """Globally serialize all scheduling operations, notifications included: within a given cluster,
+        they all potentially interfere with one another.  A notification reads the lock cache to decide
+        whether to buffer, and saves its object and updates the ObjectCache, so it must not run while
+        a job is being planned, completed or locks are being taken.
 
         """
 
         self._lock_cache = LockCache()
         self._job_collection = JobCollection()
         self._notification_buffer = NotificationBuffer()
+        action_cache.clear()
+        self._failed_over = {}  # Whether each target was last notified as failed over
 
         self._db_quota = SimpleConnectionQuota(self.MAX_STEP_DB_CONNECTIONS)
         self._run_threads = {}  # Map of job ID to RunJobThread
+        self._step_executor = StepExecutor(settings.JOB_STEP_WORKERS, settings.JOB_STEP_HOST_CONCURRENCY)
 
         self.progress = JobProgress(self)
 
@@ -486,7 +577,9 @@ class JobScheduler(object):
         for job_id, thread in self._run_threads.items():
             log.info("Joining thread for job %s" % job_id)
             thread.join()
+        self._step_executor.stop()
 
+    @profiler.timed
     def _run_next(self):
         ready_jobs = self._job_collection.ready_jobs
 
@@ -509,6 +602,7 @@ class JobScheduler(object):
             # Cancellations may have made some jobs ready, run me again
             self._run_next()
 
+    @profiler.timed
     def _check_jobs(self, jobs, dep_cache):
         """Return the list of jobs which pass their checks"""
         ok_jobs = []
@@ -516,7 +610,8 @@ class JobScheduler(object):
 
         for job in jobs:
             try:
-                deps_satisfied = job._deps_satisfied(dep_cache)
+                with profiler.time("jobs._deps_satisfied"):
+                    deps_satisfied = job._deps_satisfied(dep_cache)
             except Exception:
                 # Catchall exception handler to ensure progression even if Job
                 # subclasses have bugs in their get_deps etc.
@@ -530,7 +625,8 @@ class JobScheduler(object):
                     # TODO: tell someone WHICH dependency
                 else:
                     try:
-                        job.steps = job.get_steps()
+                        with profiler.time("jobs.get_steps"):
+                            job.steps = job.get_steps()
                     except Exception:
                         log.error("Job %d: exception in get_steps: %s" % (job.id, traceback.format_exc()))
                         cancel_jobs.append(job)
@@ -549,13 +645,15 @@ class JobScheduler(object):
             assert job.id not in self._run_threads
             self._run_threads[job.id] = thread
 
-            thread.start()
-            log.debug('_spawn_job: %s threads in flight' % len(self._run_threads))
+            # Favour the steps of commands which were started first
+            self._step_executor.submit(thread, (self._job_collection.first_command_id(job.id), job.id))
+            log.debug('_spawn_job: %s jobs in flight' % len(self._run_threads))
         else:
             log.debug('_spawn_job: No steps for %s, completing' % job.pk)
             # No steps: skip straight to completion
             self.progress.complete_job(job.id, False)
 
+    @profiler.timed
     def _complete_job(self, job, errored, cancelled):
         try:
             del self._run_threads[job.id]
@@ -603,6 +701,7 @@ class JobScheduler(object):
     def del_completion_hook(self, deletion):
         self.completion_hooks.remove(deletion)
 
+    @profiler.timed
     def _completion_hooks(self, changed_item, command = None, updated_attrs = []):
         """
         :param command: If set, any created jobs are added
@@ -629,14 +728,11 @@ class JobScheduler(object):
             return bool(count)
 
         if isinstance(changed_item, ManagedTarget):
-            if issubclass(changed_item.downcast_class, FilesystemMember):
-                affected_filesystems = [changed_item.downcast().filesystem]
-            else:
-                affected_filesystems = changed_item.downcast().managedfilesystem_set.all()
-
-            for filesystem in affected_filesystems:
-                members = filesystem.get_targets()
-                states = set([t.state for t in members])
+            # The ObjectCache counts the states of each filesystem's targets as they change
+            ObjectCache.target_state_changed(changed_item)
+            for filesystem_id in ObjectCache.target_filesystem_ids(changed_item.id):
+                filesystem = ObjectCache.get_by_id(ManagedFilesystem, filesystem_id)
+                states = ObjectCache.filesystem_target_states(filesystem_id)
                 now = django.utils.timezone.now()
 
                 if not filesystem.state == 'available' and changed_item.state in ['mounted', 'removed'] and states == set(['mounted']):
@@ -676,10 +772,13 @@ class JobScheduler(object):
                             command = Command.objects.create(message = "Updating configuration parameters on %s" % mgs)
                         self.CommandPlan.add_jobs([job], command)
 
-            # Update TargetFailoverAlert from .active_mount
+            # Update TargetFailoverAlert from .active_mount, when that changes whether the target is failed over
             from chroma_core.models import TargetFailoverAlert
-            failed_over = changed_item.active_mount is not None and changed_item.active_mount != changed_item.managedtargetmount_set.get(primary = True)
-            TargetFailoverAlert.notify(changed_item, failed_over)
+            primary_mount = ObjectCache.target_primary_mount(changed_item.id)
+            failed_over = changed_item.active_mount_id is not None and changed_item.active_mount_id != primary_mount.id
+            if self._failed_over.get(changed_item.id) != failed_over:
+                TargetFailoverAlert.notify(changed_item, failed_over)
+                self._failed_over[changed_item.id] = failed_over
 
         if isinstance(changed_item, PacemakerConfiguration) and 'reconfigure_fencing' in updated_attrs:
             job = ConfigureHostFencingJob(host = changed_item.host)
@@ -687,6 +786,7 @@ class JobScheduler(object):
                 command = Command.objects.create(message = "Configuring fencing agent on %s" % changed_item)
             self.CommandPlan.add_jobs([job], command)
 
+    @profiler.timed
     def _drain_notification_buffer(self):
         # Give any buffered notifications a chance to drain out
         for buffer_key in self._notification_buffer.notification_keys:
@@ -708,8 +808,11 @@ class JobScheduler(object):
             log.info("Replaying %d buffered notifications for %s-%s" % (len(notifications), model_klass.__name__, instance.pk))
             for notification in notifications:
                 log.debug("Replaying buffered notification: %s" % (notification,))
-                self._notify(*notification)
+                instance = self._notify(*notification)
+                if instance is not None:
+                    self._completion_hooks(instance, updated_attrs = notification[3].keys())
 
+    @profiler.timed
     def set_state(self, object_ids, message, run):
         with self._lock:
             with transaction.commit_on_success():
@@ -718,12 +821,17 @@ class JobScheduler(object):
                 self.progress.advance()
         return command.id
 
+    @profiler.timed
     @transaction.commit_on_success
     def advance(self):
         with self._lock:
             self._run_next()
 
     def _notify(self, content_type, object_id, notification_time, update_attrs, from_states):
+        """Apply a notification to an object, returning the updated instance, or None if the notification
+        was dropped or buffered.
+
+        """
         # Get the StatefulObject
         model_klass = ContentType.objects.get_by_natural_key(*content_type).model_class()
         try:
@@ -760,12 +868,14 @@ class JobScheduler(object):
 
             return
 
+        updated = False
         for attr, value in update_attrs.items():
             old_value = getattr(instance, attr)
             if old_value == value:
                 log.debug("_notify: Dropping %s.%s = %s because it is already set" % (instance, attr, value))
                 continue
 
+            updated = True
             log.info("_notify: Updating .%s of item %s (%s) from %s to %s" % (attr, instance.id, instance, old_value, value))
             if attr == 'state':
                 # If setting the special 'state' attribute then maybe schedule some jobs
@@ -784,18 +894,63 @@ class JobScheduler(object):
         # locking this object.
         instance = ObjectCache.update(instance)
 
+        # What is available depends on more than state, e.g. failover on a target's active_mount
+        if updated:
+            action_cache.invalidate()
+
         # FIXME: should check the new state against reverse dependencies
         # and apply any fix_states
-        self._completion_hooks(instance, updated_attrs = update_attrs.keys())
+        return instance
 
-    @transaction.commit_on_success
     def notify(self, content_type, object_id, time_serialized, update_attrs, from_states):
+        self.notify_many([(content_type, object_id, time_serialized, update_attrs, from_states)])
+
+    @profiler.timed
+    def notify_many(self, notifications):
+        """Apply a batch of notifications, each a tuple of the arguments to `notify`.
+
+        The batch is applied under the lock in one transaction, after which jobs are scheduled once.
+        A notification which fails is rolled back and logged without affecting the rest.
+
+        """
         with self._lock:
-            notification_time = IMLDateTime.parse(time_serialized)
-            self._notify(content_type, object_id, notification_time, update_attrs, from_states)
+            with transaction.commit_on_success():
+                for content_type, object_id, time_serialized, update_attrs, from_states in notifications:
+                    notification = (content_type, object_id, IMLDateTime.parse(time_serialized), update_attrs, from_states)
+                    instance = self._apply_notification(notification)
+                    if instance is not None:
+                        self._completion_hooks(instance, updated_attrs = update_attrs.keys())
 
-            self._run_next()
+                self._run_next()
 
+    def _apply_notification(self, notification):
+        savepoint = transaction.savepoint()
+        try:
+            instance = self._notify(*notification)
+        except Exception:
+            transaction.savepoint_rollback(savepoint)
+            log.warning("notify: failed to apply %s: %s" % (notification, traceback.format_exc()))
+            return None
+        transaction.savepoint_commit(savepoint)
+        return instance
+
+    def get_profile(self):
+        """Return the wall time of scheduling operations and cache counters since the service started,
+        with the number of jobs in each state and the depths of queues.  Read without
+        taking the lock, so that it can be used to find out what the lock is waiting for.
+
+        """
+        profile = profiler.stats()
+        profile['jobs'] = self._job_collection.counts()
+        profile['queues'] = {
+            'progress': self.progress.qsize(),
+            'run_threads': len(self._run_threads),
+            'steps': self._step_executor.stats(),
+            'buffered_notifications': len(self._notification_buffer.notification_keys)
+        }
+        return profile
+
+    @profiler.timed
     @transaction.commit_on_success
     def run_jobs(self, job_dicts, message):
         with self._lock:
@@ -837,6 +992,7 @@ class JobScheduler(object):
         return CommandPlan(LockCache(), None).get_transition_consequences(stateful_object, new_state)
 
     @transaction.commit_on_success
+    @profiler.timed
     def cancel_job(self, job_id):
         cancelled_thread = None
 
@@ -856,6 +1012,8 @@ class JobScheduler(object):
                 try:
                     cancelled_thread = self._run_threads[job_id]
                     cancelled_thread.cancel()
+                    # in case it's waiting for its server's steps to finish
+                    self._step_executor.wake(cancelled_thread)
                 except KeyError:
                     pass
                 self._job_collection.update(job, 'complete', cancelled = True)
@@ -873,6 +1031,7 @@ class JobScheduler(object):
             # So that anything waiting on this job can be cancelled too
             self.progress.advance()
 
+    @profiler.timed
     def complete_job(self, job_id, errored = False, cancelled = False):
         # TODO: document the rules here: jobs may only modify objects that they
         # have taken out a writelock on, and they may only modify instances obtained
@@ -1348,6 +1507,7 @@ class JobScheduler(object):
 
         return stateful_object.downcast()
 
+    @profiler.timed
     def available_transitions(self, object_list):
         """Compute the available transitional states for each stateful object
 
@@ -1359,29 +1519,28 @@ class JobScheduler(object):
         If an object in the list is locked, it will be included in the return
         dict, but it's transitions will be an empty list.
 
+        The transitions of unlocked objects are cached, see ActionCache.
+
         :param object_list: list of serialized tuples: [(obj_key, obj_id), ...]
         :return: dict of list of states {obj_id: ['<state1>','<state2',etc], }
         """
 
         with self._lock:
+            # Hit the DB for the statefulobjects (ManagedMgs, ManagedMdt, etc., avoiding all caches
+            # Localize fixed for HYD-2714.  May chance again as HYD-3155 is resolved.
+            # Used to leverage the ObjectCache, but this suspect now:  HYD-3155
+            stateful_objects = self._fetch_stateful_objects(object_list)
+
             transitions = defaultdict(list)
             for obj_key, obj_id in object_list:
-                try:
-                    # Hit the DB for the statefulobject (ManagedMgs, ManagedMdt, etc., avoiding all caches
-                    # Localize fixed for HYD-2714.  May chance again as HYD-3155 is resolved.
-                    model_klass = ContentType.objects.get_by_natural_key(*obj_key).model_class()
-                    stateful_object = model_klass.objects.get(pk=obj_id)
-
-                    # Used to leverage the ObjectCache, but this suspect now:  HYD-3155
-                    # stateful_object = JobScheduler._retrieve_stateful_object(obj_key, obj_id)
-
-                    log.debug("available_transitions object: %s, state: %s" % (stateful_object, stateful_object.state))
-                except ObjectDoesNotExist:
+                stateful_object = stateful_objects.get((tuple(obj_key), int(obj_id)))
+                if stateful_object is None:
                     # Do not advertise transitions for an object that does not exist
                     # as can happen if a parallel operation deletes this object
                     transitions[obj_id] = []
                     log.debug("available_transitions object: %s" % obj_id)
                 else:
+                    log.debug("available_transitions object: %s, state: %s" % (stateful_object, stateful_object.state))
                     # We don't advertise transitions for anything which is currently
                     # locked by an incomplete job.  We could alternatively advertise
                     # which jobs would actually be legal to add by skipping this
@@ -1396,15 +1555,37 @@ class JobScheduler(object):
                         # which will
                         # be available when current jobs are complete)
                         #  See method self.get_expected_state(stateful_object)
-                        from_state = stateful_object.state
-                        available_states = stateful_object.get_available_states(from_state)
-                        log.debug("available_transitions from_state: %s, states: %s" % (from_state, available_states))
-
-                        # Add the job verbs to the possible state transitions for displaying as a choice.
-                        transitions[obj_id] = self._add_verbs(stateful_object, available_states)
+                        transitions[obj_id] = action_cache.get('transitions', obj_key, obj_id, stateful_object.state,
+                                                               lambda: self._available_transitions(stateful_object))
 
             return transitions
 
+    @staticmethod
+    def _fetch_stateful_objects(object_list):
+        """Load the objects of a list of (obj_key, obj_id) from the database with a query per type,
+        returning a dict of (obj_key, obj_id) to object
+
+        """
+        ids_by_key = defaultdict(list)
+        for obj_key, obj_id in object_list:
+            ids_by_key[tuple(obj_key)].append(obj_id)
+
+        stateful_objects = {}
+        for obj_key, obj_ids in ids_by_key.items():
+            model_klass = ContentType.objects.get_by_natural_key(*obj_key).model_class()
+            for stateful_object in model_klass.objects.filter(pk__in = obj_ids):
+                stateful_objects[(obj_key, stateful_object.pk)] = stateful_object
+
+        return stateful_objects
+
+    def _available_transitions(self, stateful_object):
+        from_state = stateful_object.state
+        available_states = stateful_object.get_available_states(from_state)
+        log.debug("available_transitions from_state: %s, states: %s" % (from_state, available_states))
+
+        # Add the job verbs to the possible state transitions for displaying as a choice.
+        return self._add_verbs(stateful_object, available_states)
+
     def _add_verbs(self, stateful_object, raw_transitions):
         """Lookup the verb for each available state
 
@@ -1461,6 +1642,7 @@ class JobScheduler(object):
                                 'args': job_class.get_args(stateful_object)})
         return available_jobs
 
+    @profiler.timed
     def available_jobs(self, object_list):
         """Compute the available jobs for the stateful object
 
@@ -1471,6 +1653,8 @@ class JobScheduler(object):
         If an object in the list is locked, it will be included in the return
         dict, but it's jobs will be an empty list.
 
+        The jobs of unlocked objects are cached, see ActionCache.
+
         :param object_list: list of serialized tuples: [(obj_key, obj_id), ...]
         :return: A dict of lists of jobs like {obj1_id: [{'verb': ...,
                         'confirmation': ..., 'class_name': ..., 'args: ...}], ...}
@@ -1493,7 +1677,8 @@ class JobScheduler(object):
                     if self._lock_cache.get_latest_write(stateful_object) > 0:
                         jobs[obj_id] = []
                     else:
-                        jobs[obj_id] = self._fetch_jobs(stateful_object)
+                        jobs[obj_id] = action_cache.get('jobs', obj_key, obj_id, stateful_object.state,
+                                                        lambda: self._fetch_jobs(stateful_object))
 
             return jobs
 
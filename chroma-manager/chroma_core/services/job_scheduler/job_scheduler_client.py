@@ -14,7 +14,7 @@ non-remote functionality is wrapped in JobSchedulerClient.
 from django import db
 
 from chroma_core.services import log_register
-from chroma_core.services.rpc import ServiceRpcInterface
+from chroma_core.services.rpc import ServiceRpcInterface, PRIORITY_HIGH, PRIORITY_LOW
 from chroma_core.models import ManagedHost, Command
 
 
@@ -44,9 +44,35 @@ class JobSchedulerRpc(ServiceRpcInterface):
                'update_corosync_configuration',
                'get_transition_consequences',
                'tables_changed',
-               'wait_table_change'
+               'wait_table_change',
+               'get_profile'
                ]
 
+    # Queries for the UI go ahead of operations which change the system, and configuring new
+    # servers and filesystems can't take all the workers.  Long polls wait for a change in
+    # threads of their own.
+    method_priorities = dict([(method, PRIORITY_HIGH) for method in ['available_transitions',
+                                                                      'available_jobs',
+                                                                      'get_locks',
+                                                                      'get_transition_consequences',
+                                                                      'tables_changed',
+                                                                      'get_profile']] +
+                             [(method, PRIORITY_LOW) for method in ['create_host_ssh',
+                                                                     'test_host_contact',
+                                                                     'create_host',
+                                                                     'create_filesystem',
+                                                                     'create_targets',
+                                                                     'set_host_profile']])
+    concurrency_classes = {'configuration': 4,
+                           'long_poll': None}
+    method_concurrency_classes = {'create_host_ssh': 'configuration',
+                                  'test_host_contact': 'configuration',
+                                  'create_host': 'configuration',
+                                  'create_filesystem': 'configuration',
+                                  'create_targets': 'configuration',
+                                  'set_host_profile': 'configuration',
+                                  'wait_table_change': 'long_poll'}
+
 
 class JobSchedulerClient(object):
     """Because there are some tasks which are the domain of the job scheduler but do not need to
@@ -27,6 +27,13 @@ class NotificationQueue(ServiceQueue):
     name = 'job_scheduler_notifications'
 
 
+# The same update is not sent again for an attribute whose value hasn't changed for this long, by
+# which time it will have been applied if it was going to be.  Map of (content type natural key,
+# object id, attribute) to (current value, update, time sent)
+RESEND_INTERVAL = datetime.timedelta(seconds = 30)
+_sent = {}
+
+
 def notify(instance, time, update_attrs, from_states = []):
     """Having detected that the state of an object in the database does not
     match information from real life (i.e. chroma-agent), call this to
@@ -46,16 +53,34 @@ def notify(instance, time, update_attrs, from_states = []):
     """
 
     if (not from_states) or instance.state in from_states:
-        log.info("Enqueuing notify %s at %s:" % (instance, time))
+        natural_key = ContentType.objects.get_for_model(instance).natural_key()
+        sent_at = datetime.datetime.utcnow()
+        current_attrs = {}
         for attr, value in update_attrs.items():
             try:
-                log.info("  .%s %s->%s" % (attr, getattr(instance, attr), value))
+                current_attrs[attr] = getattr(instance, attr)
             except DisabledConnection.DisabledConnectionUsed:
-                log.info("  .%s 'Unknown State'->%s" % (attr, value))
+                current_attrs[attr] = 'Unknown State'
+
+            # Skip updates which are still on their way from an identical notification
+            current, update, previously_sent_at = _sent.get((natural_key, instance.id, attr), (None, None, None))
+            if (current, update) == (current_attrs[attr], value) and sent_at - previously_sent_at < RESEND_INTERVAL:
+                del current_attrs[attr]
+
+        if not current_attrs:
+            log.debug("Skipping notify %s at %s: already sent" % (instance, time))
+            return
+
+        log.info("Enqueuing notify %s at %s:" % (instance, time))
+        for attr, current in current_attrs.items():
+            log.info("  .%s %s->%s" % (attr, current, update_attrs[attr]))
+            _sent[(natural_key, instance.id, attr)] = (current, update_attrs[attr], sent_at)
 
         # Encode datetimes
         encoded_attrs = {}
         for attr, value in update_attrs.items():
+            if attr not in current_attrs:
+                continue
             try:
                 field = next(f for f in instance._meta.fields if f.name == attr)
             except StopIteration:
@@ -70,7 +95,7 @@ def notify(instance, time, update_attrs, from_states = []):
 
         time_serialized = time.isoformat()
         NotificationQueue().put({
-            'instance_natural_key': ContentType.objects.get_for_model(instance).natural_key(),
+            'instance_natural_key': natural_key,
             'instance_id': instance.id,
             'time': time_serialized,
             'update_attrs': encoded_attrs,
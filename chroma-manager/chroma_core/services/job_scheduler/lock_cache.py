@@ -3,12 +3,20 @@
 # license that can be found in the LICENSE file.
 
 
+import bisect
 from collections import defaultdict
 import json
 from django.db.models import Q
 
 
 class LockCache(object):
+    """Index of the StateLocks of incomplete jobs.
+
+    The locks of each item are kept ordered by job ID, alongside a list of their job IDs to bisect,
+    so that finding the latest write lock on an item is O(1) and the read locks after a job is
+    O(log n).  The end state of each item's latest write lock is maintained in `expected_states`.
+
+    """
 
     # Lock change receivers are called whenever a change occurs to the locks. It allows something to
     # respond to changes. An example would be long polling.
@@ -20,12 +28,13 @@ class LockCache(object):
     def __init__(self):
         from chroma_core.models import Job, StateLock
 
-        self.write_locks = []
         self.write_by_item = defaultdict(list)
-        self.read_locks = []
+        self.write_ids_by_item = defaultdict(list)
         self.read_by_item = defaultdict(list)
+        self.read_ids_by_item = defaultdict(list)
         self.all_by_job = defaultdict(list)
         self.all_by_item = defaultdict(list)
+        self.expected_states = {}
 
         for job in Job.objects.filter(~Q(state = 'complete')):
             if job.locks_json:
@@ -37,20 +46,32 @@ class LockCache(object):
         for lock_change_receiver in self.lock_change_receivers:
             lock_change_receiver(lock, add_remove)
 
+    def _by_item(self, lock):
+        if lock.write:
+            return self.write_by_item[lock.locked_item], self.write_ids_by_item[lock.locked_item]
+        else:
+            return self.read_by_item[lock.locked_item], self.read_ids_by_item[lock.locked_item]
+
+    def _update_expected_state(self, locked_item):
+        locks = self.write_by_item.get(locked_item)
+        if locks and locks[-1].end_state:
+            self.expected_states[locked_item] = locks[-1].end_state
+        else:
+            self.expected_states.pop(locked_item, None)
+
     def remove_job(self, job):
-        locks = list(self.all_by_job[job.id])
-        n = len(locks)
+        locks = self.all_by_job.pop(job.id, [])
         for lock in locks:
+            item_locks, item_ids = self._by_item(lock)
+            # the locks of a job are contiguous, so only from the first of them need be searched
+            index = item_locks.index(lock, bisect.bisect_left(item_ids, job.id))
+            del item_locks[index]
+            del item_ids[index]
             if lock.write:
-                self.write_locks.remove(lock)
-                self.write_by_item[lock.locked_item].remove(lock)
-            else:
-                self.read_locks.remove(lock)
-                self.read_by_item[lock.locked_item].remove(lock)
-            self.all_by_job[job.id].remove(lock)
+                self._update_expected_state(lock.locked_item)
             self.all_by_item[lock.locked_item].remove(lock)
             self.call_receivers(lock, self.LOCK_REMOVE)
-        return n
+        return len(locks)
 
     def add(self, lock):
         self._add(lock)
@@ -58,12 +79,12 @@ class LockCache(object):
     def _add(self, lock):
         assert lock.job.id is not None
 
+        item_locks, item_ids = self._by_item(lock)
+        index = bisect.bisect_right(item_ids, lock.job.id)
+        item_locks.insert(index, lock)
+        item_ids.insert(index, lock.job.id)
         if lock.write:
-            self.write_locks.append(lock)
-            self.write_by_item[lock.locked_item].append(lock)
-        else:
-            self.read_locks.append(lock)
-            self.read_by_item[lock.locked_item].append(lock)
+            self._update_expected_state(lock.locked_item)
 
         self.all_by_job[lock.job.id].append(lock)
         self.all_by_item[lock.locked_item].append(lock)
@@ -76,16 +97,14 @@ class LockCache(object):
         return self.all_by_item[locked_item]
 
     def get_latest_write(self, locked_item, not_job = None):
-        try:
-            if not_job != None:
-                return sorted([l for l in self.write_by_item[locked_item] if l.job != not_job], lambda a, b: cmp(a.job.id, b.job.id))[-1]
-            else:
-                return sorted(self.write_by_item[locked_item], lambda a, b: cmp(a.job.id, b.job.id))[-1]
-        except IndexError:
-            return None
+        for lock in reversed(self.write_by_item.get(locked_item, [])):
+            if not_job is None or lock.job != not_job:
+                return lock
+        return None
 
     def get_read_locks(self, locked_item, after, not_job):
-        return [x for x in self.read_by_item[locked_item] if after <= x.job.id and x.job != not_job]
+        item_ids = self.read_ids_by_item.get(locked_item, [])
+        return [x for x in self.read_by_item[locked_item][bisect.bisect_left(item_ids, after):] if x.job != not_job]
 
     def get_write(self, locked_item):
         return self.write_by_item[locked_item]
@@ -94,11 +113,7 @@ class LockCache(object):
         return self.all_by_item[item]
 
     def get_write_by_locked_item(self):
-        result = {}
-        for locked_item, locks in self.write_by_item.items():
-            if locks:
-                result[locked_item] = sorted(locks, lambda a, b: cmp(a.job.id, b.job.id))[-1]
-        return result
+        return dict((locked_item, locks[-1]) for locked_item, locks in self.write_by_item.items() if locks)
 
 
 def lock_change_receiver():
@@ -0,0 +1,99 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+"""
+Instrumentation of the job_scheduler service: wall time of its operations and counters of
+its caches, reported by JobScheduler.get_profile along with lock contention, job counts and
+queue depths.
+
+"""
+
+import time
+import functools
+import threading
+from collections import defaultdict
+
+
+class Timing(object):
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def to_dict(self):
+        return {'calls': self.calls, 'total': self.total, 'max': self.max}
+
+
+class SchedulerProfiler(object):
+    """Accumulate wall time per operation, and counters.
+
+    Nested or recursive timing of an operation which is already being timed on the same thread
+    is not counted again, so totals are not inflated by recursion.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.timings = defaultdict(Timing)
+            self.counters = defaultdict(int)
+
+    def time(self, name):
+        return _Timer(self, name)
+
+    def timed(self, fn):
+        """Decorator timing each call of a function, named by its module and function name"""
+        name = "%s.%s" % (fn.__module__.split('.')[-1], fn.__name__)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.time(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add(self, name, elapsed):
+        with self._lock:
+            self.timings[name].add(elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {'elapsed': time.time() - self.started_at,
+                    'timings': dict((name, timing.to_dict()) for name, timing in self.timings.items()),
+                    'counters': dict(self.counters)}
+
+
+class _Timer(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        active = self.profiler._local.__dict__.setdefault('active', set())
+        if self.name not in active:
+            active.add(self.name)
+            self.started = time.time()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.started is not None:
+            self.profiler._local.active.remove(self.name)
+            self.profiler.add(self.name, time.time() - self.started)
+
+
+profiler = SchedulerProfiler()
@@ -0,0 +1,170 @@
+# Copyright (c) 2017 Intel Corporation. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+
+import os
+import time
+import heapq
+import itertools
+import threading
+import traceback
+from collections import defaultdict
+
+from chroma_core.services.log import log_register
+from chroma_core.services.job_scheduler.profiler import profiler
+
+
+log = log_register(__name__.split('.')[-1])
+
+
+class StepExecutor(object):
+    """A bounded pool of threads which run the steps of jobs, one step at a time.
+
+    Runs are anything with `run_step()` (returning whether there are more steps to run), and `host`,
+    `step_class` and `cancelled` attributes describing the next step.  Between steps a run goes back
+    on the queue, so a job doesn't hold a worker while it waits for a server.  The queue is ordered by
+    the priority each run was submitted with, and no more than `per_host` steps of different runs act
+    on the same server at once: runs whose next step is for a busy server wait aside until one of its
+    steps finishes.  Cancelled runs are let through regardless, so their cancellation completes promptly:
+    `wake(run)` moves a run which was cancelled while waiting aside back to the queue.
+
+    Steps flagged `long_running` by the run, which may wait for a long time on something other than the
+    manager, are started in a thread of their own, so that they don't leave the pool without workers.
+
+    The time each step spends queued and running is recorded by step class in the profiler.
+
+    """
+
+    def __init__(self, workers, per_host):
+        self._workers = workers
+        self._per_host = per_host
+        self._condition = threading.Condition()
+        self._ready = []
+        self._waiting = defaultdict(list)
+        self._running = defaultdict(int)
+        self._sequence = itertools.count()
+        self._threads = []
+        self._long_running = 0
+        self._stopping = False
+
+    def submit(self, run, priority):
+        with self._condition:
+            if not self._threads:
+                for n in range(self._workers):
+                    thread = threading.Thread(target = self._work, name = "StepExecutor-%s" % n)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+            self._push(self._ready, priority, run)
+
+    def wake(self, run):
+        """Queue a cancelled run which is waiting aside for its server, so that it completes promptly"""
+        with self._condition:
+            waiting = self._waiting.get(run.host)
+            for index, entry in enumerate(waiting or []):
+                if entry[-1] is run:
+                    waiting.pop(index)
+                    heapq.heapify(waiting)
+                    if not waiting:
+                        del self._waiting[run.host]
+                    heapq.heappush(self._ready, entry)
+                    self._condition.notify()
+                    return
+
+    def stop(self):
+        """Stop the workers, once the runs submitted have completed"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        with self._condition:
+            return {'workers': len(self._threads),
+                    'ready': len(self._ready),
+                    'waiting_for_host': sum(len(entries) for entries in self._waiting.values()),
+                    'running': sum(self._running.values()),
+                    'long_running': self._long_running}
+
+    def _push(self, heap, priority, run):
+        heapq.heappush(heap, (priority, next(self._sequence), time.time(), run))
+        self._condition.notify()
+
+    def _take(self):
+        """Return the highest priority ready entry whose server isn't busy, setting aside those which are"""
+        while self._ready:
+            entry = heapq.heappop(self._ready)
+            run = entry[-1]
+            if run.host is None or run.cancelled or self._running.get(run.host, 0) < self._per_host:
+                return entry
+            heapq.heappush(self._waiting[run.host], entry)
+        return None
+
+    def _release(self, host):
+        self._running[host] -= 1
+        if not self._running[host]:
+            del self._running[host]
+        waiting = self._waiting.get(host)
+        if waiting:
+            heapq.heappush(self._ready, heapq.heappop(waiting))
+            if not waiting:
+                del self._waiting[host]
+            self._condition.notify()
+
+    def _work(self):
+        from chroma_core.services.job_scheduler.job_scheduler import _disable_database
+
+        _disable_database()
+        while True:
+            with self._condition:
+                entry = self._take()
+                while entry is None:
+                    # runs may still come back from long running steps
+                    if self._stopping and not self._long_running:
+                        return
+                    self._condition.wait()
+                    entry = self._take()
+                run = entry[-1]
+                if run.host is not None:
+                    self._running[run.host] += 1
+                if run.long_running and not run.cancelled:
+                    self._long_running += 1
+                    thread = threading.Thread(target = self._run_long, args = (entry,), name = "StepExecutor-long")
+                    thread.daemon = True
+                    thread.start()
+                    continue
+
+            self._run(entry)
+
+    def _run_long(self, entry):
+        from chroma_core.services.job_scheduler.job_scheduler import _disable_database
+
+        _disable_database()
+        try:
+            self._run(entry)
+        finally:
+            with self._condition:
+                self._long_running -= 1
+                self._condition.notify_all()
+
+    def _run(self, entry):
+        priority, sequence, queued_at, run = entry
+        host = run.host
+        step_class = run.step_class
+        started_at = time.time()
+        profiler.add("step_wait.%s" % step_class, started_at - queued_at)
+        try:
+            more = run.run_step()
+        except Exception:
+            log.critical("Unhandled exception running step: %s" % traceback.format_exc())
+            # As for an unhandled exception in RunJobThread, better to die clean than live on dirty
+            os._exit(-1)
+        profiler.add("step_run.%s" % step_class, time.time() - started_at)
+
+        with self._condition:
+            if host is not None:
+                self._release(host)
+            if more:
+                self._push(self._ready, priority, run)
@@ -5,8 +5,9 @@
 
 import traceback
 import sys
+import time
 from chroma_core.services.lustre_audit.update_scan import UpdateScan
-from chroma_core.models import ManagedHost
+from chroma_core.models import ManagedHost, Series
 from chroma_core.services import ChromaService, log_register
 from chroma_core.services.queue import AgentRxQueue
 from django.db import transaction
@@ -17,10 +18,12 @@ log = log_register(__name__)
 
 class Service(ChromaService):
     PLUGIN_NAME = 'lustre'
+    REPORT_INTERVAL = 600
 
     def __init__(self):
         self._queue = AgentRxQueue(Service.PLUGIN_NAME)
         self._queue.purge()
+        self._reported = time.time()
 
     def run(self):
         super(Service, self).run()
@@ -37,6 +40,10 @@ class Service(ChromaService):
         except Exception:
             log.error("Error handling lustre message: %s", '\n'.join(traceback.format_exception(*(sys.exc_info()))))
 
+        if time.time() > self._reported + self.REPORT_INTERVAL:
+            log.info("Series cache: %s" % Series.cache.counters())
+            self._reported = time.time()
+
     def stop(self):
         super(Service, self).stop()
 
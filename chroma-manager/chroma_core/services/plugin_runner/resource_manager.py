@@ -11,14 +11,16 @@ WARNING:
 """
 import logging
 import json
+import time
 import threading
 
 from collections import defaultdict
+from contextlib import contextmanager
 
 import dse
 from django.db.models.aggregates import Count
 from django.db.models.query_utils import Q
-from django.db import transaction
+from django.db import connection, transaction, DEFAULT_DB_ALIAS
 
 from chroma_core.lib.storage_plugin.api.resources import LogicalDrive, LogicalDriveSlice
 from chroma_core.lib.storage_plugin.base_plugin import BaseStoragePlugin
@@ -47,6 +49,73 @@ from chroma_core.models import LNetConfiguration, NetworkInterface, Nid
 from chroma_core.models.storage_plugin import StorageResourceAttributeSerialized, StorageResourceLearnEvent, StorageResourceAttributeReference, StorageAlertPropagated
 
 
+class TimedLock(object):
+    """A lock which keeps the number of times it was taken, and the time spent waiting for and
+    holding it, for each scannable ID it was taken for.  It may be taken shared by any number
+    of holders at once, or exclusively by one: waiting exclusive holders go first"""
+
+    # Waits longer than this are logged as they happen
+    WAIT_WARNING = 10.0
+
+    def __init__(self, name):
+        self.name = name
+        self._condition = threading.Condition(threading.Lock())
+        self._shared = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+        self._times_lock = threading.Lock()
+        self._times = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def _acquire(self, shared):
+        with self._condition:
+            if shared:
+                while self._exclusive or self._exclusive_waiting:
+                    self._condition.wait()
+                self._shared += 1
+            else:
+                self._exclusive_waiting += 1
+                try:
+                    while self._exclusive or self._shared:
+                        self._condition.wait()
+                finally:
+                    self._exclusive_waiting -= 1
+                self._exclusive = True
+
+    def _release(self, shared):
+        with self._condition:
+            if shared:
+                self._shared -= 1
+            else:
+                self._exclusive = False
+            self._condition.notify_all()
+
+    @contextmanager
+    def acquired(self, scannable_id, shared = False):
+        started = time.time()
+        self._acquire(shared)
+        acquired = time.time()
+        if acquired - started > self.WAIT_WARNING:
+            log.warning("Waited %.1fs for ResourceManager %s lock for %s" % (acquired - started, self.name, scannable_id))
+        try:
+            yield
+        finally:
+            self._release(shared)
+            with self._times_lock:
+                times = self._times[scannable_id]
+                times[0] += 1
+                times[1] += acquired - started
+                times[2] += time.time() - acquired
+
+    def times(self):
+        """Return a dict of scannable ID to (acquisitions, seconds waiting, seconds held)"""
+        with self._times_lock:
+            return dict((scannable_id, tuple(times)) for scannable_id, times in self._times.items())
+
+    def forget(self, scannable_id):
+        with self._times_lock:
+            return tuple(self._times.pop(scannable_id, (0, 0.0, 0.0)))
+
+
 class PluginSession(object):
     def __init__(self, plugin_instance, scannable_id, update_period):
         # We have to be sure that this PluginSession is only associated with 1 single plugin_instance
@@ -57,6 +126,9 @@ class PluginSession(object):
         self.scannable_id = scannable_id
         self.update_period = update_period
 
+        # Protects the state of this session
+        self.lock = TimedLock('session')
+
 
 class EdgeIndex(object):
     def __init__(self):
@@ -260,15 +332,31 @@ class ResourceManager(object):
 
     This code is written for multi-threaded use within a single process.
     It is not safe to have multiple processes running plugins at this stage.
-    We serialize operations from different plugins using a big lock, and
-    we use the autocommit decorator on persistence functions because
-    otherwise we would have to explicitly commit at the start of
-    each one to see changes from other threads.
+    Each session has a lock of its own for operations on its state, and the graph
+    lock, which is always taken after a session's lock, guards the shared graph of
+    records, the indexes of it and the sessions' ID maps.  Operations which add or
+    remove records, or change the indexes, take it exclusively.  Operations which
+    only use existing records (statistics, attribute updates) take it shared, so
+    they run alongside each other but records and ID map entries cannot be removed
+    from under them.  The statistics lock is held while finding statistic records.  We use the autocommit
+    decorator on persistence functions because otherwise we would have to
+    explicitly commit at the start of each one to see changes from other threads.
 
     """
+    # The most keys or ids to look up in one query
+    QUERY_BATCH_SIZE = 500
+
     def __init__(self):
         self._sessions = {}
-        self._instance_lock = threading.Lock()
+        self._sessions_lock = threading.Lock()
+        self._graph_lock = TimedLock('graph')
+
+        # Map of resource global id to map of statistic name to StorageResourceStatistic,
+        # protected by _stats_lock.  Statistics which a thread creates are kept in its
+        # _created_stats.records until its transaction commits, and dropped if it rolls back.
+        self._statistics = defaultdict(dict)
+        self._stats_lock = threading.RLock()
+        self._created_stats = threading.local()
 
         # Map of (resource_global_id, alert_class) to AlertState pk
         self._active_alerts = {}
@@ -303,42 +391,66 @@ class ResourceManager(object):
         scannable_class = self._class_index.get(scannable_id)
         assert issubclass(scannable_class, BaseScannableResource) or issubclass(scannable_class, HostsideResource)
         log.debug(">> session_open %s (%s resources)" % (scannable_id, len(initial_resources)))
-        with self._instance_lock:
-            if scannable_id in self._sessions:
-                log.warning("Clearing out old session for scannable ID %s" % scannable_id)
-                del self._sessions[scannable_id]
+        session = PluginSession(plugin_instance, scannable_id, update_period)
 
-            session = PluginSession(plugin_instance, scannable_id, update_period)
+        try:
+            # If this returns a BaseStorageResource such as
+            # PluginAgentResources, with a host_id
+            # set it in the session for later use.
+            resource = ResourceQuery().get_resource(session.scannable_id)
+            if resource and hasattr(resource, 'host_id'):
+                session.host_id = resource.host_id
+        except BaseStorageResource.DoesNotExist:
+            pass
 
-            try:
-                # If this returns a BaseStorageResource such as
-                # PluginAgentResources, with a host_id
-                # set it in the session for later use.
-                resource = ResourceQuery().get_resource(session.scannable_id)
-                if resource and hasattr(resource, 'host_id'):
-                    session.host_id = resource.host_id
-            except BaseStorageResource.DoesNotExist:
-                pass
+        with session.lock.acquired(scannable_id):
+            with self._sessions_lock:
+                if scannable_id in self._sessions:
+                    log.warning("Clearing out old session for scannable ID %s" % scannable_id)
+                self._sessions[scannable_id] = session
 
-            self._sessions[scannable_id] = session
-            self._persist_new_resources(session, initial_resources)
-            self._cull_lost_resources(session, initial_resources)
+            with self._graph_lock.acquired(scannable_id):
+                self._persist_new_resources(session, initial_resources)
+                self._cull_lost_resources(session, initial_resources)
 
-            self._persist_lun_updates(scannable_id)
-            self._persist_nid_updates(scannable_id, None, None)
+                self._persist_lun_updates(scannable_id)
+                self._persist_nid_updates(scannable_id, None, None)
 
-            # Plugins are allowed to create VirtualMachine objects, indicating that
-            # we should created a ManagedHost to go with it (e.g. discovering VMs)
-            self._persist_created_hosts(session, scannable_id, initial_resources)
+                # Plugins are allowed to create VirtualMachine objects, indicating that
+                # we should created a ManagedHost to go with it (e.g. discovering VMs)
+                self._persist_created_hosts(session, scannable_id, initial_resources)
 
         log.debug("<< session_open %s" % scannable_id)
 
     def session_close(self, scannable_id):
-        with self._instance_lock:
+        with self._sessions_lock:
             try:
-                del self._sessions[scannable_id]
+                session = self._sessions.pop(scannable_id)
             except KeyError:
                 log.warning("Cannot remove session for %s, it does not exist" % scannable_id)
+                return
+
+        session_times = session.lock.forget(scannable_id)
+        graph_times = self._graph_lock.forget(scannable_id)
+        log.info("ResourceManager session %s locks: session taken %s times, waited %.3fs, held %.3fs; "
+                 "graph taken %s times, waited %.3fs, held %.3fs" % ((scannable_id,) + session_times + graph_times))
+
+    def _get_session(self, scannable_id):
+        with self._sessions_lock:
+            return self._sessions[scannable_id]
+
+    def lock_times(self):
+        """Return a dict of scannable ID to a dict of lock name to (acquisitions, seconds
+        waiting, seconds held), for the open sessions"""
+        with self._sessions_lock:
+            sessions = self._sessions.values()
+
+        result = defaultdict(dict)
+        for session in sessions:
+            result[session.scannable_id]['session'] = session.lock.times().get(session.scannable_id, (0, 0.0, 0.0))
+        for scannable_id, times in self._graph_lock.times().items():
+            result[scannable_id]['graph'] = times
+        return dict(result)
 
     def _persist_created_hosts(self, session, scannable_id, new_resources):
         # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
@@ -894,16 +1006,17 @@ class ResourceManager(object):
         This implementation is really so sub optimal at the moment it is untrue, because it gets called
         for every field that changes for every record. I may change this comment if I can work out a solution!
         """
-        with self._instance_lock:
-            self._resource_persist_update_attributes(scannable_id, record_id, attrs)
-            #self._persist_lun_updates(scannable_id)
-            self._persist_nid_updates(scannable_id, record_id, attrs)
-            #self._persist_created_hosts(scannable_id, scannable_id, resources)
+        session = self._get_session(scannable_id)
+        with session.lock.acquired(scannable_id):
+            with self._graph_lock.acquired(scannable_id, shared = True):
+                self._resource_persist_update_attributes(scannable_id, record_id, attrs)
+                #self._persist_lun_updates(scannable_id)
+                self._persist_nid_updates(scannable_id, record_id, attrs)
+                #self._persist_created_hosts(scannable_id, scannable_id, resources)
 
     def session_resource_add_parent(self, scannable_id, local_resource_id, local_parent_id):
-
-        with self._instance_lock:
-            session = self._sessions[scannable_id]
+        session = self._get_session(scannable_id)
+        with session.lock.acquired(scannable_id), self._graph_lock.acquired(scannable_id):
             record_pk = session.local_id_to_global_id[local_resource_id]
 
             # HYD-6845 Test failure: RpcError - missing parent resource
@@ -924,8 +1037,8 @@ class ResourceManager(object):
             self._resource_modify_parent(record_pk, parent_pk, False)
 
     def session_resource_remove_parent(self, scannable_id, local_resource_id, local_parent_id):
-        with self._instance_lock:
-            session = self._sessions[scannable_id]
+        session = self._get_session(scannable_id)
+        with session.lock.acquired(scannable_id), self._graph_lock.acquired(scannable_id):
             record_pk = session.local_id_to_global_id[local_resource_id]
             parent_pk = session.local_id_to_global_id[local_parent_id]
             self._edges.remove_parent(record_pk, parent_pk)
@@ -934,34 +1047,101 @@ class ResourceManager(object):
     def session_get_stats(self, scannable_id, local_resource_id, update_data):
         """Get global ID for a resource, look up the StoreageResourceStatistic for
            each stat in the update, and invoke its .metrics.update with the data"""
-       # FIXME: definitely could be doing finer grained locking here as although
-       # we need the coarse one for protecting local_id_to_global_id etc, the later
-       # part of actually updating stats just needs to be locked on a per-statistic basis
-        with self._instance_lock:
-                session = self._sessions[scannable_id]
-                record_pk = session.local_id_to_global_id[local_resource_id]
-                return self._get_stats(record_pk, update_data)
-
-    def _get_stats(self, record_pk, update_data):
+        return self.session_get_stats_many(scannable_id, [(local_resource_id, update_data)])
+
+    def session_get_stats_many(self, scannable_id, updates):
+        """As session_get_stats for a list of (local_resource_id, update_data), returning
+           the samples for all of them together"""
+        session = self._get_session(scannable_id)
+        with session.lock.acquired(scannable_id), self._graph_lock.acquired(scannable_id, shared = True):
+            record_updates = [(session.local_id_to_global_id[local_resource_id], update_data)
+                              for local_resource_id, update_data in updates]
+            return self._get_stats(record_updates)
+
+    def _created_stat_records(self):
+        """Return the dict of (record_pk, stat_name) to StorageResourceStatistic created in this thread's
+        transaction, moving them into the statistics cache when it commits"""
+        created = getattr(self._created_stats, 'records', None)
+        if created is None:
+            created = self._created_stats.records = {}
+            connection = transaction.connections[DEFAULT_DB_ALIAS]
+            original_commit_fn = connection.commit
+            original_rollback_fn = connection.rollback
+
+            def transaction_end(commit):
+                connection.commit = original_commit_fn
+                connection.rollback = original_rollback_fn
+                self._created_stats.records = None
+                if commit:
+                    original_commit_fn()
+                    with self._stats_lock:
+                        for (record_pk, stat_name), stat_record in created.items():
+                            self._statistics[record_pk][stat_name] = stat_record
+                else:
+                    original_rollback_fn()
+
+            connection.commit = lambda: transaction_end(True)
+            connection.rollback = lambda: transaction_end(False)
+
+        return created
+
+    def _get_stat_records(self, record_pks_names):
+        """Return a dict of (record_pk, stat_name) to StorageResourceStatistic, loading the statistics
+        of records not seen before in one query, and creating any which don't exist yet"""
+        created = self._created_stat_records()
+        with self._stats_lock:
+            unseen = set(record_pk for record_pk, stat_name in record_pks_names
+                         if stat_name not in self._statistics.get(record_pk, {}) and (record_pk, stat_name) not in created)
+            for batch in self._batches(unseen):
+                for stat_record in StorageResourceStatistic.objects.filter(storage_resource__in = batch):
+                    if (stat_record.storage_resource_id, stat_record.name) not in created:
+                        self._statistics[stat_record.storage_resource_id][stat_record.name] = stat_record
+
+            result = {}
+            creations = []
+            for record_pk, stat_name in record_pks_names:
+                stat_properties = self._class_index.get(record_pk)._meta.storage_statistics[stat_name]
+                stat_record = created.get((record_pk, stat_name)) or self._statistics[record_pk].get(stat_name)
+                if stat_record and stat_record.sample_period != stat_properties.sample_period:
+                    log.warning("Plugin stat period for '%s' changed, expunging old statistics", stat_name)
+                    stat_record.delete()
+                    self._statistics[record_pk].pop(stat_name, None)
+                    created.pop((record_pk, stat_name), None)
+                    stat_record = None
+
+                if stat_record:
+                    result[(record_pk, stat_name)] = stat_record
+                else:
+                    creations.append(StorageResourceStatistic(
+                        storage_resource_id = record_pk, name = stat_name, sample_period = stat_properties.sample_period))
+
+            if creations:
+                # Until the transaction commits these are only for this thread: if it rolls back they never existed
+                StorageResourceStatistic.objects.bulk_create(creations)
+                # Outside a managed transaction bulk_create has committed, and begun another
+                created = self._created_stat_records()
+                keys = set((stat_record.storage_resource_id, stat_record.name) for stat_record in creations)
+                for batch in self._batches(set(record_pk for record_pk, stat_name in keys)):
+                    for stat_record in StorageResourceStatistic.objects.filter(storage_resource__in = batch):
+                        key = (stat_record.storage_resource_id, stat_record.name)
+                        if key in keys:
+                            created[key] = stat_record
+                            result[key] = stat_record
+
+            return result
+
+    def _get_stats(self, record_updates):
         # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
         assert transaction.is_managed()
 
-        record = StorageResourceRecord.objects.get(pk = record_pk)
+        stat_records = self._get_stat_records(set((record_pk, stat_name)
+                                                  for record_pk, update_data in record_updates
+                                                  for stat_name in update_data))
         samples = []
-        for stat_name, stat_data in update_data.items():
-            stat_properties = record.get_statistic_properties(stat_name)
-            try:
-                stat_record = StorageResourceStatistic.objects.get(
-                        storage_resource = record, name = stat_name)
-                if stat_record.sample_period != stat_properties.sample_period:
-                    log.warning("Plugin stat period for '%s' changed, expunging old statistics", stat_name)
-                    stat_record.delete()
-                    raise StorageResourceStatistic.DoesNotExist
-
-            except StorageResourceStatistic.DoesNotExist:
-                stat_record = StorageResourceStatistic.objects.create(
-                        storage_resource = record, name = stat_name, sample_period = stat_properties.sample_period)
-            samples += stat_record.update(stat_name, stat_properties, stat_data)
+        for record_pk, update_data in record_updates:
+            storage_statistics = self._class_index.get(record_pk)._meta.storage_statistics
+            for stat_name, stat_data in update_data.items():
+                samples += stat_records[(record_pk, stat_name)].update(stat_name, storage_statistics[stat_name], stat_data)
         return samples
 
     def _resource_modify_parent(self, record_pk, parent_pk, remove):
@@ -978,7 +1158,7 @@ class ResourceManager(object):
         # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
         assert transaction.is_managed()
 
-        session = self._sessions[scannable_id]
+        session = self._get_session(scannable_id)
 
         global_record_id = session.local_id_to_global_id[local_record_id]
 
@@ -1003,47 +1183,51 @@ class ResourceManager(object):
         # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
         assert transaction.is_managed()
 
-        with self._instance_lock:
-            session = self._sessions[scannable_id]
-            self._persist_new_resources(session, resources)
-            self._persist_lun_updates(scannable_id)
-            self._persist_nid_updates(scannable_id, None, None)
-            self._persist_created_hosts(session, scannable_id, resources)
+        session = self._get_session(scannable_id)
+        with session.lock.acquired(scannable_id):
+            with self._graph_lock.acquired(scannable_id):
+                self._persist_new_resources(session, resources)
+                self._persist_lun_updates(scannable_id)
+                self._persist_nid_updates(scannable_id, None, None)
+                self._persist_created_hosts(session, scannable_id, resources)
 
     @advisory_lock(AlertState, wait=False)
     def session_remove_local_resources(self, scannable_id, resources):
         # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
         assert transaction.is_managed()
 
-        with self._instance_lock:
-            session = self._sessions[scannable_id]
-            for local_resource in resources:
-                try:
-                    resource_global_id = session.local_id_to_global_id[local_resource._handle]
-                    self._delete_nid_resource(scannable_id, resource_global_id)
-                    self._delete_resource(StorageResourceRecord.objects.get(pk = resource_global_id))
-                except KeyError:
-                    pass
-            self._persist_lun_updates(scannable_id)
+        session = self._get_session(scannable_id)
+        with session.lock.acquired(scannable_id):
+            with self._graph_lock.acquired(scannable_id):
+                for local_resource in resources:
+                    try:
+                        resource_global_id = session.local_id_to_global_id[local_resource._handle]
+                        self._delete_nid_resource(scannable_id, resource_global_id)
+                        self._delete_resource(StorageResourceRecord.objects.get(pk = resource_global_id))
+                    except KeyError:
+                        pass
+                self._persist_lun_updates(scannable_id)
 
     @advisory_lock(AlertState, wait=False)
     def session_remove_global_resources(self, scannable_id, resources):
         # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
         assert transaction.is_managed()
 
-        with self._instance_lock:
-            session = self._sessions[scannable_id]
+        session = self._get_session(scannable_id)
+        with session.lock.acquired(scannable_id):
             resources = session._plugin_instance._index._local_id_to_resource.values()
 
-            self._cull_lost_resources(session, resources)
-            self._persist_lun_updates(scannable_id)
+            with self._graph_lock.acquired(scannable_id):
+                self._cull_lost_resources(session, resources)
+                self._persist_lun_updates(scannable_id)
 
     def session_notify_alert(self, scannable_id, resource_local_id, active, severity, alert_class, attribute):
         # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
         assert transaction.is_managed()
 
-        with self._instance_lock:
-            session = self._sessions[scannable_id]
+        session = self._get_session(scannable_id)
+        # Alerts propagate to descendents in the graph
+        with session.lock.acquired(scannable_id), self._graph_lock.acquired(scannable_id):
             record_pk = session.local_id_to_global_id[resource_local_id]
             if active:
                 if not (record_pk, alert_class) in self._active_alerts:
@@ -1097,79 +1281,94 @@ class ResourceManager(object):
                                                   alert_type="StorageResourceAlert_%s" % alert_class)
         return alert_state
 
+    def _batches(self, ids):
+        ids = list(ids)
+        for i in range(0, len(ids), self.QUERY_BATCH_SIZE):
+            yield ids[i:i + self.QUERY_BATCH_SIZE]
+
     @advisory_lock(AlertState, wait=False)
     def _cull_lost_resources(self, session, reported_resources):
         # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
         assert transaction.is_managed()
 
-        reported_scoped_resources = []
-        reported_global_resources = []
+        reported_scoped_resources = set()
+        reported_global_resources = set()
         for r in reported_resources:
             if isinstance(r._meta.identifier, BaseScopedId):
-                reported_scoped_resources.append(session.local_id_to_global_id[r._handle])
+                reported_scoped_resources.add(session.local_id_to_global_id[r._handle])
             else:
-                reported_global_resources.append(session.local_id_to_global_id[r._handle])
-
-        # This generator re-runs the query on every loop iteration in order
-        # to handle situations where resources returned by the query are
-        # deleted as dependents of prior resources (HYD-3659).
-        def iterate_lost_resources(query):
-            loops_remaining = len(query())
-            while loops_remaining:
-                loops_remaining -= 1
-                rs = query()
-                if len(rs):
-                    yield rs[0]
-                else:
-                    raise StopIteration()
-
-            # If the list of lost items grew, don't continue looping.
-            # Just bail out and the next scan will get them.
-            if loops_remaining <= 0:
-                raise StopIteration()
+                reported_global_resources.add(session.local_id_to_global_id[r._handle])
 
         # Look for scoped resources which were at some point reported by
         # this scannable_id, but are missing this time around.
-        lost_scoped_resources = lambda: StorageResourceRecord.objects.filter(
-                  ~Q(pk__in = reported_scoped_resources),
-                  storage_id_scope = session.scannable_id)
-        for r in iterate_lost_resources(lost_scoped_resources):
-            self._delete_resource(r)
+        lost_resources = set(StorageResourceRecord.objects.filter(
+            storage_id_scope = session.scannable_id).values_list('id', flat = True)) - reported_scoped_resources
 
         # Look for globalid resources which were at some point reported by
-        # this scannable_id, but are missing this time around.
-        lost_global_resources = lambda: StorageResourceRecord.objects.filter(
-                    ~Q(pk__in = reported_global_resources),
-                    reported_by = session.scannable_id)
-        for reportee in iterate_lost_resources(lost_global_resources):
-            reportee.reported_by.remove(session.scannable_id)
-            if not reportee.reported_by.count():
-                self._delete_resource(reportee)
+        # this scannable_id, but are missing this time around: they are lost
+        # if nothing else reports them.
+        reported_by = StorageResourceRecord.reported_by.through._default_manager
+        from_field = StorageResourceRecord.reported_by.field.m2m_field_name()
+        to_field = StorageResourceRecord.reported_by.field.m2m_reverse_field_name()
+        lost_global_resources = set(reported_by.filter(**{to_field: session.scannable_id}).values_list(
+            '%s_id' % from_field, flat = True)) - reported_global_resources
+        for batch in self._batches(lost_global_resources):
+            reported_by.filter(**{to_field: session.scannable_id, '%s__in' % from_field: batch}).delete()
+            lost_resources.update(set(batch) - set(reported_by.filter(**{'%s__in' % from_field: batch}).values_list(
+                '%s_id' % from_field, flat = True)))
+
+        # Everything lost is deleted together, so that resources which depend on
+        # more than one of them are only found and deleted once (HYD-3659).
+        self._delete_resources(lost_resources)
 
     def _delete_resource(self, resource_record):
-        log.info("ResourceManager._delete_resource '%s'" % resource_record.pk)
+        self._delete_resources([resource_record.id])
+
+    def _delete_where_in(self, model, column, ids):
+        """Delete the rows of a model with a column value in ids, a batch at a time, without
+        loading them first as QuerySet.delete() would: only for models which nothing references."""
+        cursor = connection.cursor()
+        for batch in self._batches(ids):
+            cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (connection.ops.quote_name(model._meta.db_table),
+                                                                connection.ops.quote_name(column),
+                                                                ", ".join(["%s"] * len(batch))), batch)
+
+    def _delete_resources(self, record_ids):
+        if not record_ids:
+            return
 
-        ordered_for_deletion = []
+        log.info("ResourceManager._delete_resources %s" % sorted(record_ids))
+
+        # The records to delete with their dependents, ordered dependents first
         phase1_ordered_dependencies = []
+        phase1_collected = set()
 
         def collect_phase1(record_id):
-            if not record_id in phase1_ordered_dependencies:
+            if not record_id in phase1_collected:
+                phase1_collected.add(record_id)
                 phase1_ordered_dependencies.append(record_id)
 
-        # If we are deleting one of the special top level resource classes, handle
-        # its dependents
-        record_id = resource_record.id
-        from chroma_core.lib.storage_plugin.base_resource import BaseScannableResource, HostsideResource
-        resource_class = self._class_index.get(record_id)
-        if issubclass(resource_class, BaseScannableResource) or issubclass(resource_class, HostsideResource):
-            # Find resources scoped to this resource
-            for dependent in StorageResourceRecord.objects.filter(storage_id_scope = record_id):
-                collect_phase1(dependent.id)
-
-            # Delete any reported_by relations to this resource
-            StorageResourceRecord.reported_by.through._default_manager.filter(
-                **{'%s' % StorageResourceRecord.reported_by.field.m2m_reverse_field_name(): record_id}
-            ).delete()
+        # If we are deleting any of the special top level resource classes, handle
+        # their dependents
+        scannable_ids = []
+        offline_ids = []
+        for record_id in record_ids:
+            resource_class = self._class_index.get(record_id)
+            if issubclass(resource_class, BaseScannableResource) or issubclass(resource_class, HostsideResource):
+                scannable_ids.append(record_id)
+            if issubclass(resource_class, BaseScannableResource):
+                offline_ids.append(record_id)
+
+        if scannable_ids:
+            for batch in self._batches(scannable_ids):
+                # Find resources scoped to these resources
+                for dependent_id in StorageResourceRecord.objects.filter(storage_id_scope__in = batch).values_list('id', flat = True):
+                    collect_phase1(dependent_id)
+
+                # Delete any reported_by relations to these resources
+                StorageResourceRecord.reported_by.through._default_manager.filter(
+                    **{'%s__in' % StorageResourceRecord.reported_by.field.m2m_reverse_field_name(): batch}
+                ).delete()
 
             # Delete any resources whose reported_by are now zero
             for srr in StorageResourceRecord.objects.filter(storage_id_scope = None, reported_by = None).values('id'):
@@ -1177,52 +1376,60 @@ class ResourceManager(object):
                 if (not issubclass(srr_class, HostsideResource)) and (not issubclass(srr_class, BaseScannableResource)):
                     collect_phase1(srr['id'])
 
-        if issubclass(resource_class, BaseScannableResource):
-            # Delete any StorageResourceOffline alerts
-            for alert_state in StorageResourceOffline.objects.filter(alert_item_id = record_id):
+        # Delete any StorageResourceOffline alerts
+        if offline_ids:
+            for alert_state in StorageResourceOffline.objects.filter(alert_item_id__in = offline_ids):
                 alert_state.delete()
 
-        phase1_ordered_dependencies.append(resource_record.id)
-
-        reference_cache = dict([(r, []) for r in phase1_ordered_dependencies])
-        for attr in StorageResourceAttributeReference.objects.filter(value__in = phase1_ordered_dependencies):
-            reference_cache[attr.value_id].append(attr)
-
-        def collect_phase2(record_id):
-            if record_id in ordered_for_deletion:
-                # NB cycles aren't allowed individually in the parent graph,
-                # the resourcereference graph, the scoping graph, but
-                # we are traversing all 3 at once so we can see cycles here.
-                return
-
-            # Find ResourceReference attributes on other objects
-            # that refer to this one
-            if record_id in reference_cache:
-                attrs = reference_cache[record_id]
-            else:
-                attrs = StorageResourceAttributeReference.objects.filter(value = record_id)
-            for attr in attrs:
-                collect_phase2(attr.resource_id)
-
-            ordered_for_deletion.append(record_id)
-
+        for record_id in record_ids:
+            collect_phase1(record_id)
+
+        # Find what refers to the victims with ResourceReference attributes, and what refers
+        # to those, a generation of referrers at a time
+        referrers = defaultdict(list)
+        found = set(phase1_collected)
+        frontier = phase1_ordered_dependencies
+        while frontier:
+            next_frontier = []
+            for batch in self._batches(frontier):
+                for value_id, resource_id in StorageResourceAttributeReference.objects.filter(value__in = batch).values_list('value_id', 'resource_id'):
+                    referrers[value_id].append(resource_id)
+                    if resource_id not in found:
+                        found.add(resource_id)
+                        next_frontier.append(resource_id)
+            frontier = next_frontier
+
+        # Order referrers before the resources they refer to.  NB cycles aren't allowed
+        # individually in the parent graph, the resourcereference graph, the scoping graph,
+        # but we are traversing all 3 at once so we can see cycles here.
+        ordered_for_deletion = []
+        visited = set()
         for record_id in phase1_ordered_dependencies:
-            collect_phase2(record_id)
+            if record_id in visited:
+                continue
+            visited.add(record_id)
+            stack = [(record_id, iter(referrers[record_id]))]
+            while stack:
+                current_id, remaining = stack[-1]
+                for referrer_id in remaining:
+                    if referrer_id not in visited:
+                        visited.add(referrer_id)
+                        stack.append((referrer_id, iter(referrers[referrer_id])))
+                        break
+                else:
+                    stack.pop()
+                    ordered_for_deletion.append(current_id)
 
-        for storage_resource_record in StorageResourceLearnEvent.objects.all():
-            if storage_resource_record.storage_resource.id in ordered_for_deletion:
-                storage_resource_record.delete()
+        deleted = set(ordered_for_deletion)
+        StorageResourceLearnEvent.objects.filter(
+            id__in = [event_id for event_id, variant in StorageResourceLearnEvent.objects.values_list('id', 'variant')
+                      if json.loads(variant).get('storage_resource_id') in deleted]).delete()
 
         # Delete any parent relations pointing to victim resources
         StorageResourceRecord.parents.through._default_manager.filter(
             **{'%s__in' % StorageResourceRecord.parents.field.m2m_reverse_field_name(): ordered_for_deletion}
         ).delete()
 
-        record_id_to_volumes = defaultdict(list)
-        volumes = Volume.objects.filter(storage_resource__in = ordered_for_deletion)
-        for v in volumes:
-            record_id_to_volumes[v.storage_resource_id].append(v)
-
         record_id_to_volume_nodes = defaultdict(list)
         volume_nodes = VolumeNode.objects.filter(storage_resource__in = ordered_for_deletion)
         for v in volume_nodes:
@@ -1263,13 +1470,24 @@ class ResourceManager(object):
                 srs.metrics.clear()
                 srs_delayed.delete(int(srs.id))
         StorageResourceStatistic.delayed.flush()
-
+        created = getattr(self._created_stats, 'records', None) or {}
+        with self._stats_lock:
+            for record_id in ordered_for_deletion:
+                self._statistics.pop(record_id, None)
+            for record_id, stat_name in created.keys():
+                if record_id in ordered_for_deletion:
+                    del created[(record_id, stat_name)]
+
+        # Every user of the sessions' ID maps holds the graph lock, so with it held exclusively
+        # we may remove deleted records from other sessions' maps too
+        with self._sessions_lock:
+            sessions = self._sessions.values()
         for record_id in ordered_for_deletion:
             self._subscriber_index.remove_resource(record_id, self._class_index.get(record_id))
             self._class_index.remove_record(record_id)
             self._edges.remove_node(record_id)
 
-            for session in self._sessions.values():
+            for session in sessions:
                 try:
                     local_id = session.global_id_to_local_id[record_id]
                     del session.local_id_to_global_id[local_id]
@@ -1278,12 +1496,11 @@ class ResourceManager(object):
                 except KeyError:
                     pass
 
-        with StorageResourceRecord.delayed as resources:
-            for record_id in ordered_for_deletion:
-                resources.update({'id': int(record_id), 'storage_id_scope_id': None})
+        for batch in self._batches(ordered_for_deletion):
+            StorageResourceRecord.objects.filter(id__in = batch).update(storage_id_scope = None)
 
         for klass in [StorageResourceAttributeReference, StorageResourceAttributeSerialized]:
-            klass.objects.filter(resource__in = ordered_for_deletion).delete()
+            self._delete_where_in(klass, 'resource_id', ordered_for_deletion)
 
         with StorageResourceRecord.delayed as deleter:
             for record_id in ordered_for_deletion:
@@ -1291,7 +1508,18 @@ class ResourceManager(object):
         StorageResourceRecord.delayed.flush()
 
     def global_remove_resource(self, resource_id):
-        with self._instance_lock:
+        # The resource may be the scannable resource of a session which is still running,
+        # hold its lock so that we don't remove its records part way through an update
+        with self._sessions_lock:
+            session = self._sessions.get(resource_id)
+        if session:
+            with session.lock.acquired(resource_id):
+                self._global_remove_resource(resource_id)
+        else:
+            self._global_remove_resource(resource_id)
+
+    def _global_remove_resource(self, resource_id):
+        with self._graph_lock.acquired(None):
             with transaction.commit_manually():
                 # Be extra-sure to see a fresh view (HYD-1301)
                 transaction.commit()
@@ -1347,57 +1575,80 @@ class ResourceManager(object):
 
         return result
 
-    def _persist_new_resources(self, session, resources):
+    def _order_for_creation(self, session, resources):
+        """Sort the resources which don't have records yet into levels, such that any resource
+        referenced by a ResourceReference attribute is in an earlier level than the resources
+        referencing it, so that its global ID is known when theirs are worked out."""
         from chroma_core.lib.storage_plugin.manager import storage_plugin_manager
 
-        # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
-        assert transaction.is_managed()
-
-        # Sort the resources into an order based on ResourceReference
-        # attributes, such that the referenced resource is created
-        # before the referencing resource.
-        ordered_for_creation = []
-
-        def order_by_references(resource):
-            if resource._handle_global:
-                # Bit of _a weird one: this covers the case where a plugin session
-                # was given a root resource that had some ResourceReference attributes
-                # that pointed to resources from a different plugin
-                return False
-
-            if resource._handle in session.local_id_to_global_id:
-                return False
+        def unpersisted(resource):
+            # Resources with a _handle_global are the case of a plugin session given a root resource
+            # with ResourceReference attributes pointing to resources from a different plugin
+            return not resource._handle_global and resource._handle not in session.local_id_to_global_id
 
+        def references(resource):
             resource_class, resource_class_id = storage_plugin_manager.get_plugin_resource_class(
                 resource.__class__.__module__,
                 resource.__class__.__name__)
-
-            # Find any ResourceReference attributes ensure that the target
-            # resource gets constructed before this one
+            result = []
             for key, value in resource._storage_dict.items():
-                # Special case for ResourceReference attributes, because the resource
-                # object passed from the plugin won't have a global ID for the referenced
-                # resource -- we have to do the lookup inside ResourceManager
                 attribute_obj = resource_class.get_attribute_properties(key)
-                if isinstance(attribute_obj, attributes.ResourceReference):
-                    if value:
-                        referenced_resource = value
-                        if not referenced_resource._handle_global:
-                            if not referenced_resource._handle in session.local_id_to_global_id:
-                                order_by_references(referenced_resource)
-
-            if not resource in ordered_for_creation:
-                ordered_for_creation.append(resource)
+                if isinstance(attribute_obj, attributes.ResourceReference) and value and unpersisted(value):
+                    result.append(value)
+            return result
 
+        # Depth first over the references, a resource's level being one more than
+        # the deepest of those it references
+        levels = {}
+        ordered = []
         for resource in resources:
-            if not resource in ordered_for_creation:
-                order_by_references(resource)
+            if resource._handle in levels or not unpersisted(resource):
+                continue
+            levels[resource._handle] = None
+            refs = references(resource)
+            stack = [(resource, refs, iter(refs))]
+            while stack:
+                resource, refs, remaining = stack[-1]
+                for ref in remaining:
+                    if ref._handle not in levels:
+                        levels[ref._handle] = None
+                        ref_refs = references(ref)
+                        stack.append((ref, ref_refs, iter(ref_refs)))
+                        break
+                else:
+                    stack.pop()
+                    levels[resource._handle] = 1 + max([levels[ref._handle] for ref in refs if levels[ref._handle] is not None] or [-1])
+                    ordered.append(resource)
 
-        # Create StorageResourceRecords for any resources which
-        # do not already have one, and update the local_id_to_global_id
-        # map with the DB ID for each resource.
-        creations = {}
-        for resource in ordered_for_creation:
+        result = [[] for n in range(0, max(levels.values()) + 1)] if levels else []
+        for resource in ordered:
+            result[levels[resource._handle]].append(resource)
+        return result
+
+    def _get_records(self, keys):
+        """Return a dict of the StorageResourceRecords for (resource_class_id, storage_id_str, scope_id) keys"""
+        result = {}
+        keys = list(keys)
+        for i in range(0, len(keys), self.QUERY_BATCH_SIZE):
+            batch = keys[i:i + self.QUERY_BATCH_SIZE]
+            scope_ids = set(scope_id for resource_class_id, id_str, scope_id in batch)
+            scope_q = Q(storage_id_scope__in = [s for s in scope_ids if s is not None])
+            if None in scope_ids:
+                scope_q |= Q(storage_id_scope__isnull = True)
+            for record in StorageResourceRecord.objects.filter(scope_q,
+                                                               resource_class__in = set(key[0] for key in batch),
+                                                               storage_id_str__in = set(key[1] for key in batch)):
+                result[(record.resource_class_id, record.storage_id_str, record.storage_id_scope_id)] = record
+        return result
+
+    def _get_or_create_records(self, session, resources):
+        """Return a (record, created) pair for each of the resources, whose references must
+        already have records: existing records are looked up together, and missing ones
+        inserted together."""
+        from chroma_core.lib.storage_plugin.manager import storage_plugin_manager
+
+        keys = []
+        for resource in resources:
             if isinstance(resource._meta.identifier, BaseScopedId):
                 scope_id = session.scannable_id
             elif isinstance(resource._meta.identifier, BaseGlobalId):
@@ -1409,49 +1660,126 @@ class ResourceManager(object):
                 resource.__class__.__module__,
                 resource.__class__.__name__)
 
-            id_tuple = resource.id_tuple()
             cleaned_id_items = []
-            for t in id_tuple:
+            for t in resource.id_tuple():
                 if isinstance(t, BaseStorageResource):
                     cleaned_id_items.append(session.local_id_to_global_id[t._handle])
                 else:
                     cleaned_id_items.append(t)
 
-            id_str = json.dumps(tuple(cleaned_id_items))
+            keys.append((resource_class_id, json.dumps(tuple(cleaned_id_items)), scope_id))
 
-            record, created = StorageResourceRecord.objects.get_or_create(
-                resource_class_id = resource_class_id,
-                storage_id_str = id_str,
-                storage_id_scope_id = scope_id)
+        records = self._get_records(set(keys))
+        missing = set(key for key in keys if key not in records)
+        if missing:
+            with StorageResourceRecord.delayed as inserter:
+                for resource_class_id, id_str, scope_id in missing:
+                    inserter.insert(dict(
+                        resource_class_id = resource_class_id,
+                        storage_id_str = id_str,
+                        storage_id_scope_id = scope_id))
+            records.update(self._get_records(missing))
 
-            session.local_id_to_global_id[resource._handle] = record.pk
-            session.global_id_to_local_id[record.pk] = resource._handle
-            self._label_cache[record.id] = resource.get_label()
+        result = []
+        for key in keys:
+            # Where two resources have the same identity only the first creates the record
+            result.append((records[key], key in missing))
+            missing.discard(key)
+        return result
 
-            if created:
-                # Record a user-visible event
-                log.debug("ResourceManager._persist_new_resource[%s] %s %s %s" % (session.scannable_id, created, record.pk, resource._handle))
+    def _set_attributes(self, records_attrs):
+        """Write attributes given as a list of (record, created, {key: value}): the stored
+        attributes of existing records are fetched in one query per attribute model, and
+        only those which have changed are written."""
+        from chroma_core.lib.storage_plugin.manager import storage_plugin_manager
+
+        def value_field(attr_model_class):
+            return 'value' if issubclass(attr_model_class, StorageResourceAttributeSerialized) else 'value_id'
+
+        writes = defaultdict(list)
+        for record, created, attrs in records_attrs:
+            resource_class = storage_plugin_manager.get_resource_class_by_id(record.resource_class_id)
+            for key, val in attrs.items():
+                attr_model_class = resource_class.attr_model_class(key)
+                writes[attr_model_class].append((record, created, key, attr_model_class.encode(val)))
+
+        for attr_model_class, attr_writes in writes.items():
+            field = value_field(attr_model_class)
+            existing_ids = list(set(record.id for record, created, key, value in attr_writes if not created))
+            stored = defaultdict(list)
+            for i in range(0, len(existing_ids), self.QUERY_BATCH_SIZE):
+                for attr in attr_model_class.objects.filter(resource__in = existing_ids[i:i + self.QUERY_BATCH_SIZE]).values('id', 'resource_id', 'key', field):
+                    stored[(attr['resource_id'], attr['key'])].append((attr['id'], attr[field]))
+
+            with attr_model_class.delayed as writer:
+                for record, created, key, value in attr_writes:
+                    attrs = stored.get((record.id, key))
+                    if not attrs:
+                        writer.insert({'resource_id': record.id, 'key': key, field: value})
+                    else:
+                        for attr_id, stored_value in attrs:
+                            if stored_value != value:
+                                writer.update({'id': attr_id, field: value})
+
+    def _add_reported_by(self, session, records):
+        """Record that the scannable of the session reports each of the records, if not already"""
+        through = StorageResourceRecord.reported_by.through
+        reported = set()
+        existing_ids = [record.id for record, created in records if not created]
+        for i in range(0, len(existing_ids), self.QUERY_BATCH_SIZE):
+            reported.update(through.objects.filter(to_storageresourcerecord = session.scannable_id,
+                                                   from_storageresourcerecord__in = existing_ids[i:i + self.QUERY_BATCH_SIZE]).values_list('from_storageresourcerecord_id', flat = True))
+
+        links = []
+        for record, created in records:
+            if record.id not in reported:
+                log.debug("saw GlobalId resource %s from scope %s for the first time" % (record.id, session.scannable_id))
+                reported.add(record.id)
+                links.append(through(from_storageresourcerecord_id = record.id, to_storageresourcerecord_id = session.scannable_id))
+        through.objects.bulk_create(links)
+
+    def _persist_new_resources(self, session, resources):
+        from chroma_core.lib.storage_plugin.manager import storage_plugin_manager
+
+        # Must be run in a transaction to avoid leaving invalid things in the DB on failure.
+        assert transaction.is_managed()
 
-            creations[resource] = (record, created)
+        started = time.time()
+
+        # Create StorageResourceRecords for any resources which
+        # do not already have one, and update the local_id_to_global_id
+        # map with the DB ID for each resource.  This goes a level at a
+        # time because the IDs of resources depend on the global IDs of
+        # resources they reference.
+        ordered_for_creation = []
+        creations = {}
+        for level in self._order_for_creation(session, resources):
+            for resource, (record, created) in zip(level, self._get_or_create_records(session, level)):
+                session.local_id_to_global_id[resource._handle] = record.pk
+                session.global_id_to_local_id[record.pk] = resource._handle
+                self._label_cache[record.id] = resource.get_label()
 
-            # Add the new record to the index so that future records and resolve their
-            # provide/subscribe relationships with respect to it
-            self._subscriber_index.add_resource(record.pk, resource)
+                if created:
+                    # Record a user-visible event
+                    log.debug("ResourceManager._persist_new_resource[%s] %s %s %s" % (session.scannable_id, created, record.pk, resource._handle))
 
-            self._class_index.add_record(record.pk, resource_class)
+                creations[resource] = (record, created)
+                ordered_for_creation.append(resource)
+
+                # Add the new record to the index so that future records and resolve their
+                # provide/subscribe relationships with respect to it
+                self._subscriber_index.add_resource(record.pk, resource)
+
+                self._class_index.add_record(record.pk, storage_plugin_manager.get_resource_class_by_id(record.resource_class_id))
 
         # Update or create attribute records
-        attr_classes = set()
+        self._add_reported_by(session, [creations[resource] for resource in ordered_for_creation
+                                        if isinstance(resource._meta.identifier, BaseGlobalId) and session.scannable_id != creations[resource][0].id])
+
+        records_attrs = []
         for resource in ordered_for_creation:
             record, created = creations[resource]
 
-            if isinstance(resource._meta.identifier, BaseGlobalId) and session.scannable_id != record.id:
-                try:
-                    record.reported_by.get(pk = session.scannable_id)
-                except StorageResourceRecord.DoesNotExist:
-                    log.debug("saw GlobalId resource %s from scope %s for the first time" % (record.id, session.scannable_id))
-                    record.reported_by.add(session.scannable_id)
-
             resource_class = storage_plugin_manager.get_resource_class_by_id(record.resource_class_id)
 
             attrs = {}
@@ -1470,34 +1798,8 @@ class ResourceManager(object):
                 else:
                     attrs[key] = value
 
-            for key, val in attrs.items():
-                resource_class = storage_plugin_manager.get_resource_class_by_id(record.resource_class_id)
-
-                # Try to update an existing record
-                attr_model_class = resource_class.attr_model_class(key)
-
-                updated = attr_model_class.objects.filter(
-                    resource = record,
-                    key = key).update(value = attr_model_class.encode(val))
-
-                # If there was no existing record, create one
-                if not updated:
-                    attr_classes.add(attr_model_class)
-                    if issubclass(attr_model_class, StorageResourceAttributeSerialized):
-                        data = dict(
-                            resource_id = record.id,
-                            key = key,
-                            value = attr_model_class.encode(val))
-
-                    else:
-                        data = dict(
-                            resource_id = record.id,
-                            key = key,
-                            value_id = attr_model_class.encode(val))
-                    attr_model_class.delayed.insert(data)
-
-        for attr_model_class in attr_classes:
-            attr_model_class.delayed.flush()
+            records_attrs.append((record, created, attrs))
+        self._set_attributes(records_attrs)
 
         # Find out if new resources match anything in SubscriberIndex and create
         # relationships if so.
@@ -1559,10 +1861,18 @@ class ResourceManager(object):
                         Volume.objects.filter(storage_resource = descendent_ld).update(label = self.get_label(ld_id))
 
         # Create StorageResourceLearnEvent for anything we found new
+        host = None
         for resource in creations:
             record, created = creations[resource]
 
             if created and hasattr(session, 'host_id'):
+                if host is None:
+                    host = ManagedHost.objects.get(id=getattr(session, 'host_id'))
                 StorageResourceLearnEvent.register_event(severity=logging.INFO,
-                                                         alert_item=ManagedHost.objects.get(id=getattr(session, 'host_id')),
+                                                         alert_item=host,
                                                          storage_resource=record)
+
+        if ordered_for_creation:
+            elapsed = time.time() - started
+            log.info("ResourceManager._persist_new_resources[%s] persisted %s resources in %.3fs (%.1f/s)" % (
+                session.scannable_id, len(ordered_for_creation), elapsed, len(ordered_for_creation) / max(elapsed, 0.001)))
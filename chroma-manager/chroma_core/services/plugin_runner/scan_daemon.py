@@ -4,6 +4,8 @@
 
 
 import os
+import heapq
+import itertools
 import threading
 import datetime
 import time
@@ -11,6 +13,8 @@ import sys
 import traceback
 from django.db import transaction
 
+import settings
+
 from chroma_core.services.log import log_register
 from chroma_core.models.storage_plugin import StorageResourceRecord
 from chroma_core.models.storage_plugin import StorageResourceOffline
@@ -19,26 +23,160 @@ from chroma_core.models.storage_plugin import StorageResourceOffline
 log = log_register(__name__.split('.')[-1])
 
 
+class SessionScheduler(object):
+    """A bounded pool of threads which run the scans of plugin sessions as they fall due.
+
+    Sessions are anything with a `scan(due)` method which runs their next step, returning
+    the time their following step is due, or None once they have stopped, and a `stopping`
+    event.  A session is only ever scanned by one thread at a time, and scheduling a session
+    replaces any scan already scheduled for it.  A session which is stopped while it's being
+    scanned is scanned again straight away, so that its teardown isn't delayed.
+
+    Plugin calls have no timeout, so a scan which has run for more than `blocking` seconds is
+    left to the thread running it, which exits when the scan returns, and another worker is
+    started in its place: hung controllers don't stop the others being scanned.
+
+    """
+
+    def __init__(self, workers, blocking):
+        self._workers = workers
+        self._blocking = blocking
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        # Map of session to the sequence number of its entry in the queue
+        self._scheduled = {}
+        # Map of session being scanned to the time its scan started and the thread running it
+        self._running = {}
+        # Sessions whose scans were left to their threads, having run for too long
+        self._detached = set()
+        self._threads = []
+        self._watcher = None
+        # The watcher waits on this rather than the condition, so as not to take the workers' wakeups
+        self._watcher_stop = threading.Event()
+        self._stopping = False
+
+    def schedule(self, session, due):
+        with self._condition:
+            if not self._threads:
+                for n in range(self._workers):
+                    self._start_worker()
+                self._watcher = threading.Thread(target = self._watch, name = "SessionScheduler-watch")
+                self._watcher.daemon = True
+                self._watcher.start()
+            self._schedule(session, due)
+
+    def wake(self, session):
+        """Scan a session now, unless it's being scanned already"""
+        with self._condition:
+            if session not in self._running:
+                self._schedule(session, time.time())
+
+    def stop(self):
+        """Stop the workers, once the scans already due have run.  Threads left running
+        blocked scans aren't waited for."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            threads = list(self._threads)
+        self._watcher_stop.set()
+        for thread in threads:
+            thread.join()
+        if self._watcher:
+            self._watcher.join()
+
+    def _start_worker(self):
+        thread = threading.Thread(target = self._work, name = "SessionScheduler-%s" % len(self._threads))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _schedule(self, session, due):
+        sequence = next(self._sequence)
+        self._scheduled[session] = sequence
+        heapq.heappush(self._queue, (due, sequence, session))
+        self._condition.notify()
+
+    def _take(self):
+        """Return the earliest entry which is due, discarding those which have been replaced"""
+        now = time.time()
+        while self._queue and self._queue[0][0] <= now:
+            due, sequence, session = heapq.heappop(self._queue)
+            if self._scheduled.get(session) == sequence:
+                del self._scheduled[session]
+                return due, session
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                entry = self._take()
+                while entry is None:
+                    if self._stopping:
+                        return
+                    self._condition.wait(self._queue[0][0] - time.time() if self._queue else None)
+                    entry = self._take()
+                due, session = entry
+                self._running[session] = (time.time(), threading.current_thread())
+
+            next_due = session.scan(due)
+
+            with self._condition:
+                del self._running[session]
+                if next_due is not None and session not in self._scheduled:
+                    if session.stopping.is_set():
+                        next_due = time.time()
+                    self._schedule(session, next_due)
+                if session in self._detached:
+                    # Another worker has taken this one's place
+                    self._detached.remove(session)
+                    return
+
+    def _watch(self):
+        """Replace the workers of scans which have run for too long"""
+        while not self._watcher_stop.wait(self._blocking / 2.0):
+            with self._condition:
+                now = time.time()
+                for session, (started, thread) in self._running.items():
+                    if session not in self._detached and now - started > self._blocking:
+                        log.warning("Scan on %s has run for %ds, starting another worker" % (thread.name, now - started))
+                        self._detached.add(session)
+                        self._threads.remove(thread)
+                        self._start_worker()
+
+
 class ScanDaemon(object):
     """
-    This class manages a set of threads, one per `ScannableResource` that periodically invoke
+    This class manages a set of sessions, one per `ScannableResource`, which periodically invoke
     the callbacks of the plugin associated with the resource.  Typically those callbacks perform
     some network I/O to interrogate the state of the resource.
 
     For example, if you have a plugin called MyPlugin which has a MyController class that inherits
     from ScannableResource, and the user has created an instance of the MyController class, then
-    this class creates a thread for that instance of MyController, and invokes the
+    this class creates a session for that instance of MyController, and invokes the
     MyPlugin.[initial_scan, update_scan, teardown] functions for that instance.
 
+    Sessions are run by a SessionScheduler, with their updates spread over their update period
+    rather than all falling due together.  New ScannableResources are started when `add_resource`
+    is called for them, and the records are only searched for any which were missed every
+    `settings.STORAGE_PLUGIN_RECONCILE_PERIOD` seconds.
+
     Creates a plugin instance for each ScannableResource.
 
     """
+    # Seconds for which add_resource waits for a new record to become visible
+    ADD_RESOURCE_TIMEOUT = 10
+    # Seconds for which a removed or modified resource's session is waited for to stop
+    KILL_TIMEOUT = 10
+
     def __init__(self, resource_manager):
         self.stopping = False
 
         self._resource_manager = resource_manager
         self._session_lock = threading.Lock()
         self._all_sessions = {}
+        self._scheduler = SessionScheduler(settings.STORAGE_PLUGIN_SCAN_WORKERS, settings.STORAGE_PLUGIN_SCAN_BLOCKING)
+        self._reconcile = threading.Event()
         # Map of module name to map of root_resource_id to PluginSession
         self.plugins = {}
         from chroma_core.lib.storage_plugin.manager import storage_plugin_manager
@@ -46,7 +184,7 @@ class ScanDaemon(object):
             # Create sessions for all root resources
             sessions = {}
             for srr_id in self.root_resource_ids(p):
-                session = PluginSession(self._resource_manager, srr_id)
+                session = PluginSession(self._resource_manager, srr_id, self._scheduler)
                 sessions[srr_id] = session
                 self._all_sessions[srr_id] = session
 
@@ -55,44 +193,71 @@ class ScanDaemon(object):
         session_count = reduce(lambda x, y: x + y, [len(s) for s in self.plugins.values()])
         log.info("Loaded %s plugins, %s sessions" % (len(self.plugins), session_count))
 
+    def _kill_session(self, resource_id):
+        try:
+            kill_session = self._all_sessions.pop(resource_id)
+        except KeyError:
+            pass
+        else:
+            for plugin, sessions in self.plugins.items():
+                if resource_id in sessions:
+                    del sessions[resource_id]
+
+            kill_session.stop()
+            log.info("waiting for session to stop")
+            # A session whose plugin is hung is left to stop when its scan returns
+            if kill_session.wait_stopped(self.KILL_TIMEOUT):
+                log.info("stopped.")
+            else:
+                log.warning("Session %s did not stop within %ss, leaving it to stop in the background" % (
+                    resource_id, self.KILL_TIMEOUT))
+
+    def _start_session(self, plugin, resource_id):
+        log.info("new session for resource %s" % resource_id)
+        session = PluginSession(self._resource_manager, resource_id, self._scheduler)
+        self.plugins[plugin][resource_id] = session
+        self._all_sessions[resource_id] = session
+        self._scheduler.schedule(session, time.time())
+
+    def add_resource(self, resource_id):
+        """Start a session for a newly created ScannableResource without waiting for
+        the next reconciliation"""
+        log.info("adding %s" % resource_id)
+        # The record may not be visible yet if its creator has not committed
+        timeout = time.time() + self.ADD_RESOURCE_TIMEOUT
+        while not self.stopping:
+            with self._session_lock:
+                if resource_id in self._all_sessions:
+                    return
+                for plugin in self.plugins.keys():
+                    if resource_id in self.root_resource_ids(plugin):
+                        self._start_session(plugin, resource_id)
+                        return
+
+            if time.time() > timeout:
+                log.warning("Resource %s not found, leaving it to reconciliation" % resource_id)
+                self._reconcile.set()
+                return
+            time.sleep(1)
+
     def modify_resource(self, resource_id, attrs):
         log.info("modifying %s" % resource_id)
         with self._session_lock:
-            try:
-                kill_session = self._all_sessions[resource_id]
-            except KeyError:
-                pass
-            else:
-                kill_session.stop()
-                log.info("waiting for session to stop")
-                while(not kill_session.stopped):
-                    time.sleep(1)
-                log.info("stopped.")
-                for plugin, sessions in self.plugins.items():
-                    if resource_id in sessions:
-                        del sessions[resource_id]
-                del self._all_sessions[resource_id]
+            self._kill_session(resource_id)
 
             record = StorageResourceRecord.objects.get(pk = resource_id)
             record.update_attributes(attrs)
             record.save()
 
+        # Start a new session with the modified attributes
+        self._reconcile.set()
         log.info("finished removing %s" % resource_id)
 
     def remove_resource(self, resource_id):
         # Is there a session to kill?
         log.info("removing %s" % resource_id)
         with self._session_lock:
-            try:
-                kill_session = self._all_sessions[resource_id]
-            except KeyError:
-                pass
-            else:
-                kill_session.stop()
-                log.info("waiting for session to stop")
-                while(not kill_session.stopped):
-                    time.sleep(1)
-                log.info("stopped.")
+            self._kill_session(resource_id)
 
             self._resource_manager.global_remove_resource(resource_id)
         log.info("finished removing %s" % resource_id)
@@ -109,22 +274,24 @@ class ScanDaemon(object):
 
     def run(self):
         log.info("entering main loop")
-        for scannable_id, session in self._all_sessions.items():
-            session.start()
+        # Spread the sessions' first scans, and so their updates, over an update period
+        started = time.time()
+        sessions = self._all_sessions.values()
+        for n, session in enumerate(sessions):
+            self._scheduler.schedule(session, started + settings.PLUGIN_DEFAULT_UPDATE_PERIOD * n / float(len(sessions)))
 
         while not self.stopping:
-            time.sleep(5)
+            self._reconcile.wait(settings.STORAGE_PLUGIN_RECONCILE_PERIOD)
+            self._reconcile.clear()
+            if self.stopping:
+                break
 
             # Look for any new root resources and start sessions for them
             with self._session_lock:
                 for plugin, sessions in self.plugins.items():
                     for rrid in self.root_resource_ids(plugin):
                         if not rrid in sessions:
-                            log.info("new session for resource %s" % rrid)
-                            s = PluginSession(self._resource_manager, rrid)
-                            sessions[rrid] = s
-                            self._all_sessions[rrid] = s
-                            s.start()
+                            self._start_session(plugin, rrid)
 
         log.info("leaving main loop")
 
@@ -138,92 +305,125 @@ class ScanDaemon(object):
             session.stop()
         log.info("joining sessions")
         for scannable_id, session in self._all_sessions.items():
-            session.join(timeout = JOIN_TIMEOUT)
-            if session.isAlive():
+            if not session.wait_stopped(timeout = JOIN_TIMEOUT):
                 log.warning("session failed to return in %s seconds, forcing exit" % JOIN_TIMEOUT)
                 os._exit(-1)
+        self._scheduler.stop()
         log.info("stop sessions done")
 
     def stop(self):
         self.stopping = True
+        self._reconcile.set()
+
 
+class PluginSession(object):
+    """The scans of a ScannableResource by an instance of its plugin: an initial scan,
+    then periodic updates until it is stopped, when the instance is torn down.  If any
+    of these fail the instance is torn down, and a new one started after a delay."""
 
-class PluginSession(threading.Thread):
-    def __init__(self, resource_manager, root_resource_id, *args, **kwargs):
+    RETRY_DELAY_MIN = 1
+    RETRY_DELAY_MAX = 256
+
+    def __init__(self, resource_manager, root_resource_id, scheduler):
         self._resource_manager = resource_manager
+        self._scheduler = scheduler
         self.stopped = False
+        self._stopped = threading.Event()
         self.stopping = threading.Event()
         self.root_resource_id = root_resource_id
         self.initialized = False
 
-        super(PluginSession, self).__init__(*args, **kwargs)
+        self._record = None
+        self._plugin_klass = None
+        self._instance = None
+        self._first_update = True
+        self._last_retry = None
+        self._retry_delay = self.RETRY_DELAY_MIN
+
+    def scan(self, due):
+        """Run the next step of the session, returning when the following one is due,
+        or None once the session has stopped"""
+        if self.stopping.is_set():
+            if self._instance:
+                try:
+                    self._teardown()
+                except Exception:
+                    log.warning("Exception tearing down session %s: %s" % (self.root_resource_id, traceback.format_exc()))
+            log.info("Session %s: Dropped out of retry loop" % self.root_resource_id)
+            self.stopped = True
+            self._stopped.set()
+            return None
 
-    def run(self):
-        from chroma_core.lib.storage_plugin.manager import storage_plugin_manager
-        record = StorageResourceRecord.objects.get(id=self.root_resource_id)
-        plugin_klass = storage_plugin_manager.get_plugin_class(
-                          record.resource_class.storage_plugin.module_name)
-
-        RETRY_DELAY_MIN = 1
-        RETRY_DELAY_MAX = 256
-        retry_delay = RETRY_DELAY_MIN
-        while not self.stopping.is_set():
-            last_retry = datetime.datetime.now()
-            try:
-                # Note: get a fresh root_resource each time as the Plugin
-                # instance will modify it.
-                self._scan_loop(plugin_klass, record)
-            except Exception:
-                run_duration = datetime.datetime.now() - last_retry
-                if last_retry and run_duration > datetime.timedelta(seconds = RETRY_DELAY_MAX):
-                    # If the last run was long running (i.e. probably ran okay until something went
-                    # wrong) then retry quickly.
-                    retry_delay = RETRY_DELAY_MIN
-                else:
-                    # If we've already retried recently, then start backing off.
-                    retry_delay *= 2
-
-                log.warning("Exception in scan loop for resource %s, waiting %ss before restart" % (self.root_resource_id, retry_delay))
-                exc_info = sys.exc_info()
-                backtrace = '\n'.join(traceback.format_exception(*(exc_info or sys.exc_info())))
-                log.warning("Backtrace: %s" % backtrace)
-
-                # Wait either retry_delay, or until stopping is set, whichever comes sooner
-                self.stopping.wait(timeout = retry_delay)
+        try:
+            if self._instance is None:
+                self._start()
+
+            log.debug("Session %s: >>periodic_update (%s)" % (self.root_resource_id, self._instance.update_period))
+            self._instance.do_periodic_update()
+            if self._first_update:
+                # NB don't mark something as online until the first update has completed, to avoid
+                # flapping if something has a working initial_scan and a failing update_scan
+                StorageResourceOffline.notify(self._record, False)
+                self._first_update = False
+
+            log.debug("Session %s: <<periodic_update" % self.root_resource_id)
+
+            # Keep to the period from when the update was due, so that sessions stay spread out
+            return max(due + self._instance.update_period, time.time())
+        except Exception:
+            run_duration = datetime.datetime.now() - self._last_retry if self._last_retry else None
+            if run_duration and run_duration > datetime.timedelta(seconds = self.RETRY_DELAY_MAX):
+                # If the last run was long running (i.e. probably ran okay until something went
+                # wrong) then retry quickly.
+                self._retry_delay = self.RETRY_DELAY_MIN
             else:
-                log.info("Session %s: out of scan loop cleanly" % self.root_resource_id)
+                # If we've already retried recently, then start backing off.
+                self._retry_delay *= 2
+
+            log.warning("Exception in scan loop for resource %s, waiting %ss before restart" % (self.root_resource_id, self._retry_delay))
+            exc_info = sys.exc_info()
+            backtrace = '\n'.join(traceback.format_exception(*(exc_info or sys.exc_info())))
+            log.warning("Backtrace: %s" % backtrace)
+
+            if self._instance:
+                try:
+                    self._teardown()
+                except Exception:
+                    log.warning("Exception tearing down session %s: %s" % (self.root_resource_id, traceback.format_exc()))
 
-        log.info("Session %s: Dropped out of retry loop" % self.root_resource_id)
-        self.stopped = True
+            return time.time() + self._retry_delay
 
-    def _scan_loop(self, plugin_klass, record):
+    def _start(self):
+        from chroma_core.lib.storage_plugin.manager import storage_plugin_manager
+
+        if self._record is None:
+            self._record = StorageResourceRecord.objects.get(id=self.root_resource_id)
+            self._plugin_klass = storage_plugin_manager.get_plugin_class(
+                self._record.resource_class.storage_plugin.module_name)
+
+        self._last_retry = datetime.datetime.now()
         log.debug("Session %s: starting scan loop" % self.root_resource_id)
-        instance = plugin_klass(self._resource_manager, self.root_resource_id)
         # TODO: impose timeouts on plugin calls (especially teardown)
+        self._instance = self._plugin_klass(self._resource_manager, self.root_resource_id)
+        self._first_update = True
+        log.debug("Session %s: >>initial_scan" % self.root_resource_id)
+        self._instance.do_initial_scan()
+        self.initialized = True
+        log.debug("Session %s: <<initial_scan" % self.root_resource_id)
+
+    def _teardown(self):
+        instance = self._instance
+        self._instance = None
         try:
-            log.debug("Session %s: >>initial_scan" % self.root_resource_id)
-            instance.do_initial_scan()
-            self.initialized = True
-            log.debug("Session %s: <<initial_scan" % self.root_resource_id)
-            first_update = True
-            while not self.stopping.is_set():
-                log.debug("Session %s: >>periodic_update (%s)" % (self.root_resource_id, instance.update_period))
-                instance.do_periodic_update()
-                if first_update:
-                    # NB don't mark something as online until the first update has completed, to avoid
-                    # flapping if something has a working initial_scan and a failing update_scan
-                    StorageResourceOffline.notify(record, False)
-                    first_update = False
-
-                log.debug("Session %s: <<periodic_update" % self.root_resource_id)
-
-                self.stopping.wait(instance.update_period)
-        except Exception:
-            raise
+            StorageResourceOffline.notify(self._record, True)
         finally:
-            StorageResourceOffline.notify(record, True)
             self.initialized = False
             instance.do_teardown()
 
     def stop(self):
         self.stopping.set()
+        self._scheduler.wake(self)
+
+    def wait_stopped(self, timeout = None):
+        self._stopped.wait(timeout)
+        return self._stopped.is_set()
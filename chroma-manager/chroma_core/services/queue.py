@@ -7,14 +7,25 @@
 around an AMQP queue."""
 
 
+import uuid
+import socket
 import threading
 
+import kombu.pools
+from kombu.messaging import Exchange, Queue
+
 from chroma_core.services import _amqp_connection
 from chroma_core.services.log import log_register
 
 
 log = log_register('queue')
 
+# publishing waits this long for the broker to come back, reconnecting on pooled connections
+RETRY_POLICY = {'interval_start': 0, 'interval_step': 1, 'interval_max': 5, 'max_retries': 30}
+
+# payload key of messages which only wake up a consumer that is stopping
+WAKEUP = '__wakeup__'
+
 
 class ServiceQueue(object):
     """Simple FIFO queue, multiple senders, single receiver.  Payloads
@@ -33,14 +44,31 @@ class ServiceQueue(object):
 
         AcmeQueue().put({'foo': 'bar'})
 
+    Example receiving from a queue, in batches of messages which have already arrived:
+    ::
+
+        AcmeQueue().serve(batch_callback = lambda bodies: ...)
+
     """
     name = None
+    prefetch_count = 100
+    batch_wait = 0.01  # seconds to wait for further messages once one has arrived
+
+    def _queue(self):
+        "Return the same exchange and queue as a SimpleQueue declares."
+        return Queue(self.name, Exchange(self.name, 'direct', durable = False), self.name, durable = False)
 
     def put(self, body):
-        with _amqp_connection() as conn:
-            q = conn.SimpleQueue(self.name, serializer = 'json',
-                                 exchange_opts={'durable': False}, queue_opts={'durable': False})
-            q.put(body)
+        self.put_many([body])
+
+    def put_many(self, bodies, retry = True):
+        """Send payloads in order, using a producer from the per-process pool so that connections and
+        channels are kept open between calls, and the queue is only declared once per channel."""
+        queue = self._queue()
+        with kombu.pools.producers[_amqp_connection()].acquire(block = True) as producer:
+            for body in bodies:
+                producer.publish(body, serializer = 'json', exchange = queue.exchange, routing_key = self.name,
+                                 declare = [queue], retry = retry, retry_policy = RETRY_POLICY)
 
     def purge(self):
         with _amqp_connection() as conn:
@@ -50,26 +78,52 @@ class ServiceQueue(object):
 
     def __init__(self):
         self._stopping = threading.Event()
+        self._wakeup = None
 
     def stop(self):
         log.info("Stopping ServiceQueue %s" % self.name)
         self._stopping.set()
+        if self._wakeup is not None:
+            try:
+                self.put_many([{WAKEUP: self._wakeup}], retry = False)
+            except Exception as e:
+                log.warning("Failed to wake up consumer of '%s': %s" % (self.name, e))
+
+    def serve(self, callback = None, batch_callback = None):
+        """Call `callback` with each payload received until stopped, or `batch_callback` with lists of
+        the payloads of up to `prefetch_count` messages which arrived together.  Messages are acknowledged
+        before being passed on.
+
+        Waits on messages rather than polling, and is woken up by a message from `stop`.
+        """
+        if (callback is None) == (batch_callback is None):
+            raise AssertionError('Set exactly one callback')
 
-    def serve(self, callback):
-        from Queue import Empty as QueueEmpty
+        received = []
         with _amqp_connection() as conn:
-            q = conn.SimpleQueue(self.name, serializer = 'json',
-                                 exchange_opts={'durable': False}, queue_opts={'durable': False})
-            # FIXME: it would be preferable to avoid waking up so often: really what is wanted
-            # here is to sleep on messages or a stop event.
-            while not self._stopping.is_set():
-                try:
-                    message = q.get(timeout = 1)
-                    message.ack()
-                    message = message.decode()
-                    callback(message)
-                except QueueEmpty:
-                    pass
+            with conn.Consumer([self._queue()], callbacks = [lambda body, message: received.append((body, message))],
+                               accept = ['json']) as consumer:
+                consumer.qos(prefetch_count = self.prefetch_count)
+                self._wakeup = uuid.uuid4().hex
+                while not self._stopping.is_set():
+                    conn.drain_events()
+                    while len(received) < self.prefetch_count:
+                        try:
+                            conn.drain_events(timeout = self.batch_wait)
+                        except socket.timeout:
+                            break
+                    for body, message in received:
+                        message.ack()
+                    # wake up messages of previous consumers are stale, and dropped too
+                    bodies = [body for body, message in received if not (isinstance(body, dict) and WAKEUP in body)]
+                    del received[:]
+                    if batch_callback is not None:
+                        if bodies:
+                            batch_callback(bodies)
+                    else:
+                        for body in bodies:
+                            callback(body)
+                self._wakeup = None
 
 
 class AgentRxQueue(ServiceQueue):
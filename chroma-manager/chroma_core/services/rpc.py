@@ -22,7 +22,10 @@ import django
 import errno
 import os
 import time
+import heapq
+import itertools
 import jsonschema
+from collections import defaultdict
 
 from django.db import transaction
 import kombu
@@ -68,6 +71,21 @@ LIGHTWEIGHT_CONNECTIONS_LIMIT = 10
 
 RESPONSE_CONN_LIMIT = 10
 
+"""
+Number of threads running the incoming RPCs of a service, other than those of methods
+in a concurrency class without a limit
+
+"""
+RPC_WORKERS = 75
+
+# Priorities of RPC methods: calls waiting for a worker are run lowest first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Answered by every RpcServer, with the figures of its RpcDispatcher
+RPC_STATS_METHOD = 'get_rpc_stats'
+
 tx_connections = None
 rx_connections = None
 lw_connections = None
@@ -91,12 +109,9 @@ class RpcTimeout(Exception):
 
 
 class RunOneRpc(threading.Thread):
-    """Handle a single incoming RPC in a new thread, and send the
-    response (result or exception) from the execution thread."""
-
-    _outstanding = 0
-    _throttle_limit = 75
-    _throttled_locks = []
+    """Handle a single incoming RPC, and send the response (result or exception).
+    Run by a worker of an RpcDispatcher, or in a new thread for methods without a
+    concurrency limit."""
 
     def __init__(self, rpc, body, response_conn_pool):
         super(RunOneRpc, self).__init__()
@@ -105,21 +120,7 @@ class RunOneRpc(threading.Thread):
         self._response_conn_pool = response_conn_pool
 
     def run(self):
-        # We do not throttle rpcs that do not hit the database.
-        rpc_throttle = self.body['method'] not in ['wait_table_change']
-
         try:
-            if rpc_throttle:
-                if RunOneRpc._outstanding > RunOneRpc._throttle_limit:
-                    rpc_complete_event = threading.Event()
-                    RunOneRpc._throttled_locks.append(rpc_complete_event)
-                    log.info("_throttled_locks: '%s'" % RunOneRpc._throttled_locks)
-                    log.info("Throttled rpc to %s throttled rpcs=%s" % (self.body['method'], len(RunOneRpc._throttled_locks)))
-                    rpc_complete_event.wait()
-                    log.info("Released rpc to %s throttled rpcs=%s" % (self.body['method'], len(RunOneRpc._throttled_locks)))
-
-                RunOneRpc._outstanding += 1
-
             result = {
                 'result': self.rpc._local_call(self.body['method'], *self.body['args'], **self.body['kwargs']),
                 'request_id': self.body['request_id'],
@@ -148,16 +149,7 @@ class RunOneRpc(threading.Thread):
             }
             log.error("RunOneRpc: exception calling %s: %s" % (self.body['method'], backtrace))
         finally:
-            try:
-                if rpc_throttle:
-                    try:
-                        rpc_complete_event = RunOneRpc._throttled_locks.pop(0)
-                        rpc_complete_event.set()
-                    except IndexError:
-                        pass
-                    RunOneRpc._outstanding -= 1
-            finally:
-                django.db.connection.close()
+            django.db.connection.close()
 
         with self._response_conn_pool[_amqp_connection()].acquire(block=True) as connection:
             with Producer(connection) as producer:
@@ -165,12 +157,152 @@ class RunOneRpc(threading.Thread):
                 producer.publish(result, serializer="json", routing_key=self.body['response_routing_key'], delivery_mode = 1, immedate = True, mandatory = True)
 
 
+class RpcMethodStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.queued = 0
+        self.running = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.service_time = 0.0
+        self.max_service_time = 0.0
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class RpcDispatcher(object):
+    """Run the incoming RPCs of a ServiceRpcInterface on a bounded pool of worker threads.
+
+    Calls waiting for a worker are taken in order of their method's priority, then of arrival,
+    so that cheap queries don't queue behind heavy operations.  No more calls of the methods
+    of a concurrency class run at once than its limit, calls beyond that waiting aside while
+    others run.  Methods of a class without a limit run each call in a thread of its own,
+    outside the pool: that is for calls which spend their time waiting, such as long polls.
+
+    The number of calls, queue depth, and wait and service times are kept for each method.
+
+    """
+
+    def __init__(self, rpc, workers, response_conn_pool):
+        self._rpc = rpc
+        self._workers = workers
+        self._response_conn_pool = response_conn_pool
+        self._condition = threading.Condition()
+        self._ready = []
+        self._waiting = defaultdict(list)
+        self._running = defaultdict(int)
+        self._sequence = itertools.count()
+        self._threads = []
+        self._stopping = False
+        self._stats = defaultdict(RpcMethodStats)
+
+    def submit(self, body):
+        method = body['method']
+        concurrency_class = self._rpc.get_concurrency_class(method)
+        queued_at = time.time()
+        with self._condition:
+            self._stats[method].queued += 1
+
+            if concurrency_class is not None and self._rpc.concurrency_classes[concurrency_class] is None:
+                threading.Thread(target = self._run, args = (body, queued_at)).start()
+                return
+
+            if not self._threads:
+                for n in range(self._workers):
+                    thread = threading.Thread(target = self._work, name = "RpcDispatcher-%s" % n)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+            heapq.heappush(self._ready, (self._rpc.get_priority(method), next(self._sequence), queued_at, concurrency_class, body))
+            self._condition.notify()
+
+    def stop(self):
+        """Stop the workers, once the calls submitted have been run"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        with self._condition:
+            return {'workers': len(self._threads),
+                    'ready': len(self._ready),
+                    'waiting': dict((concurrency_class, len(entries)) for concurrency_class, entries in self._waiting.items()),
+                    'running': dict(self._running),
+                    'methods': dict((method, stats.to_dict()) for method, stats in self._stats.items())}
+
+    def _take(self):
+        """Return the first ready call whose concurrency class isn't at its limit, setting aside those which are"""
+        while self._ready:
+            entry = heapq.heappop(self._ready)
+            concurrency_class = entry[3]
+            if concurrency_class is None or self._running.get(concurrency_class, 0) < self._rpc.concurrency_classes[concurrency_class]:
+                return entry
+            heapq.heappush(self._waiting[concurrency_class], entry)
+        return None
+
+    def _release(self, concurrency_class):
+        self._running[concurrency_class] -= 1
+        if not self._running[concurrency_class]:
+            del self._running[concurrency_class]
+        waiting = self._waiting.get(concurrency_class)
+        if waiting:
+            heapq.heappush(self._ready, heapq.heappop(waiting))
+            if not waiting:
+                del self._waiting[concurrency_class]
+            self._condition.notify()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                entry = self._take()
+                while entry is None:
+                    if self._stopping:
+                        return
+                    self._condition.wait()
+                    entry = self._take()
+                priority, sequence, queued_at, concurrency_class, body = entry
+                if concurrency_class is not None:
+                    self._running[concurrency_class] += 1
+
+            self._run(body, queued_at)
+
+            if concurrency_class is not None:
+                with self._condition:
+                    self._release(concurrency_class)
+
+    def _run(self, body, queued_at):
+        stats = self._stats[body['method']]
+        started_at = time.time()
+        with self._condition:
+            stats.queued -= 1
+            stats.running += 1
+            stats.wait_time += started_at - queued_at
+            stats.max_wait_time = max(stats.max_wait_time, started_at - queued_at)
+
+        try:
+            RunOneRpc(self._rpc, body, self._response_conn_pool).run()
+        except Exception:
+            # RunOneRpc sends exceptions from the call in its response: this is a failure to send that
+            import traceback
+            log.error("RpcDispatcher: exception running %s: %s" % (body['method'], traceback.format_exc()))
+        finally:
+            service_time = time.time() - started_at
+            with self._condition:
+                stats.calls += 1
+                stats.running -= 1
+                stats.service_time += service_time
+                stats.max_service_time = max(stats.max_service_time, service_time)
+
+
 class RpcServer(ConsumerMixin):
     def __init__(self, rpc, connection, service_name, serialize = False):
         """
         :param rpc: A ServiceRpcInterface instance
         :param serialize: If True, then process RPCs one after another in a single thread
-        rather than running a thread for each RPC.
+        rather than on a pool of `rpc.rpc_workers` threads.
         """
         super(RpcServer, self).__init__()
         self.serialize = serialize
@@ -179,6 +311,7 @@ class RpcServer(ConsumerMixin):
         self.queue_name = service_name
         self.request_routing_key = "%s.requests" % self.queue_name
         self._response_conn_pool = kombu.pools.Connections(limit = RESPONSE_CONN_LIMIT)
+        self.dispatcher = RpcDispatcher(rpc, 1 if serialize else rpc.rpc_workers, self._response_conn_pool)
 
     def get_consumers(self, Consumer, channel):
         return [Consumer(
@@ -195,7 +328,7 @@ class RpcServer(ConsumerMixin):
             # breaks our faith in request_id and response_routing_key
             log.error("Invalid RPC body: %s" % e)
         else:
-            RunOneRpc(self.rpc, body, self._response_conn_pool).start()
+            self.dispatcher.submit(body)
 
     def stop(self):
         self.should_stop = True
@@ -538,8 +671,20 @@ class ServiceRpcInterface(object):
 
         FooRpc().functionality()
 
+    Incoming calls are run on a pool of `rpc_workers` threads, taking waiting calls in order
+    of the priorities in `method_priorities` (PRIORITY_NORMAL by default).  Methods named in
+    `method_concurrency_classes` are limited to the number of calls of their class given in
+    `concurrency_classes` running at once, or with a limit of None run each call in a thread
+    of its own.  The call, queue and timing figures of each method are returned by the
+    `get_rpc_stats` method of every interface.
+
     """
 
+    rpc_workers = RPC_WORKERS
+    method_priorities = {}
+    concurrency_classes = {}
+    method_concurrency_classes = {}
+
     def __init__(self, wrapped = None):
         self.worker = None
         self.wrapped = wrapped
@@ -551,7 +696,7 @@ class ServiceRpcInterface(object):
                 getattr(wrapped, method)
 
     def __getattr__(self, name):
-        if name in self.methods:
+        if name in self.methods or name == RPC_STATS_METHOD:
             return lambda *args, **kwargs: self._call(name, *args, **kwargs)
         else:
             raise AttributeError(name)
@@ -599,8 +744,18 @@ class ServiceRpcInterface(object):
 
             return result['result']
 
+    def get_priority(self, fn_name):
+        if fn_name == RPC_STATS_METHOD:
+            return PRIORITY_HIGH
+        return self.method_priorities.get(fn_name, PRIORITY_NORMAL)
+
+    def get_concurrency_class(self, fn_name):
+        return self.method_concurrency_classes.get(fn_name)
+
     def _local_call(self, fn_name, *args, **kwargs):
         log.debug("_local_call: %s %s %s" % (fn_name, args, kwargs))
+        if fn_name == RPC_STATS_METHOD:
+            return self.worker.dispatcher.stats()
         assert (fn_name in self.methods)
         fn = getattr(self.wrapped, fn_name)
         return fn(*args, **kwargs)
@@ -609,6 +764,7 @@ class ServiceRpcInterface(object):
         with _amqp_connection() as connection:
             self.worker = RpcServer(self, connection, self.__class__.__name__)
             self.worker.run()
+            self.worker.dispatcher.stop()
 
     def stop(self):
         # self.worker could be None if thread stopped before run() gets to the point of setting it
@@ -3,34 +3,88 @@
 # license that can be found in the LICENSE file.
 
 
+import time
+import Queue
+import signal
+import threading
 import traceback
+import collections
+import multiprocessing
 from django import db
-from django.utils import dateparse
+import settings
 from chroma_core.models import Stats
-from chroma_core.services import ChromaService, log_register, queue
+from chroma_core.models.stats import to_datetime, to_timestamp
+from chroma_core.services import ChromaService, ServiceThread, log_register, queue
 
 
 log = log_register(__name__)
 
 
 class StatsQueue(queue.ServiceQueue):
+    """Samples partitioned by series id into STATS_WORKERS shards, each with its own queue,
+    so that every series is only ever inserted by the same worker."""
     name = 'stats'
 
+    def __init__(self, shard=0):
+        super(StatsQueue, self).__init__()
+        if shard:
+            self.name = '{0}_{1:d}'.format(StatsQueue.name, shard)
+
     def put(self, samples):
-        queue.ServiceQueue.put(self, [(id, str(dt), value) for id, dt, value in samples])
+        shards = collections.defaultdict(list)
+        for id, dt, value in samples:
+            shards[id % settings.STATS_WORKERS].append((id, to_timestamp(dt), value))
+        sent = time.time()
+        for shard, samples in shards.items():
+            queue.ServiceQueue.put(StatsQueue(shard), {'sent': sent, 'samples': samples})
 
 
-class Service(ChromaService):
-    def run(self):
-        super(Service, self).run()
+class StatsInserter(object):
+    """Insert received messages in batches, coalescing all messages received within STATS_BATCH_WINDOW
+    seconds, up to STATS_BATCH_SIZE samples, into a single insert."""
+    LAG_WARNING = 60  # seconds between sending and inserting samples
 
-        self.queue = StatsQueue()
-        self.queue.purge()
-        self.queue.serve(callback=self.insert)
+    def __init__(self, inserted=None):
+        # bounded, so that inserts falling behind hold up receiving rather than fill memory
+        self.messages = Queue.Queue(settings.STATS_QUEUE_SIZE)
+        self.inserted = inserted  # optional shared counter of samples
+
+    def put(self, message):
+        self.messages.put(message)
+
+    def batches(self):
+        "Generate lists of messages, until stopped."
+        while True:
+            message = self.messages.get()
+            if message is None:
+                return
+            batch, count = [message], len(message['samples'])
+            deadline = time.time() + settings.STATS_BATCH_WINDOW
+            while count < settings.STATS_BATCH_SIZE:
+                try:
+                    message = self.messages.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                if message is None:
+                    yield batch
+                    return
+                batch.append(message)
+                count += len(message['samples'])
+            yield batch
+
+    def run(self):
+        for batch in self.batches():
+            self.insert(batch)
+        db.connection.close()
 
-    def insert(self, samples):
+    def insert(self, messages):
+        # samples of a series may arrive more than once, and must be in time order
+        samples = dict(((id, ts), value) for message in messages for id, ts, value in message['samples'])
+        samples = [(id, to_datetime(ts), samples[id, ts]) for id, ts in sorted(samples, key=lambda key: key[1])]
+        started = time.time()
+        lag = started - min(message['sent'] for message in messages)
         try:
-            outdated = Stats.insert((id, dateparse.parse_datetime(dt), value) for id, dt, value in samples)
+            outdated = Stats.insert(samples)
         except db.IntegrityError:
             log.error("Duplicate stats insert: " + db.connection.queries[-1]['sql'])
             db.transaction.rollback()  # allow future stats to still work
@@ -39,8 +93,100 @@ class Service(ChromaService):
         else:
             if outdated:
                 log.warn("Outdated samples ignored: {0}".format(outdated))
+            if self.inserted is not None:
+                with self.inserted.get_lock():
+                    self.inserted.value += len(samples) - len(outdated)
+            log.debug("Inserted {0} samples from {1} messages in {2:.3f}s, {3:.1f}s after sending".format(
+                len(samples), len(messages), time.time() - started, lag))
+            if lag > self.LAG_WARNING:
+                log.warn("Stats inserts are {0:.0f}s behind, {1} messages are waiting".format(lag, self.messages.qsize()))
+
+    def stop(self):
+        # inserts what has already been received before stopping
+        self.messages.put(None)
+
+
+class StatsWorker(multiprocessing.Process):
+    "Process which inserts the samples of one shard."
+
+    def __init__(self, shard):
+        super(StatsWorker, self).__init__(name='stats_worker_{0:d}'.format(shard))
+        self.shard = shard
+        self.inserted = multiprocessing.Value('L', 0)
+        self.stopping = multiprocessing.Event()
+
+    def run(self):
+        # the service stops its workers, after they have inserted what they received
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        # deleting everything older than its expiration is the same work for every shard
+        for model in Stats:
+            model.expire_all = not self.shard
+
+        # receive while the previous batch is being inserted
+        inserter = StatsInserter(self.inserted)
+        inserter_thread = ServiceThread(inserter)
+        inserter_thread.start()
+
+        stats_queue = StatsQueue(self.shard)
+        stopper = threading.Thread(target=self.wait, args=(stats_queue,))
+        stopper.daemon = True
+        stopper.start()
+        try:
+            stats_queue.purge()
+            stats_queue.serve(callback=inserter.put)
+        finally:
+            inserter_thread.stop()
+            inserter_thread.join()
+
+    def wait(self, stats_queue):
+        self.stopping.wait()
+        stats_queue.stop()
+
+    def stop(self):
+        self.stopping.set()
+
+
+class Service(ChromaService):
+    """Run STATS_WORKERS processes, one per shard of the stats queue.
+    Samples inserted by each shard per second are logged every REPORT_INTERVAL seconds."""
+    REPORT_INTERVAL = 60
+
+    def __init__(self):
+        super(Service, self).__init__()
+        self._stopping = threading.Event()
+
+    def run(self):
+        super(Service, self).run()
+
+        # connections mustn't be shared with the worker processes
+        db.connection.close()
+        workers = [StatsWorker(shard) for shard in range(settings.STATS_WORKERS)]
+        for worker in workers:
+            worker.start()
+
+        reported, counts = time.time(), [0] * len(workers)
+        while not self._stopping.wait(self.REPORT_INTERVAL):
+            now, rates = time.time(), []
+            for shard, worker in enumerate(workers):
+                if not worker.is_alive():
+                    log.error("Stats worker {0} exited with {1}, restarting".format(shard, worker.exitcode))
+                    workers[shard] = worker = StatsWorker(shard)
+                    worker.start()
+                    counts[shard] = 0
+                inserted = worker.inserted.value
+                rates.append("{0:.1f}".format((inserted - counts[shard]) / (now - reported)))
+                counts[shard] = inserted
+            reported = now
+            log.info("Samples inserted per second by shard: {0}".format(', '.join(rates)))
+
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
 
     def stop(self):
         super(Service, self).stop()
 
-        self.queue.stop()
+        self._stopping.set()
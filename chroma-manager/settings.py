@@ -234,6 +234,13 @@ STORAGE_PLUGIN_DEBUG_PLUGINS = []
 
 STORAGE_PLUGIN_ENABLE_STATS = True
 
+#: Number of threads running the scans of storage plugin sessions
+STORAGE_PLUGIN_SCAN_WORKERS = 16
+#: Seconds after which a storage plugin scan is left to its thread, and another started in its place
+STORAGE_PLUGIN_SCAN_BLOCKING = 60
+#: Seconds between searches for scannable resources which the plugin_runner wasn't told about
+STORAGE_PLUGIN_RECONCILE_PERIOD = 300
+
 # Control of the statistics storage
 STATS_SIMPLE_WIPE = True                    # True means we simple delete everything that is older than the expiration, data not rolled up is lost.
 STATS_10_SECOND_EXPIRATION = {'days': 1}    # Expiration must be multiple of 10 seconds.
@@ -242,6 +249,22 @@ STATS_5_MINUTE_EXPIRATION = {'days': 7}     # Expiration must be multiple of 5 m
 STATS_1_HOUR_EXPIRATION = {'days': 30}      # Expiration must be multiple of 1 hour.
 STATS_1_DAY_EXPIRATION = {'weeks': 10000}   # Expiration must be multiple of 1 day
 STATS_FLUSH_RATE = 20                       # Flush 20 times per expiration interval - for 10 seconds sample flush every 1day/20.
+STATS_PARTITIONED = False                   # True stores samples in time partitions which are dropped as they expire, see 'manage.py partition_stats'.
+STATS_PARTITIONS = 4                        # Number of time partitions per expiration interval.
+STATS_ENGINE = 'postgres'                   # 'postgres' for the Sample_* tables, 'mmap' for memory-mapped ring files.
+STATS_MMAP_PATH = '/var/lib/chroma/stats'   # Root directory of the ring files used by the 'mmap' engine.
+STATS_BATCH_SIZE = 10000                    # Maximum number of samples the stats service inserts at once.
+STATS_BATCH_WINDOW = 1.0                    # Seconds the stats service waits for more samples to insert together.
+STATS_QUEUE_SIZE = 1000                     # Messages each stats worker receives ahead of inserting them.
+STATS_WORKERS = 1                           # Number of stats service processes, each inserting a shard of the series.
+METRIC_CACHE_SIZE = 200                     # Number of distinct metric queries whose results are cached by each API process.
+METRIC_CACHE_SETTLE_SECONDS = 60            # Cached metric results this much older than the newest sample are reused.
+METRIC_CACHE_WATERMARK_SECONDS = 5          # Seconds the time of the newest sample is reused for by metric queries.
+
+# Control of the execution of job steps by the job_scheduler service
+JOB_STEP_WORKERS = 32                       # Number of threads running the steps of jobs.
+JOB_STEP_HOST_CONCURRENCY = 4               # Maximum number of steps of different jobs acting on the same server at once.
+AVAILABLE_ACTIONS_MAX_AGE = 10              # Seconds the available transitions and jobs of an object are cached for.
 
 # When agent sends VPD 0x80 and 0x83 serial numbers, which do we prefer to use
 # for the canonical device serial on the manager?  Favorite first.
@@ -3,10 +3,13 @@ import json
 import collections
 import operator
 
+import mock
+
 from chroma_core.lib.cache import ObjectCache
 from chroma_core.lib import metrics
 from chroma_core.models import ManagedTarget, ManagedTargetMount, ManagedMgs, ManagedMdt, ManagedOst, ManagedFilesystem
 from chroma_core.models import Stats
+from chroma_api.utils import metric_cache
 from .chroma_api_test_case import ChromaApiTestCase
 from tests.unit.chroma_core.helpers import synthetic_host, synthetic_volume_full
 
@@ -40,6 +43,7 @@ class TestStats(ChromaApiTestCase):
                 Stats.insert(store.serialize(value, timestamp, **kwargs))
         for model in Stats:
             model.cache.clear()
+        metric_cache.clear()
 
     def fetch(self, path, **params):
         response = self.api_client.get('/api/' + path, data=params)
@@ -83,6 +87,18 @@ class TestStats(ChromaApiTestCase):
         self.assertEqual(data, ({'mem_MemFree': 65001.0, 'cpu_user': 5.9}, {'mem_MemFree': 68704.0, 'cpu_user': 9.6}))
         self.assertEqual(timestamps, ('2013-04-19T20:34:10+00:00', '2013-04-19T20:34:20+00:00'))
 
+        # host list, date range repeated: verify cached results are reused
+        counters = metric_cache.stats()
+        self.assertEqual(self.fetch('host/metric/', metrics='cpu_user,mem_MemFree', begin='2013-04-19T20:34:00Z', end='2013-04-19T20:34:30Z', role='OSS'), content)
+        self.assertEqual(metric_cache.stats()['hits'], counters['hits'] + 1)
+        content = self.fetch('host/metric/', metrics='cpu_user,mem_MemFree', begin='2013-04-19T20:34:10Z', end='2013-04-19T20:34:30Z', role='OSS')
+        self.assertEqual(len(content[host_id]), 2)
+        self.assertEqual(metric_cache.stats()['hits'], counters['hits'] + 2)
+        # the watermark is reused rather than queried for every request
+        with mock.patch.object(Stats, 'watermark') as watermark:
+            self.fetch('host/metric/', metrics='cpu_user,mem_MemFree', begin='2013-04-19T20:34:10Z', end='2013-04-19T20:34:30Z', role='OSS')
+            self.assertFalse(watermark.called)
+
         # target detail, date range: verify basic target retrieval
         content = self.fetch('target/{0}/metric/'.format(self.mdt.id), metrics='stats_close,stats_mkdir', begin='2013-04-19T20:34:00Z', end='2013-04-19T20:34:30Z')
         data, timestamps = zip(*map(operator.itemgetter('data', 'ts'), content))
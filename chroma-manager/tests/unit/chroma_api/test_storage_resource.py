@@ -1,4 +1,6 @@
 
+import mock
+
 from tests.unit.chroma_api.chroma_api_test_case import ChromaApiTestCase
 from tests.unit.chroma_core.lib.storage_plugin.helper import load_plugins
 
@@ -19,6 +21,10 @@ class TestStorageResourceResource(ChromaApiTestCase):
         from chroma_core.models import StorageResourceRecord
         StorageResourceResource._meta.queryset = StorageResourceRecord.objects.filter(resource_class__id__in = filter_class_ids())
 
+        from chroma_core.services.plugin_runner.scan_daemon_interface import ScanDaemonRpcInterface
+        self.scan_daemon_call = mock.patch.object(ScanDaemonRpcInterface, '_call').start()
+        self.addCleanup(mock.patch.stopall)
+
     def tearDown(self):
         import chroma_core
         chroma_core.lib.storage_plugin.manager.storage_plugin_manager = self.old_manager
@@ -36,6 +42,8 @@ class TestStorageResourceResource(ChromaApiTestCase):
         })
         self.assertHttpCreated(response)
         resource = self.deserialize(response)
+        # The plugin_runner is told to start scanning it
+        self.scan_daemon_call.assert_called_once_with('add_resource', int(resource['id']))
 
         valid_alias = 'foobar'
         response = self.api_client.put(resource['resource_uri'], data = {
@@ -64,3 +72,17 @@ class TestStorageResourceResource(ChromaApiTestCase):
             # Check that the alias is still the last valid one we set
             response = self.api_client.get(resource['resource_uri'])
             self.assertEqual(self.deserialize(response)['alias'], valid_alias)
+
+    def test_create_unnotified(self):
+        """Check that a resource is created even if the plugin_runner can't be told about it"""
+        self.scan_daemon_call.side_effect = IOError("Connection refused")
+        response = self.api_client.post("/api/storage_resource/", data = {
+            'plugin_name': 'loadable_plugin',
+            'class_name': 'TestScannableResource',
+            'attrs': {
+                'name': 'foobar'
+            }
+        })
+        self.assertHttpCreated(response)
+        resource = self.deserialize(response)
+        self.scan_daemon_call.assert_called_once_with('add_resource', int(resource['id']))
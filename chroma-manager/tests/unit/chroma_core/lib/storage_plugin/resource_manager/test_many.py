@@ -1,7 +1,10 @@
-from django.db import connection
+import json
+
+import mock
+from django.db import connection, transaction, DEFAULT_DB_ALIAS
 from chroma_core.lib.util import dbperf
 from chroma_core.models.host import Volume, VolumeNode
-from chroma_core.models.storage_plugin import StorageResourceRecord
+from chroma_core.models.storage_plugin import StorageResourceRecord, StorageResourceAttributeSerialized, StorageResourceStatistic
 from tests.unit.chroma_core.lib.storage_plugin.resource_manager.test_resource_manager import ResourceManagerTestCase
 
 
@@ -78,3 +81,64 @@ class TestManyObjects(ResourceManagerTestCase):
         finally:
             dbperf.enabled = False
             connection.use_debug_cursor = False
+
+    def test_reopen(self):
+        """Reopening a session reuses the records of its resources, and only rewrites the attributes which changed"""
+        self.resource_manager.session_open(self.plugin, self.couplet_resource_pk, self.controller_resources, 60)
+        record_ids = sorted(StorageResourceRecord.objects.values_list('id', flat = True))
+        attr_ids = sorted(StorageResourceAttributeSerialized.objects.values_list('id', flat = True))
+        self.resource_manager.session_close(self.couplet_resource_pk)
+
+        lun_resource = self.controller_resources[self.M + 1]
+        lun_resource.name = "LUN_renamed"
+        self.resource_manager.session_open(self.plugin, self.couplet_resource_pk, self.controller_resources, 60)
+
+        self.assertEqual(sorted(StorageResourceRecord.objects.values_list('id', flat = True)), record_ids)
+        self.assertEqual(sorted(StorageResourceAttributeSerialized.objects.values_list('id', flat = True)), attr_ids)
+        names = StorageResourceAttributeSerialized.objects.filter(key = 'name').values_list('value', flat = True)
+        self.assertIn(json.dumps("LUN_renamed"), names)
+        self.assertNotIn(json.dumps("LUN_0"), names)
+
+    def test_stats(self):
+        """Statistics of all a session's resources are written together, resolving their records from memory once known"""
+        self.resource_manager.session_open(self.plugin, self.couplet_resource_pk, self.controller_resources, 60)
+        drives = [r for r in self.controller_resources if r.__class__.__name__ == 'HardDrive']
+        updates = [(drive._handle, {'temperature': [{'timestamp': 1000, 'value': 30 + n}]}) for n, drive in enumerate(drives)]
+
+        samples = self.resource_manager.session_get_stats_many(self.couplet_resource_pk, updates)
+        self.assertEqual(len(samples), self.N * self.M)
+        self.assertEqual(StorageResourceStatistic.objects.count(), self.N * self.M)
+        self.assertEqual(sorted(value for id, dt, value in samples), [30.0 + n for n in range(0, self.N * self.M)])
+
+        try:
+            connection.use_debug_cursor = True
+            queries = len(connection.queries)
+            samples = self.resource_manager.session_get_stats_many(self.couplet_resource_pk, updates)
+            self.assertEqual(len(samples), self.N * self.M)
+            self.assertEqual([q for q in connection.queries[queries:] if 'storageresource' in q['sql']], [])
+        finally:
+            connection.use_debug_cursor = False
+
+    def test_stats_transaction(self):
+        """Statistics created in a transaction are only cached once it commits"""
+        self.resource_manager.session_open(self.plugin, self.couplet_resource_pk, self.controller_resources, 60)
+        drive = [r for r in self.controller_resources if r.__class__.__name__ == 'HardDrive'][0]
+        updates = [(drive._handle, {'temperature': [{'timestamp': 1000, 'value': 30}]})]
+        record_pk = self.resource_manager._sessions[self.couplet_resource_pk].local_id_to_global_id[drive._handle]
+
+        db = transaction.connections[DEFAULT_DB_ALIAS]
+        # Statistics are always updated inside the caller's transaction
+        with mock.patch.object(transaction, 'is_managed', return_value = True), \
+                mock.patch.object(db, 'commit'), mock.patch.object(db, 'rollback'):
+            self.resource_manager.session_get_stats_many(self.couplet_resource_pk, updates)
+            self.assertFalse(self.resource_manager._statistics.get(record_pk))
+
+            # A rolled back statistic is forgotten, and created again by the next update
+            db.rollback()
+            StorageResourceStatistic.objects.all().delete()
+            self.assertFalse(self.resource_manager._statistics.get(record_pk))
+            self.resource_manager.session_get_stats_many(self.couplet_resource_pk, updates)
+            self.assertEqual(StorageResourceStatistic.objects.count(), 1)
+
+            db.commit()
+            self.assertEqual(self.resource_manager._statistics[record_pk].keys(), ['temperature'])
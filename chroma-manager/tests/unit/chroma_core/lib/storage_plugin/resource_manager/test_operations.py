@@ -50,6 +50,26 @@ class TestResourceOperations(ResourceManagerTestCase):
         self.assertEqual(StorageResourceAttributeReference.objects.count(), 1)
         self.assertNotEqual(StorageResourceAttributeReference.objects.get().value, None)
 
+    def test_cull_lost(self):
+        """Resources missing when a session reopens are deleted, with whatever refers to them"""
+        partition = self._make_local_resource('linux', 'Partition',
+                                              container = self.dev_resource, number = 0, size = 1024 * 1024 * 500)
+        self.resource_manager.session_open(self.plugin,
+                                           self.scannable_resource_pk,
+                                           [self.scannable_resource, partition, self.dev_resource, self.node_resource],
+                                           60)
+        self.assertEqual(StorageResourceRecord.objects.count(), 4)
+        self.resource_manager.session_close(self.scannable_resource_pk)
+
+        self.resource_manager.session_open(self.plugin,
+                                           self.scannable_resource_pk,
+                                           [self.scannable_resource],
+                                           60)
+
+        from chroma_core.models import StorageResourceAttributeReference
+        self.assertEqual([r.pk for r in StorageResourceRecord.objects.all()], [self.scannable_resource_pk])
+        self.assertEqual(StorageResourceAttributeReference.objects.count(), 0)
+
     def test_subscriber(self):
         """Create a pair of resources where one subscribes to the other"""
         controller_record, controller_resource = self._make_global_resource('subscription_plugin', 'Controller', {'address': '192.168.0.1'})
@@ -1,4 +1,7 @@
+import threading
+
 from chroma_core.models.storage_plugin import StorageResourceRecord
+from chroma_core.services.plugin_runner.resource_manager import TimedLock
 from tests.unit.chroma_core.lib.storage_plugin.resource_manager.test_resource_manager import ResourceManagerTestCase
 
 
@@ -32,3 +35,36 @@ class TestSessions(ResourceManagerTestCase):
         # closing in a finally block)
         self.resource_manager.session_close(self.scannable_resource_id)
         self.assertEqual(len(self.resource_manager._sessions), 0)
+
+    def test_lock_times(self):
+        self.resource_manager.session_open(self.plugin, self.scannable_resource_id, [], 60)
+
+        times = self.resource_manager.lock_times()[self.scannable_resource_id]
+        for name in ['session', 'graph']:
+            acquisitions, waited, held = times[name]
+            self.assertEqual(acquisitions, 1)
+            self.assertTrue(held >= 0.0)
+
+        # Times are reported and then dropped with the session
+        self.resource_manager.session_close(self.scannable_resource_id)
+        self.assertEqual(self.resource_manager.lock_times(), {})
+
+    def test_shared_lock(self):
+        lock = TimedLock('graph')
+        entered = []
+
+        def exclusive():
+            with lock.acquired(2):
+                entered.append(True)
+
+        with lock.acquired(1, shared = True):
+            # Shared holders run alongside each other, an exclusive one waits for them
+            with lock.acquired(1, shared = True):
+                pass
+            thread = threading.Thread(target = exclusive)
+            thread.start()
+            thread.join(0.5)
+            self.assertEqual(entered, [])
+        thread.join()
+        self.assertEqual(entered, [True])
+        self.assertEqual(lock.times()[1][0], 2)
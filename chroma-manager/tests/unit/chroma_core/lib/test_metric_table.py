@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+
+from django.test import TestCase
+from django.utils.timezone import utc
+
+from chroma_core.lib.metrics import MetricTable
+
+
+now = datetime.fromtimestamp(0, utc) + timedelta(days=365 * 40)
+dts = [now + timedelta(seconds=10 * n) for n in range(4)]
+
+
+class TestMetricTable(TestCase):
+    "Test conversion and reduction of metric tables."
+
+    def test_dict(self):
+        stats = {dts[0]: {'free': 1.0}, dts[1]: {'free': 2.0, 'total': 4.0}}
+        table = MetricTable.fromdict(['total', 'free'], stats)
+        self.assertEqual(table.metrics, ['total', 'free'])
+        self.assertEqual(table.todict(), stats)
+        table = MetricTable.fromdict(['used'], stats)
+        self.assertEqual(table.metrics, ['used', 'free', 'total'])
+        self.assertEqual(table.align(['total', 'free', 'used'])[1].tolist()[:2], [4.0, 2.0])
+        self.assertEqual(MetricTable.empty(['free']).todict(), {})
+
+    def test_reduce(self):
+        # staggered timestamps merge with the previous value of the other table
+        tables = [MetricTable.fromdict(['free'], {dts[0]: {'free': 1.0}, dts[2]: {'free': 3.0}}),
+                  MetricTable.fromdict(['free'], {dts[1]: {'free': 10.0}, dts[3]: {'free': 30.0}}),
+                  MetricTable.empty(['free'])]
+        self.assertEqual(MetricTable.reduce(['free'], tables, 'sum').todict(),
+                         {dts[0]: {'free': 11.0}, dts[1]: {'free': 11.0}, dts[2]: {'free': 13.0}, dts[3]: {'free': 33.0}})
+        self.assertEqual(MetricTable.reduce(['free'], tables, 'average').todict()[dts[3]], {'free': 11.0})
+
+        # required metrics default to 0, others are only present where reported
+        tables = [MetricTable.fromdict(['read'], {dts[0]: {'job1': 1.0}, dts[1]: {'job2': 2.0}})]
+        self.assertEqual(MetricTable.reduce(['read'], tables, 'sum').todict(),
+                         {dts[0]: {'read': 0.0, 'job1': 1.0}, dts[1]: {'read': 0.0, 'job2': 2.0}})
+        self.assertEqual(MetricTable.reduce(['read'], [], 'average').todict(), {})
+        self.assertRaises(NotImplementedError, MetricTable.reduce, ['read'], tables, 'max')
@@ -59,12 +59,14 @@ class TestModels(IMLUnitTestCase):
         connection.use_debug_cursor = True
         connection.cursor().execute('SET enable_seqscan = off')
         self.preserve_stats_wipe = settings.STATS_SIMPLE_WIPE
+        self.preserve_stats_partitioned = settings.STATS_PARTITIONED
 
     def tearDown(self):
         connection.cursor().execute('SET enable_seqscan = on')
         connection.use_debug_cursor = False
         Stats.delete_all()
         settings.STATS_SIMPLE_WIPE = self.preserve_stats_wipe
+        settings.STATS_PARTITIONED = self.preserve_stats_partitioned
 
     def test_point(self):
         self.assertEqual(Point(now, 0.0, 0).mean, 0)
@@ -141,6 +143,12 @@ class TestModels(IMLUnitTestCase):
         with assertQueries():
             model.expire([id])
 
+        # Nor when another stats worker does the expiring
+        model.next_flush_orphans_time = epoch
+        with mock.patch.object(model, 'expire_all', False):
+            with assertQueries():
+                model.expire([id])
+
         self.assertEqual(len(list(model.reduce(points))), len(points))
         self.assertLess(len(list(Stats[1].reduce(points))), len(points))
 
@@ -157,6 +165,51 @@ class TestModels(IMLUnitTestCase):
         self.assertListEqual(list(model.select(id)), [])
         self.assertTrue(Stats[-1].start(id))
 
+    def test_sample_partitions(self):
+        model = Stats[0]
+        settings.STATS_PARTITIONED = True
+
+        model.objects.all().delete()
+
+        model.insert({id: points})
+        numbers = sorted(set(map(model.partition, (point.dt for point in points))))
+        self.assertEqual(sorted(set(model.partitions()) & set(numbers)), numbers)
+        start, stop = model.bounds(numbers[0])
+        self.assertLessEqual(start, points[0].dt)
+        self.assertGreater(stop, points[0].dt)
+        self.assertListEqual(list(model.select(id)), points)
+
+        # queries only scan partitions which overlap the range
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN SELECT * FROM {0} WHERE dt >= %s AND dt < %s'.format(model._meta.db_table), model.bounds(numbers[0]))
+        plan = ''.join(row for row, in cursor)
+        self.assertIn(model.partitions()[numbers[0]], plan)
+        for number in numbers[1:]:
+            self.assertNotIn(model.partitions()[number], plan)
+
+        # each partition has an index on dt, which finds the watermark without scanning it
+        cursor.execute('EXPLAIN SELECT MAX(dt) FROM {0}'.format(model._meta.db_table))
+        plan = ''.join(row for row, in cursor)
+        for number in numbers:
+            self.assertIn('{0}_dt'.format(model.partitions()[number]), plan)
+
+        # expiry is only done by the stats worker with expire_all set
+        model.next_flush_orphans_time = epoch
+        with mock.patch.object(model, 'expire_all', False):
+            with assertQueries():
+                model.expire([id])
+
+        # expiry creates the next partition ahead of time, and drops whole partitions
+        model.expire([id])
+        self.assertIn(model.partition(datetime.now(utc) + model.partition_interval), model.partitions())
+        self.assertListEqual(list(model.select(id)), points)
+        model.drop_partitions(stop)
+        self.assertNotIn(numbers[0], model.partitions())
+        self.assertListEqual(list(model.select(id)), [point for point in points if point.dt >= stop])
+
+        model.drop_partitions(model.bounds(max(model.partitions()))[1])
+        self.assertEqual(model.partitions(), {})
+
     def test_stats(self):
         outdated = Stats.insert((id, point.dt, point.sum) for point in points)
         self.assertEqual(outdated, [])
@@ -41,6 +41,28 @@ class TestSeries(IMLUnitTestCase):
         with patch(Series.cache, SIZE=0):
             self.assertEqual(series, Series.get(self.obj, field))
         self.assertFalse(Series.cache)
+        self.assertRaises(Series.DoesNotExist, Series.get, self.obj, 'missing')
+
+    def test_cache(self):
+        types = dict(field[:2] for field in fields)
+        series = Series.get_many(self.obj, types)
+        self.assertEqual(sorted(series), sorted(types))
+        self.assertEqual(Series.filter(self.obj).count(), len(types))
+        Series.cache.clear()
+        Series.loaded.clear()
+        with patch(Series.cache, SIZE=2):
+            self.assertEqual(Series.get_many(self.obj, {'size': ''}), {'size': series['size']})
+            self.assertEqual(len(Series.cache), 2)
+            self.assertEqual(list(Series.cache)[-1][1:], (self.obj.id, 'size'))
+            evictions = Series.cache.evictions
+            name, = set(['bandwith', 'speed']) - set(key[2] for key in Series.cache)
+            self.assertEqual(Series.get(self.obj, name), series[name])
+            self.assertEqual(Series.cache.evictions, evictions + 1)
+            self.assertEqual([key[2] for key in Series.cache], ['size', name])
+            # iterating and printing don't count as use
+            self.assertEqual([key[2] for key, value in Series.cache.items()], ['size', name])
+            self.assertIn(name, repr(Series.cache))
+            self.assertEqual([key[2] for key in Series.cache], ['size', name])
 
     def test_fast(self):
         "Small data set with short intervals."
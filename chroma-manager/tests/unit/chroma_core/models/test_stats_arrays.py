@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+import numpy
+from django.test import TestCase
+from django.utils.timezone import utc
+
+from chroma_core.models.stats import Point, PostgresStats, point_array, concatenate, rollup, means, rates, pad, split, to_timestamp
+
+
+now = datetime.fromtimestamp(0, utc) + timedelta(days=365 * 40)
+
+
+class TestStatsArrays(TestCase):
+    "Test vectorized operations on points of many series."
+
+    def setUp(self):
+        self.points = concatenate([point_array(id, [Point(now + timedelta(seconds=5 * n), float(n * id), 1) for n in range(24)])
+                                   for id in (2, 1)])
+
+    def test_rollup(self):
+        points = rollup(self.points, 60)
+        self.assertEqual(points['id'].tolist(), [1, 1, 2, 2])
+        self.assertEqual(points['len'].tolist(), [12, 12] * 2)
+        self.assertEqual(points['sum'].tolist(), [66, 210, 132, 420])
+        self.assertEqual(split(points)[1], [Point(now, 66.0, 12), Point(now + timedelta(minutes=1), 210.0, 12)])
+        self.assertEqual(len(rollup(self.points)), len(self.points))
+        self.assertEqual(len(rollup(concatenate([]), 60)), 0)
+        self.assertEqual(split(points)[2], list(PostgresStats[1].reduce(split(self.points)[2])))
+
+    def test_rates(self):
+        points = rates(rollup(self.points, 10))
+        self.assertEqual(points['id'].tolist(), [1] * 11 + [2] * 11)
+        self.assertEqual(set(means(points)[:11]), set([0.2]))
+        self.assertEqual(set(means(points)[11:]), set([0.4]))
+
+    def test_pad(self):
+        points = pad(self.points, [1, 2, 3], now, now + timedelta(minutes=2), 4)
+        self.assertEqual(points['id'].tolist(), [1] * 4 + [2] * 4 + [3] * 4)
+        self.assertEqual(points['ts'].tolist()[:4], [to_timestamp(now + timedelta(seconds=30 * n)) for n in range(4)])
+        self.assertEqual(points['len'].tolist(), [6] * 8 + [0] * 4)
+        self.assertEqual(points['sum'][:4].tolist(), [15, 51, 87, 123])
+        numpy.testing.assert_array_equal(means(points)[8:], 0.0)
@@ -0,0 +1,58 @@
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from django.test import TestCase
+from django.utils.timezone import utc
+
+from chroma_core.models.stats import SAMPLES, Point
+from chroma_core.lib.stats_mmap import MmapStats
+
+
+epoch = datetime.fromtimestamp(0, utc)
+now = epoch + timedelta(days=365 * 40)
+
+
+class TestMmapStats(TestCase):
+    "Test the memory-mapped storage engine."
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.stats = MmapStats(SAMPLES, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_insert(self):
+        samples = [(1, now + timedelta(seconds=5 * n), float(n)) for n in range(100)]
+        self.assertEqual(self.stats.insert(samples), [])
+        self.assertEqual(self.stats.insert(samples[-1:]), samples[-1:])
+        self.assertEqual(self.stats[0].latest(1), Point(samples[-1][1], 99.0, 1))
+        self.assertEqual(self.stats.latest(1), Point(now + timedelta(seconds=490), 99.0, 1))
+        self.assertEqual(self.stats.latest(2), (self.stats[0].floor(epoch), 0.0, 0))
+
+        points = self.stats[0].select(1)
+        self.assertEqual(len(points), 50)
+        self.assertEqual(points[0], Point(now, 1.0, 2))
+        self.assertEqual(sum(point.len for point in points), 100)
+        points = self.stats[1].select(1)
+        self.assertEqual([point.len for point in points], [12] * 8 + [4])
+        self.assertEqual(sum(point.sum for point in points), sum(range(100)))
+        points = self.stats[0].select(1, now + timedelta(seconds=15), now + timedelta(seconds=40))
+        self.assertEqual([point.dt for point in points], [now + timedelta(seconds=seconds) for seconds in (20, 30)])
+
+        for point in self.stats.select(1, now, now + timedelta(seconds=100), rate=True):
+            self.assertEqual(point[1:], (2.0, 10))
+        points = self.stats.select(1, now, now + timedelta(seconds=100), fixed=5)
+        self.assertEqual([point.len for point in points], [4] * 5)
+        self.assertEqual(self.stats.active([1, 2], now), [1])
+
+        self.stats.delete(1)
+        self.assertEqual(self.stats[0].select(1), [])
+        self.assertEqual(self.stats[0].latest(1), Point.zero)
+
+    def test_expiration(self):
+        ring = self.stats[0]
+        ring.insert({1: [Point(now, 1.0, 1), Point(now + ring.expiration_time, 2.0, 1)]})
+        self.assertEqual(ring.select(1), [Point(now + ring.expiration_time, 2.0, 1)])
+        self.assertEqual(ring.start(1), now)
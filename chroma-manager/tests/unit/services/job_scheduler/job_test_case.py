@@ -138,6 +138,7 @@ class JobTestCase(IMLUnitTestCase):
         from chroma_core.services.job_scheduler.dep_cache import DepCache
         from chroma_core.services.job_scheduler.job_scheduler import JobScheduler, RunJobThread
         from chroma_core.services.job_scheduler.job_scheduler_client import JobSchedulerRpc
+        from chroma_core.services.job_scheduler import job_scheduler_notify
         from chroma_core.services.job_scheduler.job_scheduler_notify import NotificationQueue
 
         ObjectCache.clear()
@@ -154,6 +155,7 @@ class JobTestCase(IMLUnitTestCase):
             log.info("job_scheduler_queue_immediate: %s" % body)
             job_scheduler_queue_handler.on_message(body)
         NotificationQueue.put = mock.Mock(side_effect = job_scheduler_queue_immediate)
+        job_scheduler_notify._sent.clear()
 
         import chroma_core.services.job_scheduler.job_scheduler
         chroma_core.services.job_scheduler.job_scheduler._disable_database = mock.Mock()
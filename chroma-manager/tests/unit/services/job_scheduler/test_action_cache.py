@@ -0,0 +1,42 @@
+import mock
+from django.test import TestCase
+
+import settings
+from chroma_core.services.job_scheduler.action_cache import ActionCache
+
+
+class TestActionCache(TestCase):
+    "Test validity of the cached transitions and jobs of objects."
+
+    def setUp(self):
+        self.cache = ActionCache()
+        self.computed = []
+
+    def get(self, state, value = 'value'):
+        def compute():
+            self.computed.append(value)
+            return value
+        return self.cache.get('transitions', ['chroma_core', 'managedhost'], 1, state, compute)
+
+    def test_state(self):
+        self.assertEqual(self.get('managed', 'a'), 'a')
+        self.assertEqual(self.get('managed', 'b'), 'a')
+        self.assertEqual(self.get('removed', 'c'), 'c')
+        self.assertEqual(self.computed, ['a', 'c'])
+
+    def test_invalidate(self):
+        self.get('managed', 'a')
+        self.cache.invalidate()
+        self.assertEqual(self.get('managed', 'b'), 'b')
+
+    def test_invalidated_while_computing(self):
+        def compute():
+            self.cache.invalidate()
+            return 'a'
+        self.cache.get('jobs', ['chroma_core', 'managedhost'], 1, 'managed', compute)
+        self.assertEqual(self.get('managed', 'b'), 'b')
+
+    def test_max_age(self):
+        self.get('managed', 'a')
+        with mock.patch.object(settings, 'AVAILABLE_ACTIONS_MAX_AGE', 0):
+            self.assertEqual(self.get('managed', 'b'), 'b')
@@ -1,5 +1,7 @@
 from itertools import chain
 
+import mock
+
 from django.db import connection
 
 from chroma_core.lib.cache import ObjectCache
@@ -255,6 +257,31 @@ class TestFSTransitions(JobTestCaseWithHost):
         ost_new.managedtarget_ptr = self.set_and_assert_state(ost_new.managedtarget_ptr, 'removed')
         self.assertState(self.fs, 'available')
 
+    def test_target_state_counts(self):
+        def assertCounted():
+            self.assertEqual(ObjectCache.filesystem_target_states(self.fs.id), set([t.state for t in self.fs.get_targets()]))
+
+        assertCounted()
+        self.mdt.managedtarget_ptr = self.set_and_assert_state(self.mdt.managedtarget_ptr, 'unmounted')
+        assertCounted()
+        self.fs = self.set_and_assert_state(self.fs, 'stopped')
+        assertCounted()
+        self.assertEqual(ObjectCache.target_filesystem_ids(self.mgt.id), set([self.fs.id]))
+
+    def test_failover_alert_transitions(self):
+        from chroma_core.models import TargetFailoverAlert
+
+        # Starting the filesystem has already notified that the target isn't failed over
+        target = ObjectCache.get_by_id(ManagedTarget, self.ost.id)
+        with mock.patch.object(TargetFailoverAlert, 'notify') as notify:
+            self.job_scheduler._completion_hooks(target)
+            self.assertEqual(notify.call_count, 0)
+
+            target.active_mount_id = ObjectCache.target_primary_mount(target.id).id + 1000
+            self.job_scheduler._completion_hooks(target)
+            self.job_scheduler._completion_hooks(target)
+            notify.assert_called_once_with(target, True)
+
 
 class TestDetectedFSTransitions(JobTestCaseWithHost):
     def setUp(self):
@@ -0,0 +1,38 @@
+import json
+from collections import namedtuple
+
+from django.test import TestCase
+
+from chroma_core.services.job_scheduler.job_scheduler import JobCollection
+
+
+class FakeJob(object):
+    def __init__(self, id, *wait_for_ids):
+        self.id = id
+        self.state = 'pending'
+        self.wait_for_json = json.dumps(wait_for_ids)
+
+
+FakeCommand = namedtuple('FakeCommand', ['id'])
+
+
+class TestJobCollection(TestCase):
+    "Test the dependency index of ready jobs."
+
+    def test_ready_jobs(self):
+        collection = JobCollection()
+        jobs = [FakeJob(1), FakeJob(2, 1), FakeJob(3, 1, 2), FakeJob(4)]
+        collection.add_command(FakeCommand(1), jobs)
+        self.assertEqual(collection.ready_jobs, [jobs[0], jobs[3]])
+
+        collection.update_many(collection.ready_jobs, 'tasked')
+        self.assertEqual(collection.ready_jobs, [])
+        collection.update(jobs[0], 'complete')
+        self.assertEqual(collection.ready_jobs, [jobs[1]])
+
+        # a job added later doesn't wait for complete jobs
+        collection.add(FakeJob(5, 1, 3))
+        collection.update(jobs[1], 'complete', cancelled = True)
+        self.assertEqual(collection.ready_jobs, [jobs[2]])
+        collection.update(jobs[2], 'complete')
+        self.assertEqual([job.id for job in collection.ready_jobs], [5])
@@ -39,6 +39,37 @@ class TestTransitionsWithCommands(JobTestCaseWithHost):
         command = Command.set_state([(freshen(self.lnet_configuration), 'lnet_up')])
         self.assertEqual(command, None)
 
+    def test_batched_notifications(self):
+        """Test that a batch of notifications is coalesced, and repeated notifications are not resent"""
+        from chroma_core.services.job_scheduler import QueueHandler
+        from chroma_core.services.job_scheduler.job_scheduler_notify import NotificationQueue
+
+        messages = []
+        NotificationQueue.put.side_effect = messages.append
+        times = [django.utils.timezone.now() + datetime.timedelta(seconds = n) for n in range(3)]
+        host = freshen(self.host)
+        job_scheduler_notify.notify(host, times[0], {'boot_time': times[1], 'needs_update': True})
+        job_scheduler_notify.notify(host, times[0], {'boot_time': times[1], 'needs_update': True})
+        job_scheduler_notify.notify(host, times[1], {'boot_time': times[2]})
+        job_scheduler_notify.notify(self.lnet_configuration, times[1], {'state': 'lnet_down'}, ['lnet_up'])
+        self.assertEqual(len(messages), 3)
+
+        with mock.patch.object(self.job_scheduler, 'notify_many', wraps = self.job_scheduler.notify_many) as notify_many:
+            QueueHandler(self.job_scheduler).on_messages(messages)
+            notifications = notify_many.call_args[0][0]
+        self.assertEqual(len(notifications), 2)
+        self.assertEqual(notifications[0][2:4], (times[1].isoformat(), {'boot_time': times[2], 'needs_update': True}))
+
+        self.drain_progress()
+        host = freshen(self.host)
+        self.assertEqual((host.boot_time, host.needs_update), (times[2], True))
+        self.assertEqual(freshen(self.lnet_configuration).state, 'lnet_down')
+
+        profile = self.job_scheduler.get_profile()
+        self.assertGreaterEqual(profile['timings']['job_scheduler.notify_many']['calls'], 1)
+        self.assertEqual(profile['queues']['progress'], 0)
+        self.assertEqual(profile['jobs']['pending'], 0)
+
     def test_2steps(self):
         self.assertEqual(LNetConfiguration.objects.get(pk = self.lnet_configuration.pk).state, 'lnet_up')
 
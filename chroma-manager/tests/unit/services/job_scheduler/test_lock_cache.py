@@ -0,0 +1,49 @@
+from collections import namedtuple
+
+import mock
+from django.test import TestCase
+
+from chroma_core.models import StateLock
+from chroma_core.services.job_scheduler.lock_cache import LockCache
+
+
+FakeJob = namedtuple('FakeJob', ['id'])
+
+
+class TestLockCache(TestCase):
+    "Test the per-item indexes of locks."
+
+    def setUp(self):
+        # the items are not models, so there is nothing for receivers to do with them
+        mock.patch.object(LockCache, 'lock_change_receivers', []).start()
+        self.addCleanup(mock.patch.stopall)
+        self.lock_cache = LockCache()
+        self.jobs = [FakeJob(id) for id in range(5)]
+
+    def lock(self, job_id, item, write = False, end_state = None):
+        lock = StateLock(job = self.jobs[job_id], locked_item = item, write = write, end_state = end_state)
+        self.lock_cache.add(lock)
+        return lock
+
+    def test_locks(self):
+        # added out of job order, as the cache is loaded
+        writes = [self.lock(3, 'a', True, 'up'), self.lock(1, 'a', True, 'down'), self.lock(4, 'a', True)]
+        reads = [self.lock(2, 'a'), self.lock(4, 'a'), self.lock(1, 'b')]
+        self.lock(2, 'b', True, 'up')
+
+        self.assertEqual(self.lock_cache.get_write('a'), [writes[1], writes[0], writes[2]])
+        self.assertEqual(self.lock_cache.get_latest_write('a'), writes[2])
+        self.assertEqual(self.lock_cache.get_latest_write('a', not_job = self.jobs[4]), writes[0])
+        self.assertEqual(self.lock_cache.get_latest_write('c'), None)
+        self.assertEqual(self.lock_cache.get_read_locks('a', after = 2, not_job = self.jobs[4]), [reads[0]])
+        self.assertEqual(self.lock_cache.get_read_locks('a', after = 3, not_job = None), [reads[1]])
+        # the latest write lock on 'a' has no end state
+        self.assertEqual(self.lock_cache.expected_states, {'b': 'up'})
+
+        self.assertEqual(self.lock_cache.remove_job(self.jobs[4]), 2)
+        self.assertEqual(self.lock_cache.expected_states, {'a': 'up', 'b': 'up'})
+        self.assertEqual(self.lock_cache.get_by_locked_item('a'), writes[:2] + reads[:1])
+        self.assertEqual(self.lock_cache.remove_job(self.jobs[2]), 2)
+        self.assertEqual(self.lock_cache.expected_states, {'a': 'up'})
+        self.assertEqual(self.lock_cache.get_write_by_locked_item(), {'a': writes[0]})
+        self.assertEqual(self.lock_cache.remove_job(self.jobs[2]), 0)
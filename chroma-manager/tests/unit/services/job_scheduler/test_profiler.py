@@ -0,0 +1,28 @@
+from django.test import TestCase
+
+from chroma_core.services.job_scheduler.profiler import SchedulerProfiler
+
+
+class TestSchedulerProfiler(TestCase):
+    "Test timing and counting of scheduler operations."
+
+    def test_timed(self):
+        profiler = SchedulerProfiler()
+
+        @profiler.timed
+        def recurse(depth):
+            with profiler.time('inner'):
+                profiler.count('calls')
+                if depth:
+                    recurse(depth - 1)
+
+        recurse(2)
+        stats = profiler.stats()
+        # nested timings of the same operation are counted once
+        self.assertEqual(stats['timings']['test_profiler.recurse']['calls'], 1)
+        self.assertEqual(stats['timings']['inner']['calls'], 1)
+        self.assertEqual(stats['counters'], {'calls': 3})
+        self.assertGreaterEqual(stats['timings']['test_profiler.recurse']['total'], stats['timings']['inner']['total'])
+
+        profiler.reset()
+        self.assertEqual(profiler.stats()['timings'], {})
@@ -0,0 +1,99 @@
+import threading
+
+from django.test import TestCase
+
+from chroma_core.services.job_scheduler.step_executor import StepExecutor
+
+
+class FakeRun(object):
+    step_class = 'FakeStep'
+    cancelled = False
+    long_running = False
+
+    def __init__(self, name, host, steps, log, gate = None):
+        self.name = name
+        self.host = host
+        self.steps = steps
+        self.log = log
+        self.gate = gate
+        self.started = threading.Event()
+        self.complete = threading.Event()
+
+    def run_step(self):
+        self.log.append(self.name)
+        self.started.set()
+        if self.gate:
+            self.gate.wait(5)
+        self.steps -= 1
+        if not self.steps:
+            self.complete.set()
+        return self.steps > 0
+
+
+class TestStepExecutor(TestCase):
+    "Test ordering and per-host limits of job step execution."
+
+    def run_all(self, executor, runs):
+        for run in runs:
+            self.assertTrue(run.complete.wait(5))
+        executor.stop()
+
+    def test_priority(self):
+        executor = StepExecutor(1, 1)
+        log, gate = [], threading.Event()
+        blocker = FakeRun('blocker', None, 1, log, gate)
+        executor.submit(blocker, (0, 0))
+        runs = [FakeRun('later', 'a', 1, log), FakeRun('first', 'b', 2, log), FakeRun('second', 'c', 1, log)]
+        for run, priority in zip(runs, [(2, 3), (1, 1), (1, 2)]):
+            executor.submit(run, priority)
+        gate.set()
+        self.run_all(executor, [blocker] + runs)
+        # the remaining steps of a run keep its place in the queue
+        self.assertEqual(log, ['blocker', 'first', 'first', 'second', 'later'])
+
+    def test_per_host(self):
+        executor = StepExecutor(3, 1)
+        log, gate = [], threading.Event()
+        runs = [FakeRun('a1', 'a', 1, log, gate), FakeRun('a2', 'a', 1, log), FakeRun('b', 'b', 1, log)]
+        executor.submit(runs[0], (1, 0))
+        self.assertTrue(runs[0].started.wait(5))
+        executor.submit(runs[1], (1, 1))
+        executor.submit(runs[2], (1, 2))
+        # a2 waits for a1's host while b runs
+        self.assertTrue(runs[2].complete.wait(5))
+        self.assertEqual(log, ['a1', 'b'])
+        gate.set()
+        self.run_all(executor, runs)
+        self.assertEqual(log[-1], 'a2')
+
+    def test_cancel_waiting(self):
+        executor = StepExecutor(2, 1)
+        log, gate = [], threading.Event()
+        runs = [FakeRun('a1', 'a', 1, log, gate), FakeRun('a2', 'a', 1, log)]
+        executor.submit(runs[0], (1, 0))
+        self.assertTrue(runs[0].started.wait(5))
+        executor.submit(runs[1], (1, 1))
+        # a2 is waiting aside for a1's host, until it is cancelled
+        self.assertFalse(runs[1].complete.wait(0.2))
+        runs[1].cancelled = True
+        executor.wake(runs[1])
+        self.assertTrue(runs[1].complete.wait(5))
+        self.assertEqual(log, ['a1', 'a2'])
+        gate.set()
+        self.run_all(executor, runs)
+
+    def test_long_running(self):
+        executor = StepExecutor(1, 1)
+        log, gate = [], threading.Event()
+        waiting = FakeRun('reboot', 'a', 1, log, gate)
+        waiting.long_running = True
+        executor.submit(waiting, (1, 0))
+        self.assertTrue(waiting.started.wait(5))
+        # the only worker isn't held by the long running step
+        other = FakeRun('other', 'b', 1, log)
+        executor.submit(other, (1, 1))
+        self.assertTrue(other.complete.wait(5))
+        self.assertEqual(executor.stats()['long_running'], 1)
+        gate.set()
+        self.run_all(executor, [waiting, other])
+        self.assertEqual(log, ['reboot', 'other'])
@@ -1,6 +1,9 @@
+import django.utils.timezone
+
 from chroma_core.lib.cache import ObjectCache
 from chroma_core.models import ManagedTargetMount
 from chroma_core.models import Nid
+from chroma_core.services.job_scheduler import job_scheduler_notify
 from chroma_core.services.job_scheduler.job_scheduler_client import JobSchedulerClient
 from chroma_core.models import ManagedTarget, ManagedMgs, ManagedHost
 
@@ -168,6 +171,23 @@ class TestSharedTarget(JobTestCaseWithHost):
         self.assertEqual(ManagedTarget.objects.get(pk = self.mgt.pk).state, 'mounted')
         self.assertEqual(ManagedTarget.objects.get(pk = self.mgt.pk).active_mount, ManagedTargetMount.objects.get(host = self.hosts[0], target = self.mgt))
 
+    def test_notified_failover(self):
+        """Check that a notification of a target's active mount changes the migrations it is offered"""
+        def available_jobs():
+            jobs = JobSchedulerClient.available_jobs([(('chroma_core', 'managedtarget'), self.mgt.pk)])
+            return [job['class_name'] for job in jobs[str(self.mgt.pk)]]
+
+        self.assertNotIn('FailoverTargetJob', available_jobs())
+        primary_mount = ManagedTargetMount.objects.get(host = self.hosts[0], target = self.mgt)
+        job_scheduler_notify.notify(freshen(self.mgt.managedtarget_ptr), django.utils.timezone.now(), {'active_mount': primary_mount})
+        self.assertIn('FailoverTargetJob', available_jobs())
+        self.assertNotIn('FailbackTargetJob', available_jobs())
+
+        secondary_mount = ManagedTargetMount.objects.get(host = self.hosts[1], target = self.mgt)
+        job_scheduler_notify.notify(freshen(self.mgt.managedtarget_ptr), django.utils.timezone.now(), {'active_mount': secondary_mount})
+        self.assertIn('FailbackTargetJob', available_jobs())
+        self.assertNotIn('FailoverTargetJob', available_jobs())
+
     def test_teardown_unformatted(self):
         self.assertEqual(ManagedTarget.objects.get(pk = self.mgt.pk).state, 'unformatted')
         try:
@@ -0,0 +1,46 @@
+import threading
+
+import mock
+from django.test import TestCase
+from kombu.connection import BrokerConnection
+
+from chroma_core.services.queue import ServiceQueue
+
+
+class AcmeQueue(ServiceQueue):
+    name = 'acme'
+
+
+class TestServiceQueue(TestCase):
+    "Test sending on pooled connections."
+
+    def connection(self):
+        return BrokerConnection('memory://')
+
+    def test_put(self):
+        with mock.patch('chroma_core.services.queue._amqp_connection', self.connection):
+            AcmeQueue().put({'foo': 0})
+            AcmeQueue().put_many([{'foo': 1}, {'foo': 2}])
+        with self.connection() as conn:
+            q = conn.SimpleQueue('acme', serializer = 'json',
+                                 exchange_opts={'durable': False}, queue_opts={'durable': False})
+            self.assertEqual([q.get(timeout = 1).payload for _ in range(3)], [{'foo': 0}, {'foo': 1}, {'foo': 2}])
+            q.close()
+
+    def test_serve(self):
+        batches = []
+        with mock.patch('chroma_core.services.queue._amqp_connection', self.connection):
+            queue = AcmeQueue()
+            queue.purge()
+            queue.put_many([{'foo': 0}, {'foo': 1}])
+            thread = threading.Thread(target = queue.serve, kwargs = {'batch_callback': batches.append})
+            thread.start()
+            queue.put({'foo': 2})
+            # stale wake up messages are dropped
+            queue.put({'__wakeup__': ''})
+            while sum(map(len, batches)) < 3:
+                thread.join(0.01)
+            queue.stop()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(sum(batches, []), [{'foo': 0}, {'foo': 1}, {'foo': 2}])
@@ -0,0 +1,83 @@
+import threading
+
+import mock
+from django.test import TestCase
+
+from chroma_core.services import rpc
+from chroma_core.services.rpc import RpcDispatcher, ServiceRpcInterface, PRIORITY_HIGH, PRIORITY_LOW
+
+
+class FakeRpc(ServiceRpcInterface):
+    methods = ['query', 'configure', 'wait']
+    method_priorities = {'query': PRIORITY_HIGH, 'configure': PRIORITY_LOW}
+    concurrency_classes = {'configuration': 1, 'long_poll': None}
+    method_concurrency_classes = {'configure': 'configuration', 'wait': 'long_poll'}
+
+
+class TestRpcDispatcher(TestCase):
+    "Test the ordering and concurrency limits of incoming RPCs."
+
+    def setUp(self):
+        self.log = []
+        self.gates = {}
+        self.started = {}
+        self.done = {}
+        test = self
+
+        class FakeRunOneRpc(object):
+            def __init__(self, rpc, body, response_conn_pool):
+                self.name = body['args'][0]
+
+            def run(self):
+                test.log.append(self.name)
+                test.started[self.name].set()
+                if self.name in test.gates:
+                    test.gates[self.name].wait(5)
+                test.done[self.name].set()
+
+        mock.patch.object(rpc, 'RunOneRpc', FakeRunOneRpc).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def submit(self, dispatcher, method, name, gate = False):
+        self.started[name] = threading.Event()
+        self.done[name] = threading.Event()
+        if gate:
+            self.gates[name] = threading.Event()
+        dispatcher.submit({'method': method, 'args': [name]})
+
+    def wait(self, *names):
+        for name in names:
+            self.assertTrue(self.done[name].wait(5))
+
+    def test_priority(self):
+        dispatcher = RpcDispatcher(FakeRpc(), 1, None)
+        self.submit(dispatcher, 'query', 'blocker', gate = True)
+        self.submit(dispatcher, 'configure', 'configure')
+        self.submit(dispatcher, 'query', 'query1')
+        self.submit(dispatcher, 'query', 'query2')
+        self.gates['blocker'].set()
+        self.wait('blocker', 'configure', 'query1', 'query2')
+        dispatcher.stop()
+        self.assertEqual(self.log, ['blocker', 'query1', 'query2', 'configure'])
+
+        stats = dispatcher.stats()['methods']
+        self.assertEqual(stats['query']['calls'], 3)
+        self.assertEqual(stats['query']['queued'], 0)
+        self.assertEqual(stats['configure']['calls'], 1)
+
+    def test_concurrency_classes(self):
+        dispatcher = RpcDispatcher(FakeRpc(), 3, None)
+        self.submit(dispatcher, 'configure', 'configure1', gate = True)
+        self.submit(dispatcher, 'configure', 'configure2')
+        self.submit(dispatcher, 'wait', 'wait', gate = True)
+        self.submit(dispatcher, 'query', 'query')
+        # the second configure waits for the first, while a query runs beside the long poll
+        self.wait('query')
+        self.assertTrue(self.started['configure1'].wait(5))
+        self.assertEqual(dispatcher.stats()['running'], {'configuration': 1})
+        self.assertNotIn('configure2', self.log)
+        self.gates['configure1'].set()
+        self.gates['wait'].set()
+        self.wait('configure1', 'configure2', 'wait')
+        dispatcher.stop()
+        self.assertEqual(dispatcher.stats()['workers'], 3)
@@ -0,0 +1,95 @@
+import time
+import threading
+
+from django.test import TestCase
+
+from chroma_core.services.plugin_runner.scan_daemon import SessionScheduler
+
+
+class FakeSession(object):
+    def __init__(self, name, period, log, scans = 3, block = None):
+        self.name = name
+        self.period = period
+        self.log = log
+        self.scans = scans
+        self.block = block
+        self.stopping = threading.Event()
+        self.stopped = threading.Event()
+
+    def scan(self, due):
+        if self.stopping.is_set():
+            self.log.append((self.name, 'teardown'))
+            self.stopped.set()
+            return None
+        self.log.append((self.name, due))
+        if self.block:
+            self.block.wait()
+        self.scans -= 1
+        if not self.scans:
+            self.stopped.set()
+            return None
+        return due + self.period
+
+
+class TestSessionScheduler(TestCase):
+    "Test timing and stopping of plugin session scans."
+
+    def test_spread(self):
+        scheduler = SessionScheduler(2, 60)
+        log = []
+        sessions = [FakeSession(name, 0.2, log) for name in ['a', 'b']]
+        started = time.time()
+        scheduler.schedule(sessions[0], started)
+        scheduler.schedule(sessions[1], started + 0.1)
+        for session in sessions:
+            self.assertTrue(session.stopped.wait(5))
+        scheduler.stop()
+        # each keeps its offset, scanning once per period from when it was first due
+        self.assertEqual([name for name, due in log], ['a', 'b', 'a', 'b', 'a', 'b'])
+        for offset, due in zip([0.1, 0.3, 0.5], [due for name, due in log if name == 'b']):
+            self.assertAlmostEqual(due - started, offset, places = 3)
+
+    def test_stop(self):
+        scheduler = SessionScheduler(1, 60)
+        log = []
+        session = FakeSession('a', 60, log)
+        scheduler.schedule(session, time.time())
+        while not log:
+            time.sleep(0.01)
+        # a stopped session is torn down straight away rather than at its next update
+        session.stopping.set()
+        scheduler.wake(session)
+        self.assertTrue(session.stopped.wait(5))
+        scheduler.stop()
+        self.assertEqual([entry[1] for entry in log][1:], ['teardown'])
+
+    def test_replace(self):
+        scheduler = SessionScheduler(1, 60)
+        log = []
+        session = FakeSession('a', 60, log, scans = 1)
+        scheduler.schedule(session, time.time() + 60)
+        now = time.time()
+        scheduler.schedule(session, now)
+        self.assertTrue(session.stopped.wait(5))
+        scheduler.stop()
+        self.assertEqual(log, [('a', now)])
+
+    def test_blocked(self):
+        scheduler = SessionScheduler(1, 0.2)
+        log = []
+        block = threading.Event()
+        blocked = FakeSession('a', 60, log, block = block)
+        session = FakeSession('b', 0.1, log, scans = 1)
+        now = time.time()
+        scheduler.schedule(blocked, now)
+        scheduler.schedule(session, now + 0.05)
+        # with every worker blocked another is started, so the other sessions are still scanned
+        self.assertTrue(session.stopped.wait(5))
+
+        # and a blocked session which is stopped is torn down as soon as its scan returns
+        blocked.stopping.set()
+        scheduler.wake(blocked)
+        block.set()
+        self.assertTrue(blocked.stopped.wait(5))
+        scheduler.stop()
+        self.assertEqual(log, [('a', now), ('b', now + 0.05), ('a', 'teardown')])
@@ -0,0 +1,43 @@
+import time
+from datetime import datetime, timedelta
+
+import mock
+from django.test import TestCase
+from django.utils.timezone import utc
+import settings
+
+from chroma_core.models.stats import to_timestamp
+from chroma_core.services.stats import StatsInserter, StatsQueue
+
+
+now = datetime.fromtimestamp(0, utc) + timedelta(days=365 * 40)
+
+
+class TestStatsInserter(TestCase):
+    "Test batching of stats messages."
+
+    def message(self, *samples):
+        return {'sent': time.time(), 'samples': [(id, to_timestamp(dt), value) for id, dt, value in samples]}
+
+    def test_batches(self):
+        inserter = StatsInserter()
+        with mock.patch.multiple(settings, STATS_BATCH_SIZE=3, STATS_BATCH_WINDOW=0):
+            for count in (2, 2, 1):
+                inserter.put(self.message(*[(1, now, 1.0)] * count))
+            inserter.stop()
+            self.assertEqual([len(batch) for batch in inserter.batches()], [2, 1])
+
+    @mock.patch('chroma_core.services.stats.Stats')
+    def test_insert(self, stats):
+        stats.insert.return_value = []
+        later = now + timedelta(seconds=10)
+        StatsInserter().insert([self.message((1, later, 2.0), (2, now, 1.0)), self.message((1, later, 3.0), (1, now, 1.0))])
+        samples, = stats.insert.call_args[0]
+        self.assertEqual(samples, [(2, now, 1.0), (1, now, 1.0), (1, later, 3.0)])
+
+    @mock.patch('chroma_core.services.queue.ServiceQueue.put', autospec=True)
+    def test_shards(self, put):
+        with mock.patch.multiple(settings, STATS_WORKERS=2):
+            StatsQueue().put([(id, now, 1.0) for id in range(5)])
+        queues = dict((stats_queue.name, [sample[0] for sample in message['samples']]) for (stats_queue, message), _ in put.call_args_list)
+        self.assertEqual(queues, {'stats': [0, 2, 4], 'stats_1': [1, 3]})